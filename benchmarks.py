@@ -0,0 +1,241 @@
+"""
+Rough timing benchmarks for the soundtrack rendering pipeline.
+
+Usage:
+    python benchmarks.py [benchmark_name ...]
+
+Runs every benchmark when no name is given.
+"""
+import sys
+import time
+
+import numpy as np
+
+from pydub import AudioSegment
+
+BENCHMARK_SAMPLE_RATE = 96000
+BENCHMARK_SAMPLE_WIDTH = 4
+
+
+def make_noise_segment(duration_seconds: float, sample_rate: int = BENCHMARK_SAMPLE_RATE,
+                       sample_width: int = BENCHMARK_SAMPLE_WIDTH, channels: int = 2) -> AudioSegment:
+    dtype = np.dtype("i%d" % sample_width)
+    amplitude = np.iinfo(dtype).max // 4
+    frames = int(duration_seconds * sample_rate)
+    samples = np.random.randint(-amplitude, amplitude, size=(frames, channels), dtype=dtype)
+    return AudioSegment(data=samples.tobytes(), sample_width=sample_width, frame_rate=sample_rate, channels=channels)
+
+
+def timed(fn, *args, **kwargs):
+    started_at = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - started_at, result
+
+
+def benchmark_stitching():
+    from processor_functions import stitch_sample_variations
+
+    variations = [make_noise_segment(duration) for duration in (7.0, 9.5, 12.0)]
+    for method in ("JOIN_WITH_CROSSFADE", "JOIN_WITH_OVERLAY"):
+        for max_length_seconds in (60, 120, 240, 480):
+            elapsed, _ = timed(stitch_sample_variations, variations, max_length_seconds * 1000, 1000, method)
+            print("stitching {method} {length}s: {elapsed:.3f}s ({per_minute:.3f}s per minute of audio)".format(
+                method=method, length=max_length_seconds, elapsed=elapsed,
+                per_minute=elapsed / (max_length_seconds / 60)))
+
+
+def benchmark_audioop():
+    # compares the C audioop module (the standard library one, or audioop-lts
+    # on Python 3.13+) with the NumPy fallback in pydub.pyaudioop
+    import warnings
+    from pydub import pyaudioop
+
+    backends = {"numpy": pyaudioop}
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        try:
+            import audioop
+            backends["c"] = audioop
+        except ImportError:
+            print("audioop: C module not available (pip install audioop-lts on Python 3.13+)")
+
+    for sample_width in (2, 4):
+        segment = make_noise_segment(10.0, sample_width=sample_width)
+        other = make_noise_segment(10.0, sample_width=sample_width)
+        data = segment.raw_data
+        operations = {
+            "mul": lambda backend: backend.mul(data, sample_width, 0.7),
+            "add": lambda backend: backend.add(data, other.raw_data, sample_width),
+            "max": lambda backend: backend.max(data, sample_width),
+            "rms": lambda backend: backend.rms(data, sample_width),
+            "avg": lambda backend: backend.avg(data, sample_width),
+            "bias": lambda backend: backend.bias(data, sample_width, 1),
+            "lin2lin": lambda backend: backend.lin2lin(data, sample_width, 6 - sample_width),
+            "ratecv": lambda backend: backend.ratecv(data, sample_width, 2, BENCHMARK_SAMPLE_RATE, 44100, None),
+            "tomono": lambda backend: backend.tomono(data, sample_width, 0.5, 0.5),
+            "tostereo": lambda backend: backend.tostereo(data, sample_width, 1.0, 1.0),
+            "reverse": lambda backend: backend.reverse(data, sample_width),
+        }
+        for name, operation in operations.items():
+            timings = {backend_name: timed(operation, backend)[0] for backend_name, backend in backends.items()}
+            print("audioop {name} {bits} bit, 10s stereo: {timings}".format(
+                name=name, bits=sample_width * 8,
+                timings=", ".join("{backend} {elapsed:.4f}s".format(backend=backend, elapsed=elapsed)
+                                  for backend, elapsed in timings.items())))
+
+
+def aliasing_dbfs(resampled, frame_rate, frequency):
+    # level of everything but the expected tone, relative to full scale
+    samples = resampled[:, 0] / np.iinfo(resampled.dtype).max
+    times = np.arange(len(samples)) / frame_rate
+    basis = np.column_stack((np.sin(2 * np.pi * frequency * times), np.cos(2 * np.pi * frequency * times)))
+    residual = samples - basis @ np.linalg.lstsq(basis, samples, rcond=None)[0]
+    # skip the filter start up and tail
+    residual = residual[frame_rate // 10:-frame_rate // 10]
+    return 10 * np.log10(max(np.mean(residual ** 2), 1e-30) * 2)
+
+
+def benchmark_resampling():
+    # throughput of audioop.ratecv (linear interpolation) against the polyphase resampler, and how much
+    # of a tone above the target Nyquist frequency folds back (aliases) into the audible band
+    from pydub.resampler import RESAMPLER_QUALITIES
+    from pydub.utils import audioop
+
+    segment = make_noise_segment(30.0, sample_width=4)
+    for frame_rate in (44100, 48000):
+        elapsed, _ = timed(audioop.ratecv, segment.raw_data, 4, 2, segment.frame_rate, frame_rate, None)
+        print("resampling 30s 96000 -> {rate} ratecv: {elapsed:.3f}s".format(rate=frame_rate, elapsed=elapsed))
+        for quality in RESAMPLER_QUALITIES:
+            elapsed, _ = timed(resample_segment, segment, frame_rate, quality)
+            print("resampling 30s 96000 -> {rate} polyphase {quality}: {elapsed:.3f}s".format(
+                rate=frame_rate, quality=quality, elapsed=elapsed))
+
+    # a 30 kHz tone has nothing to do below 22.05 kHz, all of it that remains after resampling is aliasing
+    duration_frames = BENCHMARK_SAMPLE_RATE * 2
+    tone = (np.sin(2 * np.pi * 30000 * np.arange(duration_frames) / BENCHMARK_SAMPLE_RATE) * 0.5 * (2 ** 31 - 1))
+    tone_segment = AudioSegment(data=np.repeat(tone.astype(np.int32)[:, np.newaxis], 2, axis=1).tobytes(),
+                                sample_width=4, frame_rate=BENCHMARK_SAMPLE_RATE, channels=2)
+    aliased, _ = audioop.ratecv(tone_segment.raw_data, 4, 2, BENCHMARK_SAMPLE_RATE, 44100, None)
+    aliased = np.frombuffer(aliased, dtype=np.int32).reshape(-1, 2)
+    print("aliasing of a -6 dBFS 30 kHz tone at 44100 ratecv: {level:.1f} dBFS".format(
+        level=aliasing_dbfs(aliased, 44100, 30000)))
+    for quality in RESAMPLER_QUALITIES:
+        resampled = resample_segment(tone_segment, 44100, quality).get_numpy_array()
+        print("aliasing of a -6 dBFS 30 kHz tone at 44100 polyphase {quality}: {level:.1f} dBFS".format(
+            quality=quality, level=aliasing_dbfs(resampled, 44100, 30000)))
+
+
+def benchmark_slicing():
+    # slices share the samples of the segment they are taken from, so cutting
+    # a segment up should allocate (next to) nothing
+    import tracemalloc
+    from processor_functions import stitch_sample_variations
+
+    segment = make_noise_segment(120.0)
+    tracemalloc.start()
+    elapsed, slices = timed(lambda: [segment[position:position + 1000] for position in range(0, len(segment), 1000)])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("slicing 120s into {count} 1s segments: {elapsed:.3f}s, peak {peak:.1f} MB allocated "
+          "({size:.1f} MB of samples)".format(count=len(slices), elapsed=elapsed, peak=peak / 2 ** 20,
+                                               size=len(segment.raw_data) / 2 ** 20))
+
+    variations = [make_noise_segment(duration) for duration in (7.0, 9.5, 12.0)]
+    for method in ("JOIN_WITH_CROSSFADE", "JOIN_WITH_OVERLAY"):
+        tracemalloc.start()
+        elapsed, stitched = timed(stitch_sample_variations, variations, 120 * 1000, 1000, method)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("stitching {method} 120s: {elapsed:.3f}s, peak {peak:.1f} MB allocated ({size:.1f} MB output)".format(
+            method=method, elapsed=elapsed, peak=peak / 2 ** 20, size=stitched.nbytes / 2 ** 20))
+
+
+def benchmark_mixing():
+    # one overlay per segment copies the whole mix every time, mix_many sums them all in one pass
+    for count in (10, 40, 160):
+        segments = [(make_noise_segment(5.0), index * 1000, -3) for index in range(count)]
+        length = (count + 4) * 1000
+        elapsed, _ = timed(AudioSegment.mix_many, segments, length)
+        print("mixing {count} 5s segments into {length}s with mix_many: {elapsed:.3f}s".format(
+            count=count, length=length // 1000, elapsed=elapsed))
+
+        def overlay_all():
+            mix = AudioSegment.silent(length, BENCHMARK_SAMPLE_RATE).set_channels(2).set_sample_width(
+                BENCHMARK_SAMPLE_WIDTH)
+            for segment, position, gain in segments:
+                mix = mix.overlay(segment.apply_gain(gain), position=position)
+            return mix
+
+        elapsed, _ = timed(overlay_all)
+        print("mixing {count} 5s segments into {length}s with overlay: {elapsed:.3f}s".format(
+            count=count, length=length // 1000, elapsed=elapsed))
+
+
+def legacy_crossfade_append(seg1, seg2, crossfade):
+    # how append used to build a crossfade: both fades mixed by an overlay, then the three parts joined
+    xf = seg1[-crossfade:].fade(to_gain=-120, start=0, end=float('inf'))
+    xf *= seg2[:crossfade].fade(from_gain=-120, start=0, end=float('inf'))
+    return seg1._spawn([seg1[:-crossfade]._data, xf._data, seg2[crossfade:]._data])
+
+
+def benchmark_crossfade():
+    from pydub.utils import CROSSFADE_CURVES
+
+    first, second = make_noise_segment(5.0), make_noise_segment(5.0)
+    repeats = 50
+    for crossfade in (100, 1000):
+        elapsed, _ = timed(lambda: [legacy_crossfade_append(first, second, crossfade) for _ in range(repeats)])
+        print("append with a {crossfade}ms crossfade, fade and overlay: {elapsed:.2f}ms per call".format(
+            crossfade=crossfade, elapsed=1000 * elapsed / repeats))
+        for curve in CROSSFADE_CURVES:
+            elapsed, _ = timed(lambda: [first.append(second, crossfade, curve) for _ in range(repeats)])
+            print("append with a {crossfade}ms crossfade, {curve} gain table: {elapsed:.2f}ms per call".format(
+                crossfade=crossfade, curve=curve, elapsed=1000 * elapsed / repeats))
+
+
+def benchmark_lazy():
+    # the same chain of operations evaluated eagerly and lazily, exported to a raw file
+    import os
+    import tempfile
+    import tracemalloc
+
+    segment = make_noise_segment(120.0)
+    overlay = make_noise_segment(30.0)
+    out_path = os.path.join(tempfile.mkdtemp(), "lazy.raw")
+    for lazy in (False, True):
+        source, top = (segment.lazy(), overlay.lazy()) if lazy else (segment, overlay)
+        tracemalloc.start()
+        started_at = time.perf_counter()
+        chain = source[1000:110000].fade_in(500).apply_gain(-3).overlay(top.fade_out(200), position=2000)
+        chain.export(out_path, format="raw").close()
+        elapsed = time.perf_counter() - started_at
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("slice, fade, gain, overlay and export of 109s {mode}: {elapsed:.3f}s, peak {peak:.1f} MB allocated "
+              "({size:.1f} MB output)".format(mode="lazy" if lazy else "eager", elapsed=elapsed,
+                                               peak=peak / 2 ** 20, size=os.path.getsize(out_path) / 2 ** 20))
+    os.remove(out_path)
+    os.rmdir(os.path.dirname(out_path))
+
+
+def resample_segment(segment, frame_rate, quality):
+    from pydub.resampler import resample
+
+    resampled = resample(segment.get_numpy_array(), segment.frame_rate, frame_rate, quality)
+    return segment._spawn(resampled, overrides={"frame_rate": frame_rate})
+
+
+BENCHMARKS = {
+    "stitching": benchmark_stitching,
+    "audioop": benchmark_audioop,
+    "resampling": benchmark_resampling,
+    "slicing": benchmark_slicing,
+    "lazy": benchmark_lazy,
+    "mixing": benchmark_mixing,
+    "crossfade": benchmark_crossfade,
+}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
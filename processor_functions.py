@@ -1,28 +1,143 @@
+import bisect
+from concurrent.futures import ThreadPoolExecutor
 import math
+import mmap
 import threading
-from typing import List, Any
+from typing import Dict, List, Any, Tuple
 import os
 import random
+import shutil
+import struct
+import sys
+import tempfile
 import time
-import warnings
-from pydub.utils import ratio_to_db, db_to_float
+
+import numpy as np
+
+from pydub.utils import ratio_to_db, db_to_float, apply_gain_envelope, float_to_int_samples, mediainfo_json, \
+    int_samples_to_bytes, crossfade_gain_tables
 from pydub import AudioSegment
+from pydub.resampler import PolyphaseResampler
+from pydub.exceptions import CouldntDecodeError
+from pydub.wavfile import read_wav_file
 from multiprocessing import Pool, cpu_count
+from sample_cache import DecodedSampleCache, DEFAULT_SAMPLE_CACHE_SIZE_MB
+
+
+# One row per timing window, sorted by start_at. Timeframe lengths are in milliseconds, gains in dB.
+TIMING_WINDOW_DTYPE = np.dtype([
+    ("start_at", np.int64),
+    ("min_length_ms", np.int64),
+    ("max_length_ms", np.int64),
+    ("min_gain_db", np.int32),
+    ("max_gain_db", np.int32),
+])
+
+# One row per segment the stitched track is split into. start and end are in milliseconds (both included),
+# each segment fades from fade_from to fade_to (in dB) over its whole length.
+SEGMENT_PLAN_DTYPE = np.dtype([
+    ("start", np.int64),
+    ("end", np.int64),
+    ("fade_from", np.int32),
+    ("fade_to", np.int32),
+])
+
+
+class SampleStitchingPick:
+    def __init__(
+            self,
+            variation_index: int,
+            position_frames: int,
+            overlap_frames: int):
+        self.variation_index = variation_index
+        self.position_frames = position_frames
+        self.overlap_frames = overlap_frames
 
 
-class SampleSplittingSegmentMap:
+class RenderedTrack:
+    """
+    Small, picklable description of a track a pool worker rendered into a raw PCM temp file.
+    Only this travels back to the parent process, which memory-maps the file instead of
+    receiving the samples through the pool.
+    """
+
     def __init__(
             self,
-            split_start_at_included: int | None,
-            split_end_at_included: int | None,
-            fade_from: int | None,
-            fade_to: int | None):
-        self.split_start_at_included = split_start_at_included
-        self.split_end_at_included = split_end_at_included
-        self.fade_from = fade_from
-        self.fade_to = fade_to
+            index: int,
+            path: str,
+            shape: tuple,
+            dtype: str,
+            frame_rate: int,
+            peak: float):
+        self.index = index
+        self.path = path
+        self.shape = shape
+        self.dtype = dtype
+        self.frame_rate = frame_rate
+        self.peak = peak
+
+    @property
+    def channels(self) -> int:
+        return self.shape[1]
+
+    @property
+    def max_dBFS(self) -> float:
+        return peak_sample_value_to_dbfs(self.peak, np.dtype(self.dtype))
+
+    def iter_blocks(self, block_frames: int):
+        # Memory-mapped reads of the track, block by block. Pages behind the current block are handed
+        # back to the kernel as the blocks are consumed, so resident memory stays around one block.
+        if self.shape[0] == 0:
+            return
+        with open(self.path, "rb") as track_file:
+            mapped = mmap.mmap(track_file.fileno(), 0, access=mmap.ACCESS_READ)
+        frames = np.frombuffer(mapped, dtype=self.dtype).reshape(self.shape)
+        frame_bytes = frames.strides[0]
+
+        for block_start in range(0, self.shape[0], block_frames):
+            yield frames[block_start:block_start + block_frames]
+            if hasattr(mmap, "MADV_DONTNEED"):
+                consumed_bytes = (block_start + block_frames) * frame_bytes
+                mapped.madvise(mmap.MADV_DONTNEED, 0, min(consumed_bytes, len(mapped)) // mmap.PAGESIZE * mmap.PAGESIZE)
+
+    def remove(self, messages_for_polling):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        else:
+            log_for_polling("Cannot remove temporary stored track from disk: {path}".format(path=self.path),
+                            messages_for_polling)
 
 
+class SampleVariationBuffer:
+    """
+    Small, picklable handle on a sample variation the parent process decoded and converted to the
+    processing format, stored as a .npy file. Every pool worker memory-maps the same file, so a variation
+    used by several tracks is decoded once and held in memory once.
+    """
+
+    def __init__(self, filename: str, path: str, frame_rate: int):
+        self.filename = filename
+        self.path = path
+        self.frame_rate = frame_rate
+
+    def open(self) -> np.ndarray:
+        return np.load(self.path, mmap_mode="r")
+
+    def to_audio_segment(self) -> AudioSegment:
+        return frames_to_audio_segment(self.open(), self.frame_rate)
+
+
+# Length of the blocks tracks are mixed in (and rendered and encoded in, when streaming render is requested)
+DEFAULT_BLOCK_SIZE_MS = 10000
+
+# Format the tracks are rendered in when the request does not ask for a processingFormat
+DEFAULT_PROCESSING_FORMAT = {"sampleRate": 96000, "bitDepth": 32}
+
+# Upper bound on the ffmpeg processes decoding at the same time, whichever thread starts them.
+# Variations are decoded before the track workers start, so every core can run one.
+MAX_CONCURRENT_FFMPEG_PROCESSES = cpu_count()
+ffmpeg_process_slots = threading.BoundedSemaphore(MAX_CONCURRENT_FFMPEG_PROCESSES)
+
 # Lock to ensure thread-safe access to messages_for_polling
 messages_lock = threading.Lock()
 
@@ -65,233 +180,435 @@ def get_sample_rate(file: AudioSegment):
     return file.frame_rate
 
 
-def create_soundtrack(
+def audio_segment_to_frames(file: AudioSegment) -> np.ndarray:
+    # read-only (frames, channels) view over the raw data of the segment, no copy is made
+    return file.get_numpy_array()
 
-        samples_variations_filenames: List[str],
-        timing_windows: Any,
 
-        max_length_seconds: int,
+def frames_to_audio_segment(frames: np.ndarray, frame_rate: int) -> AudioSegment:
+    # the segment reads straight from the (frames, channels) array, which may be memory-mapped, nothing is copied
+    return AudioSegment(
+        data=memoryview(frames).cast("B"),
+        sample_width=frames.dtype.itemsize,
+        sample_format="float" if frames.dtype.kind == "f" else "int",
+        frame_rate=frame_rate,
+        channels=frames.shape[1]
+    )
 
-        sample_concat_overlay_seconds: float,
-        sample_stitching_method: str,  # "JOIN_WITH_OVERLAY", "JOIN_WITH_CROSSFADE"
-        bit_depth: int,
-        sample_rate: int,
-        messages_for_polling):
-    # Initialize an empty audio segment with 0 duration for storing the concatenated sample
-    original_concatenated_sample = AudioSegment.silent(duration=0)
-    original_concatenated_sample.set_frame_rate(sample_rate)
-    original_concatenated_sample.set_sample_width(translate_bit_depth_for_pydub(bit_depth))
-
-    # Load sample
-    sample_variations_audio_segments: List[AudioSegment] = [AudioSegment.from_file(variation_filename) for
-                                                            variation_filename in samples_variations_filenames]
-
-    for j in range(len(sample_variations_audio_segments)):
-        found_sample_rate = get_sample_rate(sample_variations_audio_segments[j])
-        if sample_rate != found_sample_rate:
-            warnings.warn(
-                "\nDifferent sample rate detected for: {samples_variations_filename}.\n"
-                "Desired track sample rate: {desired_sample_rate}.\n"
-                "The actual sample has: {sample_actual_sample_rate}. This can cause artifacts when resampling.\n"
-                "It is recommended to keep the same sample rate as the samples that will be mixed."
-                .format(
-                    samples_variations_filename=samples_variations_filenames[j],
-                    desired_sample_rate=sample_rate,
-                    sample_actual_sample_rate=found_sample_rate
-                )
-
-            )
-            time.sleep(1)
-            log_for_polling("Will resample at the desired sample rate...", messages_for_polling)
-            sample_variations_audio_segments[j] = sample_variations_audio_segments[j].set_frame_rate(sample_rate)
-        sample_variations_audio_segments[j] = sample_variations_audio_segments[j].set_sample_width(
-            translate_bit_depth_for_pydub(bit_depth))
-
-    log_for_polling(samples_variations_filenames[0] + ": bit depth " + str(
-        get_bit_depth_from_audio_segment(sample_variations_audio_segments[0])) + ", sample rate: " + str(
-        get_sample_rate(sample_variations_audio_segments[0])), messages_for_polling)
 
-    desired_track_length_milliseconds = max_length_seconds * 1000
+def get_peak_sample_value(frames: np.ndarray) -> float:
+    if frames.size == 0:
+        return 0
+    if frames.dtype.kind == "f":
+        return max(float(frames.max()), -float(frames.min()))
+    return max(int(frames.max()), -int(frames.min()))
 
-    # Keep adding the sample variations until the processed sample is processedSampleMaxLength minutes
-    while len(original_concatenated_sample) < desired_track_length_milliseconds:
 
-        # pick random sample variation to concatenate the final audio data
-        random_sample_variation_index = random.randint(0, len(samples_variations_filenames) - 1)
-
-        # log_for_polling(f"Current concatenated length: {len(original_concatenated_sample)}")
-        # log_for_polling(f"Adding sample of length: {len(sample_variations_audio_segments[random_sample_variation_index])}")
-
-        # make sure stitching overlay is not bigger than any of the stitched parts
-        safe_sample_concat_overlay_milliseconds = sample_concat_overlay_seconds * 1000
-        if len(original_concatenated_sample) - 1 < safe_sample_concat_overlay_milliseconds:
-            safe_sample_concat_overlay_milliseconds = 0
-
-        if sample_stitching_method == "JOIN_WITH_CROSSFADE":
-            original_concatenated_sample = original_concatenated_sample.append(
-                sample_variations_audio_segments[random_sample_variation_index],
-                crossfade=safe_sample_concat_overlay_milliseconds)
-        elif sample_stitching_method == "JOIN_WITH_OVERLAY":
-
-            # Determine the position for the overlay
-            overlay_position = len(original_concatenated_sample) - safe_sample_concat_overlay_milliseconds
-
-            # Get the sample to overlay
-            overlay_sample = sample_variations_audio_segments[random_sample_variation_index]
-
-            # Calculate the length of the overlay sample
-            overlay_length = len(overlay_sample)
-
-            silence_duration = overlay_length - safe_sample_concat_overlay_milliseconds
-            silence_segment = AudioSegment.silent(duration=silence_duration)
-            silence_segment.set_frame_rate(sample_rate)
-            silence_segment.set_sample_width(translate_bit_depth_for_pydub(bit_depth))
-
-            original_concatenated_sample = original_concatenated_sample.append(silence_segment, crossfade=0)
-            # Perform the overlay
-            original_concatenated_sample = original_concatenated_sample.overlay(
-                overlay_sample,
-                position=overlay_position
-            )
-        else:
-            return Exception("Unknown stitching method")
+def full_scale_sample_value(dtype: np.dtype) -> float:
+    # float samples are full scale at 1.0, integer ones at 2 ** (bits - 1)
+    return 1.0 if dtype.kind == "f" else float(np.iinfo(dtype).max + 1)
 
-    # crop processed sample at exact processedSampleMaxLength
-    original_concatenated_sample = original_concatenated_sample[:desired_track_length_milliseconds]
 
-    # Process originalConcatenatedSample by taking parts out of it and applying
-    # fading effects then adding it to processedConcatenatedSample
+def peak_sample_value_to_dbfs(peak: float, dtype: np.dtype) -> float:
+    return ratio_to_db(peak, full_scale_sample_value(dtype))
 
-    # Initialize an empty audio segment with 0 duration for concatenating processed parts of originalConcatenatedSample
-    processed_concatenated_sample = AudioSegment.silent(duration=0)
-    processed_concatenated_sample.set_frame_rate(sample_rate)
-    processed_concatenated_sample.set_sample_width(translate_bit_depth_for_pydub(bit_depth))
 
-    # setting a total track length less than maximum sample window length will cause undesired behavior
-    for timing_window in timing_windows:
-        if timing_window["params"]["minTimeframeLengthMs"] >= desired_track_length_milliseconds or timing_window["params"]["maxTimeframeLengthMs"] >= desired_track_length_milliseconds:
-            raise Exception("cannot accept total track length to be less than timeframe min or timeframe max")
+def plan_sample_stitching(
+        variation_frame_counts: List[int],
+        desired_length_frames: int,
+        overlap_frames: int) -> List[SampleStitchingPick]:
+    # Work out upfront which variations get picked and where each of them lands in the final buffer,
+    # so the stitched track can be allocated once and every variation written straight into place
+    picks: List[SampleStitchingPick] = []
+    position_frames = 0
 
-    # fill the mapping array with maximum elements that the algorithm can possibly fill
-    # (if it always chooses minimum random intervals when it splits originalConcatenatedSample into segments )
-    min_sample_segment_timeframe_milliseconds_from_all_timeframes = timing_windows[0]["params"]["minTimeframeLengthMs"]
-    for timing_window in timing_windows:
-        if min_sample_segment_timeframe_milliseconds_from_all_timeframes > timing_window["params"][
-            "minTimeframeLengthMs"]:
-            min_sample_segment_timeframe_milliseconds_from_all_timeframes = timing_window["params"][
-                "minTimeframeLengthMs"]
-
-    if min_sample_segment_timeframe_milliseconds_from_all_timeframes == 0:
-        raise Exception("min_sample_segment_timeframe_milliseconds_from_all_timeframes cannot be zero")
-
-    maximum_hypotetical_possible_sample_segments = int(
-        desired_track_length_milliseconds // min_sample_segment_timeframe_milliseconds_from_all_timeframes)
-    sample_processing_mapping: List[SampleSplittingSegmentMap] = [
-        SampleSplittingSegmentMap(
-            split_start_at_included=None,
-            split_end_at_included=None,
-            fade_from=None,
-            fade_to=None
-        ) for _ in range(maximum_hypotetical_possible_sample_segments)
-    ]
-
-    # temp variables
-    _lastSegmentVolumeEnd = random.randint(
-        safe_ratio_to_db(timing_windows[0]["params"]["minVolRatio"]),
-        safe_ratio_to_db(timing_windows[0]["params"]["maxVolRatio"]))
-    _lastSegmentSplitEndIncluded = -1
-    _originalSampleLength = len(original_concatenated_sample)
-    _mappedSegmentsCount = 0
-
-    for i in range(len(sample_processing_mapping)):
-        current_timing_window = timing_windows[0]
-        for timing_window_index, timing_window in reversed(list(enumerate(timing_windows))):
-            if timing_window_index == 0 and timing_window['startAt'] != 0:
-                raise Exception("The startAt property needs to be 0 in the first time window.")
-
-            if _lastSegmentSplitEndIncluded + 1 >= timing_window['startAt']:
-                current_timing_window = timing_window
-                break  # Breaks the inner loop, continues with next iteration of the outer loop
-
-        max_volume_gain_db = safe_ratio_to_db(current_timing_window["params"]["maxVolRatio"])
-        min_volume_gain_db = safe_ratio_to_db(current_timing_window["params"]["minVolRatio"])
-
-        fading_timeframe_seconds_min = int(current_timing_window["params"]["minTimeframeLengthMs"] / 1000)
-        fading_timeframe_seconds_max = int(current_timing_window["params"]["maxTimeframeLengthMs"] / 1000)
-
-        # create a mapping of how the originalConcatenatedSample will be processed further
-        # split originalConcatenatedSample at random timing positions
-        max_sample_segment_timeframe_milliseconds = fading_timeframe_seconds_max * 1000
-        min_sample_segment_timeframe_milliseconds = fading_timeframe_seconds_min * 1000
-
-        if max_sample_segment_timeframe_milliseconds < min_sample_segment_timeframe_milliseconds:
-            raise Exception(samples_variations_filenames[
-                                0] + ": the max timeframe sample length is shorter than min timeframe sample length")
-
-        if desired_track_length_milliseconds < min_sample_segment_timeframe_milliseconds:
-            log_for_polling(samples_variations_filenames[
-                                0] + ": the final track length is shorter than its minimum fading timeframes length" + str(
-                desired_track_length_milliseconds) + " " + str(min_sample_segment_timeframe_milliseconds),
-                            messages_for_polling)
-            log_for_polling("setting minimum fading timeframes length to the final track length", messages_for_polling)
-            min_sample_segment_timeframe_milliseconds = desired_track_length_milliseconds - 100
+    while position_frames < desired_length_frames:
+        # pick random sample variation to concatenate the final audio data
+        variation_index = random.randint(0, len(variation_frame_counts) - 1)
+
+        # make sure stitching overlap is not bigger than any of the stitched parts
+        safe_overlap_frames = overlap_frames if position_frames > overlap_frames else 0
+        if safe_overlap_frames >= variation_frame_counts[variation_index]:
+            raise Exception("The stitching overlap is longer than the sample variation it is applied to")
+
+        start_frames = position_frames - safe_overlap_frames
+        picks.append(SampleStitchingPick(
+            variation_index=variation_index,
+            position_frames=start_frames,
+            overlap_frames=safe_overlap_frames
+        ))
+        position_frames = start_frames + variation_frame_counts[variation_index]
+
+    return picks
+
+
+def render_sample_stitching(
+        out: np.ndarray,
+        out_start_frame: int,
+        variations: List[np.ndarray],
+        picks: List[SampleStitchingPick],
+        sample_stitching_method: str):  # "JOIN_WITH_OVERLAY", "JOIN_WITH_CROSSFADE"
+    # Writes the picked variations into out, which holds the frames of the stitched track starting at
+    # out_start_frame. Picks are applied in order and clipped to the window covered by out, so rendering
+    # a track block by block gives exactly the same result as rendering it at once.
+    out_end_frame = out_start_frame + len(out)
+    is_float = out.dtype.kind == "f"
+    limits = None if is_float else np.iinfo(out.dtype)
+
+    for pick in picks:
+        variation = variations[pick.variation_index]
+        start = pick.position_frames
+        overlap_end = start + pick.overlap_frames
+        end = start + len(variation)
+
+        # only the overlapping region needs mixing, the rest of the variation is copied as is
+        mix_from = max(start, out_start_frame)
+        mix_to = min(overlap_end, out_end_frame)
+        if mix_to > mix_from:
+            target = out[mix_from - out_start_frame:mix_to - out_start_frame]
+            source = variation[mix_from - start:mix_to - start]
+            mixed = target.astype(np.float64)
+            if sample_stitching_method == "JOIN_WITH_CROSSFADE":
+                # same gains as AudioSegment.append: the tail fades from 0dB to -120dB while the head fades
+                # the other way
+                fade_out, fade_in = crossfade_gain_tables(pick.overlap_frames, pick.overlap_frames)
+                mixed *= fade_out[mix_from - start:mix_to - start, np.newaxis]
+                mixed += source * fade_in[mix_from - start:mix_to - start, np.newaxis]
+            else:
+                mixed += source
+            target[:] = mixed if is_float else np.clip(np.floor(mixed), limits.min, limits.max)
+
+        copy_from = max(overlap_end, out_start_frame)
+        copy_to = min(end, out_end_frame)
+        if copy_to > copy_from:
+            out[copy_from - out_start_frame:copy_to - out_start_frame] = variation[copy_from - start:copy_to - start]
+
+
+def plan_track_stitching(
+        sample_variations_audio_segments: List[AudioSegment],
+        desired_track_length_milliseconds: int,
+        sample_concat_overlay_milliseconds: float) -> Tuple[List[np.ndarray], List[SampleStitchingPick], int]:
+    # Works out which sample variations get stitched together, and where. Returns the frames of the
+    # variations (read-only views, nothing is copied), the picks and the length of the track in frames.
+    first_variation = sample_variations_audio_segments[0]
+
+    desired_length_frames = int(first_variation.frame_count(ms=desired_track_length_milliseconds))
+    overlap_frames = int(first_variation.frame_count(ms=sample_concat_overlay_milliseconds))
+
+    variations = [audio_segment_to_frames(variation) for variation in sample_variations_audio_segments]
+    picks = plan_sample_stitching(
+        [len(variation) for variation in variations], desired_length_frames, overlap_frames)
+    return variations, picks, desired_length_frames
+
+
+def stitch_sample_variations(
+        sample_variations_audio_segments: List[AudioSegment],
+        desired_track_length_milliseconds: int,
+        sample_concat_overlay_milliseconds: float,
+        sample_stitching_method: str) -> np.ndarray:
+    # Keep adding the sample variations until the track reaches desired_track_length_milliseconds.
+    # The whole output is preallocated, so the cost is linear in the output length. Tracks are planned the
+    # same way and rendered by the same render_sample_stitching, only block by block (see TrackRenderer).
+    variations, picks, desired_length_frames = plan_track_stitching(
+        sample_variations_audio_segments, desired_track_length_milliseconds, sample_concat_overlay_milliseconds)
+
+    stitched = np.zeros((desired_length_frames, variations[0].shape[1]), dtype=variations[0].dtype)
+    render_sample_stitching(stitched, 0, variations, picks, sample_stitching_method)
+    return stitched
+
+
+def compile_timing_windows(timing_windows: Any, track_length_milliseconds: int, track_label: str) -> np.ndarray:
+    # validate the timingWindows config once and turn it into a TIMING_WINDOW_DTYPE array sorted by startAt
+    if len(timing_windows) == 0:
+        raise Exception(track_label + ": at least one timing window is required")
+    if timing_windows[0]["startAt"] != 0:
+        raise Exception("The startAt property needs to be 0 in the first time window.")
+
+    compiled = np.zeros(len(timing_windows), dtype=TIMING_WINDOW_DTYPE)
+    for i, timing_window in enumerate(timing_windows):
+        params = timing_window["params"]
+
+        # setting a total track length less than maximum sample window length will cause undesired behavior
+        if params["minTimeframeLengthMs"] >= track_length_milliseconds or \
+                params["maxTimeframeLengthMs"] >= track_length_milliseconds:
+            raise Exception("cannot accept total track length to be less than timeframe min or timeframe max")
+        if params["minTimeframeLengthMs"] == 0:
+            raise Exception(track_label + ": the min timeframe sample length cannot be zero")
+
+        # timeframes are picked at a whole second resolution
+        min_length_ms = int(params["minTimeframeLengthMs"] / 1000) * 1000
+        max_length_ms = int(params["maxTimeframeLengthMs"] / 1000) * 1000
+        if max_length_ms < min_length_ms:
+            raise Exception(track_label + ": the max timeframe sample length is shorter than min timeframe sample length")
+
+        min_gain_db = safe_ratio_to_db(params["minVolRatio"])
+        max_gain_db = safe_ratio_to_db(params["maxVolRatio"])
+        if max_gain_db < min_gain_db:
+            raise Exception(track_label + ": the max volume ratio is lower than the min volume ratio")
+
+        compiled[i] = (timing_window["startAt"], min_length_ms, max_length_ms, min_gain_db, max_gain_db)
+
+    # a stable sort keeps the config order for windows starting at the same time, so the last one wins
+    return compiled[np.argsort(compiled["start_at"], kind="stable")]
+
+
+def generate_segment_plan(
+        compiled_timing_windows: np.ndarray,
+        track_length_milliseconds: int,
+        rng: np.random.Generator | None = None) -> np.ndarray:
+    # Split the track at random positions into contiguous segments, each fading from the volume the previous
+    # segment ended at to a new random volume, using the timing window active where the segment starts.
+    # Segments are drawn in batches, one batch per run of segments falling into the same timing window.
+    if rng is None:
+        rng = np.random.default_rng()
+
+    window_starts = compiled_timing_windows["start_at"].tolist()
+    plan_parts: List[np.ndarray] = []
+
+    position = 0
+    last_fade_to = int(rng.integers(compiled_timing_windows[0]["min_gain_db"],
+                                    compiled_timing_windows[0]["max_gain_db"], endpoint=True))
+
+    while position < track_length_milliseconds:
+        window_index = bisect.bisect_right(window_starts, position) - 1
+        window = compiled_timing_windows[window_index]
+        window_end = window_starts[window_index + 1] if window_index + 1 < len(window_starts) else math.inf
+        batch_end = min(window_end, track_length_milliseconds)
+
+        # every segment moves the position by at least min_length_ms + 1,
+        # so this many segments always reach the end of the batch
+        batch_size = int((batch_end - position) // (window["min_length_ms"] + 1)) + 1
+        durations = rng.integers(window["min_length_ms"], window["max_length_ms"], endpoint=True, size=batch_size)
+        starts = position + np.concatenate(([0], np.cumsum(durations[:-1] + 1)))
+
+        # keep only the segments that start before the next timing window (or the end of the track)
+        batch_size = int(np.searchsorted(starts, batch_end, side="left"))
+        starts = starts[:batch_size]
+
+        batch = np.empty(batch_size, dtype=SEGMENT_PLAN_DTYPE)
+        batch["start"] = starts
+        batch["end"] = np.minimum(track_length_milliseconds, starts + durations[:batch_size])
+        batch["fade_to"] = rng.integers(window["min_gain_db"], window["max_gain_db"], endpoint=True, size=batch_size)
+        batch["fade_from"][0] = last_fade_to
+        batch["fade_from"][1:] = batch["fade_to"][:-1]
+        plan_parts.append(batch)
+
+        position = int(batch["end"][-1]) + 1
+        last_fade_to = int(batch["fade_to"][-1])
+
+    if not plan_parts:
+        return np.empty(0, dtype=SEGMENT_PLAN_DTYPE)
+    return np.concatenate(plan_parts)
+
+
+def build_segment_plan_gain_envelope(segment_plan: np.ndarray, track_length_milliseconds: int, frame_rate: int):
+    # The segments are contiguous and each one fades from fade_from to fade_to over its whole length,
+    # so together they form one piecewise linear gain curve. Returns its breakpoints (in frames, with
+    # linear gain ratios).
+    segment_ends = np.minimum(segment_plan["end"] + 1, track_length_milliseconds)
+    segment_lengths = segment_ends - segment_plan["start"]
+    non_empty = segment_lengths > 0
+    segment_plan = segment_plan[non_empty]
+    segment_lengths = segment_lengths[non_empty]
+
+    segment_start_frames = (segment_plan["start"] * frame_rate // 1000).astype(np.int64)
+    fade_end_frames = segment_start_frames + ((segment_lengths - 1) * frame_rate // 1000).astype(np.int64)
+
+    breakpoint_frames = np.column_stack((segment_start_frames, fade_end_frames)).ravel()
+    breakpoint_gains = np.power(10.0, np.column_stack((segment_plan["fade_from"], segment_plan["fade_to"])).ravel() / 20)
+
+    return breakpoint_frames, breakpoint_gains
+
+
+class TrackRenderer:
+    """
+    Renders one track from its stitching picks and its segment plan. Any range of frames can be rendered
+    on its own: the picks and the gain envelope are planned for the whole track upfront, so the only state
+    carried from one block to the next is which picks are still playing. This lets long tracks be produced
+    block by block with memory bounded by the block size.
+    """
 
-        if desired_track_length_milliseconds < max_sample_segment_timeframe_milliseconds:
-            log_for_polling(samples_variations_filenames[
-                                0] + ": the final track length is shorter than the max fading timeframes length",
-                            messages_for_polling)
-            log_for_polling("setting maximum fading timeframes length to the final track length", messages_for_polling)
-            max_sample_segment_timeframe_milliseconds = desired_track_length_milliseconds - 50
+    def __init__(
+            self,
+            variations: List[np.ndarray],
+            picks: List[SampleStitchingPick],
+            sample_stitching_method: str,
+            segment_plan: np.ndarray,
+            length_frames: int,
+            frame_rate: int):
+        if sample_stitching_method not in ("JOIN_WITH_OVERLAY", "JOIN_WITH_CROSSFADE"):
+            raise Exception("Unknown stitching method")
+
+        self.variations = variations
+        self.picks = picks
+        self.sample_stitching_method = sample_stitching_method
+        self.length_frames = length_frames
+        self.frame_rate = frame_rate
+        self.channels = variations[0].shape[1]
+        self.dtype = variations[0].dtype
+
+        # picks are sorted by position and so are their ends, which allows a bisect lookup per block
+        self._pick_starts = np.array([pick.position_frames for pick in picks], dtype=np.int64)
+        self._pick_ends = np.array([pick.position_frames + len(variations[pick.variation_index]) for pick in picks],
+                                   dtype=np.int64)
+
+        track_length_milliseconds = round(1000 * length_frames / frame_rate)
+        self.breakpoint_frames, self.breakpoint_gains = build_segment_plan_gain_envelope(
+            segment_plan, track_length_milliseconds, frame_rate)
+
+    def render_block(self, block_start: int, block_end: int, out: np.ndarray | None = None) -> np.ndarray:
+        # out, when given, has to be zero filled
+        block = out if out is not None else np.zeros((block_end - block_start, self.channels), dtype=self.dtype)
+
+        first_pick = int(np.searchsorted(self._pick_ends, block_start, side="right"))
+        last_pick = int(np.searchsorted(self._pick_starts, block_end, side="left"))
+        render_sample_stitching(block, block_start, self.variations, self.picks[first_pick:last_pick],
+                                self.sample_stitching_method)
+
+        # apply fading according to the segment plan, in place
+        return apply_gain_envelope(block, self.breakpoint_frames - block_start, self.breakpoint_gains, out=block)
+
+    def iter_blocks(self, block_frames: int):
+        for block_start in range(0, self.length_frames, block_frames):
+            yield self.render_block(block_start, min(block_start + block_frames, self.length_frames))
+
+    def render_to_file(self, path: str, index: int, block_frames: int | None = None) -> RenderedTrack:
+        # Without block_frames the whole track is rendered at once, straight into a memory-mapped file.
+        # With block_frames only one block is held in memory at a time and appended to the file.
+        shape = (self.length_frames, self.channels)
+        if block_frames is None:
+            out = np.memmap(path, dtype=self.dtype, mode="w+", shape=shape)
+            self.render_block(0, self.length_frames, out=out)
+            peak = get_peak_sample_value(out)
+            out.flush()
+            del out
+        else:
+            peak = 0
+            with open(path, "wb") as temp_file:
+                for block in self.iter_blocks(block_frames):
+                    peak = max(peak, get_peak_sample_value(block))
+                    block.tofile(temp_file)
+
+        return RenderedTrack(
+            index=index,
+            path=path,
+            shape=shape,
+            dtype=self.dtype.str,
+            frame_rate=self.frame_rate,
+            peak=peak
+        )
 
-        random_segment_duration = random.randint(
-            min_sample_segment_timeframe_milliseconds,
-            max_sample_segment_timeframe_milliseconds)
-        random_fade_to = random.randint(min_volume_gain_db, max_volume_gain_db)
 
-        sample_processing_mapping[i].split_start_at_included = _lastSegmentSplitEndIncluded + 1
-        sample_processing_mapping[i].split_end_at_included = min(
-            _originalSampleLength,
-            sample_processing_mapping[i].split_start_at_included + random_segment_duration)
-        sample_processing_mapping[i].fade_from = _lastSegmentVolumeEnd
-        sample_processing_mapping[i].fade_to = random_fade_to
+def decode_sample_variation(
+        variation_filename: str,
+        bit_depth: int,
+        sample_rate: int,
+        channels: int,
+        sample_cache: DecodedSampleCache,
+        messages_for_polling) -> str:
+    # Decodes a sample variation in the processing sample rate, bit depth and channel layout and stores it in
+    # the sample cache. A variation converted before (by any job) is already there and is not decoded again.
+    # Returns the cache key of the variation.
+    started_at = time.perf_counter()
+    sample_width = translate_bit_depth_for_pydub(bit_depth)
+    cache_key = sample_cache.key(variation_filename, sample_rate, sample_width, channels)
+    if sample_cache.get(cache_key) is not None:
+        log_for_polling("Found {filename} in the sample cache ({seconds:.2f}s)".format(
+            filename=variation_filename, seconds=time.perf_counter() - started_at), messages_for_polling)
+        return cache_key
+
+    # a single ffmpeg call decodes, resamples and converts the variation, the source format was already
+    # probed by probe_source_formats
+    with ffmpeg_process_slots:
+        variation = AudioSegment.from_file_as(variation_filename, frame_rate=sample_rate, sample_width=sample_width,
+                                              channels=channels)
+
+    sample_cache.put(cache_key, audio_segment_to_frames(variation))
+    log_for_polling("Decoded {filename} in {seconds:.2f}s".format(
+        filename=variation_filename, seconds=time.perf_counter() - started_at), messages_for_polling)
+    return cache_key
+
+
+def decode_sample_variations(variation_filenames: List[str], bit_depth: int, sample_rate: int, channels: int,
+                             sample_cache: DecodedSampleCache, messages_for_polling) -> Dict[str, SampleVariationBuffer]:
+    # Decodes every variation file once, however many tracks share it, and returns a buffer handle per file.
+    # Files that cannot be decoded are logged and left out. The files are decoded concurrently: the threads
+    # mostly wait on their ffmpeg processes, bounded by ffmpeg_process_slots.
+    def decode(variation_filename: str) -> str | None:
+        try:
+            return decode_sample_variation(variation_filename, bit_depth, sample_rate, channels, sample_cache,
+                                           messages_for_polling)
+        except Exception as e:
+            log_for_polling("Error decoding sample variation {filename}: {error}".format(
+                filename=variation_filename, error=str(e)), messages_for_polling)
+            return None
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, min(len(variation_filenames), MAX_CONCURRENT_FFMPEG_PROCESSES))) \
+            as executor:
+        decoded_cache_keys = list(executor.map(decode, variation_filenames))
+    log_for_polling("Decoded {count} sample variations in {seconds:.2f}s".format(
+        count=len(variation_filenames), seconds=time.perf_counter() - started_at), messages_for_polling)
+
+    variation_buffers: Dict[str, SampleVariationBuffer] = {}
+    cache_keys = []
+    for variation_filename, cache_key in zip(variation_filenames, decoded_cache_keys):
+        if cache_key is None:
+            continue
+        cache_keys.append(cache_key)
+        variation_buffers[variation_filename] = SampleVariationBuffer(
+            filename=variation_filename,
+            path=sample_cache.path(cache_key),
+            frame_rate=sample_rate
+        )
 
-        _lastSegmentSplitEndIncluded = sample_processing_mapping[i].split_end_at_included
-        _lastSegmentVolumeEnd = sample_processing_mapping[i].fade_to
-        _mappedSegmentsCount = i + 1
+    # the variations of this job have to survive until the workers have mapped them
+    sample_cache.evict(keep=cache_keys)
+    return variation_buffers
 
-        if sample_processing_mapping[i].split_start_at_included >= _originalSampleLength:
-            break
 
-    # discard the unfilled SampleSplittingSegmentMap items
-    sample_processing_mapping = sample_processing_mapping[:_mappedSegmentsCount]
+def prepare_track_renderer(
 
-    # split segments and apply fading according to the mapping
-    for i in range(len(sample_processing_mapping)):
+        sample_variations: List[SampleVariationBuffer],
+        timing_windows: Any,
 
-        split_start_at_included = sample_processing_mapping[i].split_start_at_included
-        split_end_at_included = sample_processing_mapping[i].split_end_at_included
+        max_length_seconds: int,
 
-        fade_from = sample_processing_mapping[i].fade_from
-        fade_to = sample_processing_mapping[i].fade_to
+        sample_concat_overlay_seconds: float,
+        sample_stitching_method: str,  # "JOIN_WITH_OVERLAY", "JOIN_WITH_CROSSFADE"
+        messages_for_polling) -> TrackRenderer:
+    # Map the decoded samples, nothing is copied
+    sample_variations_audio_segments: List[AudioSegment] = [sample_variation.to_audio_segment() for
+                                                            sample_variation in sample_variations]
+    track_label = sample_variations[0].filename
 
-        sample_segment = original_concatenated_sample[split_start_at_included:split_end_at_included + 1]
+    log_for_polling(track_label + ": bit depth " + str(
+        get_bit_depth_from_audio_segment(sample_variations_audio_segments[0])) + ", sample rate: " + str(
+        get_sample_rate(sample_variations_audio_segments[0])), messages_for_polling)
 
-        segment_length = len(sample_segment)  # Use the full segment length for fade
+    desired_track_length_milliseconds = max_length_seconds * 1000
 
-        if segment_length > 0:
-            processed_concatenated_sample += sample_segment.fade(
-                from_gain=fade_from,
-                to_gain=fade_to,
-                start=0,
-                end=len(sample_segment) - 1)
+    # Plan how the stitched track will be processed further: split it at random timing positions into
+    # segments and fade each of them from the volume the previous segment ended at to a new random volume
+    compiled_timing_windows = compile_timing_windows(
+        timing_windows, desired_track_length_milliseconds, track_label)
+    sample_processing_plan = generate_segment_plan(compiled_timing_windows, desired_track_length_milliseconds)
 
-    return processed_concatenated_sample
+    # Work out which sample variations get stitched together, and where
+    sample_variations, picks, desired_length_frames = plan_track_stitching(
+        sample_variations_audio_segments, desired_track_length_milliseconds, sample_concat_overlay_seconds * 1000)
 
+    return TrackRenderer(
+        variations=sample_variations,
+        picks=picks,
+        sample_stitching_method=sample_stitching_method,
+        segment_plan=sample_processing_plan,
+        length_frames=desired_length_frames,
+        frame_rate=sample_variations_audio_segments[0].frame_rate
+    )
 
-def normalize_soundtrack(audio_track: AudioSegment, messages_for_polling) -> AudioSegment:
-    # Calculate peak level
-    peak_level = audio_track.max_dBFS
 
+def calculate_normalization_gain(peak_level: float, messages_for_polling) -> float:
     log_for_polling("Calculated max peak level: {peak}".format(peak=peak_level), messages_for_polling)
 
     # Calculate normalization gain
@@ -303,11 +620,7 @@ def normalize_soundtrack(audio_track: AudioSegment, messages_for_polling) -> Aud
     normalization_gain = max_peak_level - peak_level
     log_for_polling("Adjusting gain to: {gain}".format(gain=normalization_gain), messages_for_polling)
 
-    # Normalize the soundtrack
-    normalized_soundtrack = audio_track.apply_gain(normalization_gain)
-    log_for_polling("Finished applying normalization gain.", messages_for_polling)
-
-    return normalized_soundtrack
+    return normalization_gain
 
 
 def safe_ratio_to_db(ratio) -> int:
@@ -319,26 +632,6 @@ def safe_ratio_to_db(ratio) -> int:
     return math.floor(ratio_to_db(ratio))
 
 
-# Calculate gain reduction needed based on dB peak levels of all tracks
-def calculate_adjusted_gain_reduction_necessary_to_avoid_clipping_when_mixed(all_tracks_max_peaks: List[float],
-                                                                             target_peak_db: float = 0.0) -> float:
-    # Convert each peak in dB to linear amplitude ratios
-    linear_peaks = [db_to_float(peak_db) for peak_db in all_tracks_max_peaks]
-
-    # Sum peaks with an empirical adjustment factor for realistic mixing (approx 0.707 per added track)
-    combined_peak_ratio = sum([peak * 0.707 for peak in linear_peaks])
-
-    # Convert adjusted combined ratio back to dB
-    combined_peak_db = safe_ratio_to_db(combined_peak_ratio)
-
-    # Calculate gain reduction to bring combined peak down to the target peak level
-    gain_reduction = target_peak_db - combined_peak_db
-    if gain_reduction < 0:
-        return gain_reduction
-    else:
-        return 0
-
-
 def audio_format_to_file_extension(audio_format: str):
     if audio_format == "mp3":
         return "mp3"
@@ -350,126 +643,324 @@ def audio_format_to_file_extension(audio_format: str):
         return "wav"
 
 
-def process_single_track(args):
-    i, number_of_tracks, config, final_length_seconds, PROCESSING_SAMPLE_RATE, PROCESSING_BIT_DEPTH, messages_for_polling = args
+def probe_audio_format(filename: str) -> Tuple[int, int]:
+    # Returns the sample rate and channel count of a file. wav headers (including RF64 and Wave64) are read
+    # directly, anything else is asked to ffprobe
+    try:
+        # mapped, so only the header is actually read
+        wav_data = read_wav_file(filename, memory_map=True)
+        return wav_data.sample_rate, wav_data.channels
+    except (CouldntDecodeError, struct.error):
+        pass
+
+    audio_streams = [stream for stream in mediainfo_json(filename)["streams"] if stream["codec_type"] == "audio"]
+    if not audio_streams:
+        raise Exception("No audio stream found in: {filename}".format(filename=filename))
+    return int(audio_streams[0]["sample_rate"]), int(audio_streams[0]["channels"])
+
+
+def probe_source_formats(samples_data_config, sample_cache: DecodedSampleCache,
+                         messages_for_polling) -> Dict[str, Tuple[int, int]]:
+    # Returns the sample rate and channel count of every variation file the tracks use. Each file is probed
+    # at most once per job, and not at all if the sample cache has seen its content before. Files that cannot
+    # be probed are logged and left out, the tracks using them are skipped later on.
+    variation_filenames = list(dict.fromkeys(
+        variation_filename for config in samples_data_config for variation_filename in config["variationFilePath"]))
+
+    def probe(variation_filename: str) -> Tuple[int, int] | None:
+        try:
+            source_format = sample_cache.get_source_format(variation_filename)
+            if source_format is None:
+                with ffmpeg_process_slots:
+                    source_format = probe_audio_format(variation_filename)
+                sample_cache.put_source_format(variation_filename, *source_format)
+            return source_format
+        except Exception as e:
+            log_for_polling("Cannot probe sample variation {filename}: {error}".format(
+                filename=variation_filename, error=str(e)), messages_for_polling)
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(1, min(len(variation_filenames), MAX_CONCURRENT_FFMPEG_PROCESSES))) \
+            as executor:
+        source_formats = list(executor.map(probe, variation_filenames))
+
+    probed_formats = {variation_filename: source_format
+                      for variation_filename, source_format in zip(variation_filenames, source_formats)
+                      if source_format is not None}
+    if not probed_formats:
+        raise Exception("None of the sample variations could be probed")
+    return probed_formats
+
+
+def resolve_processing_channels(source_formats: Dict[str, Tuple[int, int]], messages_for_polling) -> int:
+    # Every sample variation is decoded to the largest channel count among the sources of the job, the layout
+    # the tracks are mixed in, so a job made of mono samples is rendered in mono.
+    channels = max(source_channels for _, source_channels in source_formats.values())
+    log_for_polling("Processing channels: {channels}".format(channels=channels), messages_for_polling)
+    return channels
+
+
+def resolve_processing_format(jsonData, source_formats: Dict[str, Tuple[int, int]], messages_for_polling):
+    # The processingFormat of the request decides the sample rate and bit depth the tracks are rendered
+    # and mixed in:
+    #   "native": the sample rate the sample variations share (the highest one if they differ), at the output bit depth
+    #   "output": the sample rate and bit depth of the final track, nothing is converted after mixing
+    #   {"sampleRate": ..., "bitDepth": ...}: an explicit format
+    # Returns the name of the policy and the processing sample rate and bit depth.
+    processing_format = jsonData.get("processingFormat", DEFAULT_PROCESSING_FORMAT)
+
+    if processing_format == "output":
+        sample_rate, bit_depth = jsonData["sampleRate"], jsonData["bitDepth"]
+    elif processing_format == "native":
+        source_sample_rates = {source_sample_rate for source_sample_rate, _ in source_formats.values()}
+        if len(source_sample_rates) > 1:
+            log_for_polling("The sample variations have different sample rates: {rates}. Using the highest one.".format(
+                rates=sorted(source_sample_rates)), messages_for_polling)
+        sample_rate, bit_depth = max(source_sample_rates), jsonData["bitDepth"]
+    elif isinstance(processing_format, dict):
+        sample_rate, bit_depth = int(processing_format["sampleRate"]), int(processing_format["bitDepth"])
+        processing_format = "explicit" if "processingFormat" in jsonData else "default"
+    else:
+        raise Exception("Unknown processing format: {processing_format}".format(processing_format=processing_format))
+
+    if bit_depth not in (8, 16, 24, 32):
+        raise Exception("Unsupported processing bit depth: {bit_depth}".format(bit_depth=bit_depth))
+    if bit_depth == 24:
+        # pydub holds 24 bit samples in 32 bit integers anyway
+        bit_depth = 32
+
+    log_for_polling("Processing format ({policy}): sample rate {sample_rate}, bit depth {bit_depth}".format(
+        policy=processing_format, sample_rate=sample_rate, bit_depth=bit_depth), messages_for_polling)
+    return processing_format, sample_rate, bit_depth
 
 
-    from processor_functions import create_soundtrack  # import inside if needed
+def process_single_track(args):
+    i, number_of_tracks, config, sample_variations, final_length_seconds, PROCESSING_SAMPLE_RATE, block_size_ms, \
+        messages_for_polling = args
 
     log_for_polling("Processing track: " + str(i + 1) + " of " + str(number_of_tracks), messages_for_polling)
 
     try:
-        soundtrack = create_soundtrack(
-            samples_variations_filenames=config["variationFilePath"],
+        track_renderer = prepare_track_renderer(
+            sample_variations=sample_variations,
             timing_windows=config["timingWindows"],
             max_length_seconds=final_length_seconds,
             sample_concat_overlay_seconds=int(config["concatOverlayMs"] / 1000),
             sample_stitching_method=config["stitchingMethod"],
-            bit_depth=PROCESSING_BIT_DEPTH,
-            sample_rate=PROCESSING_SAMPLE_RATE,
             messages_for_polling=messages_for_polling
         )
-        # try to normalize down each track take into consideration maximum number
-        # of tracks that will be combined. Use -1db for each new track that will be overlaid.
-        # This is not bulletproof, but it reduces the risk of final track clipping
-        # soundtrack = soundtrack.apply_gain(-number_of_tracks)
 
-        temp_soundtrack_filepath = "generated/temp-track-{track_index}.tmp".format(track_index=i)
-        log_for_polling("Exporting temporary track: {temp_soundtrack_filepath} ...".format(
+        temp_soundtrack_filepath = "generated/temp-track-{track_index}.pcm".format(track_index=i)
+        log_for_polling("Rendering temporary track: {temp_soundtrack_filepath} ...".format(
             temp_soundtrack_filepath=temp_soundtrack_filepath), messages_for_polling)
-        soundtrack.export(temp_soundtrack_filepath, format="wav")
-        log_for_polling("Successfully exported temporary track: {temp_soundtrack_filepath}".format(
+        block_frames = None if block_size_ms is None else int(PROCESSING_SAMPLE_RATE * block_size_ms / 1000)
+        rendered_track = track_renderer.render_to_file(temp_soundtrack_filepath, i, block_frames)
+        log_for_polling("Successfully rendered temporary track: {temp_soundtrack_filepath}".format(
             temp_soundtrack_filepath=temp_soundtrack_filepath), messages_for_polling)
     except Exception as e:
         log_for_polling("Error creating soundtrack: {error}".format(error=str(e)), [])
         return
-    # Return the generated AudioSegment
-    return i, soundtrack
-def process_json(jsonData, messages_for_polling):
-    empty_log_for_polling(messages_for_polling)
+    # Only a small descriptor goes back to the parent, the samples stay in the temp file
+    return rendered_track
 
-    PROCESSING_BIT_DEPTH = 32
-    PROCESSING_SAMPLE_RATE = 96000
 
-    FINAL_TRACK_BIT_DEPTH = jsonData["bitDepth"]
-    FINAL_TRACK_SAMPLE_RATE = jsonData["sampleRate"]
-    final_length_seconds = int(jsonData["lengthMs"] // 1000)
-    audio_format = jsonData["format"]
-    samples_data_config = jsonData["sampleDataConfig"]
+def render_tracks(samples_data_config, source_formats: Dict[str, Tuple[int, int]], final_length_seconds: int,
+                  processing_sample_rate: int, processing_bit_depth: int, block_size_ms: int | None,
+                  sample_cache: DecodedSampleCache, messages_for_polling) -> List[RenderedTrack]:
+    number_of_tracks = len(samples_data_config)
 
-    final_track = AudioSegment.silent(duration=final_length_seconds * 1000)
-    final_track.set_frame_rate(PROCESSING_SAMPLE_RATE)
-    final_track.set_sample_width(translate_bit_depth_for_pydub(PROCESSING_BIT_DEPTH))
+    # Every variation file is decoded once here, the workers map the decoded samples
+    processing_channels = resolve_processing_channels(source_formats, messages_for_polling)
+    log_for_polling("Decoding sample variations...", messages_for_polling)
+    variation_buffers = decode_sample_variations(list(source_formats), processing_bit_depth, processing_sample_rate,
+                                                 processing_channels, sample_cache, messages_for_polling)
 
-    number_of_tracks = len(samples_data_config)
+    # --- Parallel processing ---
+    args_list = []
+    for i, config in enumerate(samples_data_config):
+        if not all(variation_filename in variation_buffers for variation_filename in config["variationFilePath"]):
+            log_for_polling("Skipping track {track}: some of its sample variations could not be probed or decoded".format(
+                track=i + 1), messages_for_polling)
+            continue
+        sample_variations = [variation_buffers[variation_filename] for variation_filename in
+                             config["variationFilePath"]]
+        args_list.append((i, number_of_tracks, config, sample_variations, final_length_seconds,
+                          processing_sample_rate, block_size_ms, messages_for_polling))
+
+    rendered_tracks: List[RenderedTrack] = []
+    with Pool(processes=max(1, min(cpu_count() - 1, 4))) as pool:
+        for rendered_track in pool.imap_unordered(process_single_track, args_list):
+            if rendered_track is not None:
+                rendered_tracks.append(rendered_track)
+    rendered_tracks.sort(key=lambda rendered_track: rendered_track.index)
 
-    log_for_polling("Will process {number_of_tracks} tracks...".format(number_of_tracks=number_of_tracks), messages_for_polling)
+    if len(rendered_tracks) == 0:
+        raise Exception("None of the tracks could be rendered")
+    if len(rendered_tracks) != number_of_tracks:
+        log_for_polling("{failed} track(s) could not be rendered and will be left out of the mix".format(
+            failed=number_of_tracks - len(rendered_tracks)), messages_for_polling)
 
+    return rendered_tracks
 
 
-    # --- Parallel processing ---
-    args_list = [
-        (i, number_of_tracks, samples_data_config[i], final_length_seconds, PROCESSING_SAMPLE_RATE, PROCESSING_BIT_DEPTH, messages_for_polling)
-        for i in range(number_of_tracks)
-    ]
+def process_json(jsonData, messages_for_polling):
+    # Renders every track into a temporary file, mixes them block by block and masters and encodes the mix in
+    # a single streamed pass. With streamingRender the tracks are rendered in blocks of blockSizeMs as well,
+    # instead of at once, so peak memory depends on the block size and the number of tracks instead of the
+    # length of the final track.
+    empty_log_for_polling(messages_for_polling)
+    render_started_at = time.perf_counter()
 
-    with Pool(processes=max(1, min(cpu_count() - 1, 4))) as pool:
-        for _ in pool.imap_unordered(process_single_track, args_list):
-            pass # just wait for completion, results already handled inside
-
-
-    log_for_polling("Calculating the risk of clipping after mixing all tracks", messages_for_polling)
-    all_tracks_max_peaks = [0.0] * number_of_tracks
-    for i in range(number_of_tracks):
-        temp_soundtrack_filepath = "generated/temp-track-{track_index}.tmp".format(track_index=i)
-        track = AudioSegment.from_file(temp_soundtrack_filepath, format="wav")
-        all_tracks_max_peaks[i] = track.max_dBFS
-    # calculate gain reduction needed based on the db peak levels of all tracks (stored in all_tracks_max_peaks)
-    calculated_gain_reduction_to_apply_to_all_tracks = calculate_adjusted_gain_reduction_necessary_to_avoid_clipping_when_mixed(
-        all_tracks_max_peaks)
-    log_for_polling("Calculated gain reduction to apply to all tracks: {reduction} dB".format(
-        reduction=calculated_gain_reduction_to_apply_to_all_tracks), messages_for_polling)
-
-    log_for_polling("Will overlay {number_of_tracks} tracks...".format(number_of_tracks=number_of_tracks), messages_for_polling)
-    for i in range(number_of_tracks):
-        log_for_polling("Mixing track: " + str(i + 1) + " of " + str(number_of_tracks), messages_for_polling)
-        temp_soundtrack_filepath = "generated/temp-track-{track_index}.tmp".format(track_index=i)
-        log_for_polling("Overlaying track {filepath} ...".format(filepath=temp_soundtrack_filepath), messages_for_polling)
-        track = AudioSegment.from_file(temp_soundtrack_filepath, format="wav")
-
-        if calculated_gain_reduction_to_apply_to_all_tracks < 0:
-            track = track.apply_gain(calculated_gain_reduction_to_apply_to_all_tracks)
-
-        final_track = final_track.overlay(track)
-
-        if os.path.exists(temp_soundtrack_filepath):
-            os.remove(temp_soundtrack_filepath)
+    final_length_seconds = int(jsonData["lengthMs"] // 1000)
+    samples_data_config = jsonData["sampleDataConfig"]
+    streaming_render = jsonData.get("streamingRender", False)
+    block_size_ms = jsonData.get("blockSizeMs", DEFAULT_BLOCK_SIZE_MS) if streaming_render else DEFAULT_BLOCK_SIZE_MS
+
+    # Without a persistent sample cache the source formats and decoded variations go to a temporary one for
+    # this job only
+    sample_cache = create_sample_cache(jsonData)
+    job_sample_cache = sample_cache
+    if job_sample_cache is None:
+        job_sample_cache = DecodedSampleCache(tempfile.mkdtemp(prefix="temp-variations-", dir="generated"),
+                                              max_size_bytes=sys.maxsize)
+
+    try:
+        source_formats = probe_source_formats(samples_data_config, job_sample_cache, messages_for_polling)
+        processing_policy, PROCESSING_SAMPLE_RATE, PROCESSING_BIT_DEPTH = resolve_processing_format(
+            jsonData, source_formats, messages_for_polling)
+
+        number_of_tracks = len(samples_data_config)
+
+        if streaming_render:
+            log_for_polling("Will process {number_of_tracks} tracks in blocks of {block_size_ms} ms...".format(
+                number_of_tracks=number_of_tracks, block_size_ms=block_size_ms), messages_for_polling)
         else:
-            log_for_polling(
-                "Cannot remove temporary stored track from disk: {path}".format(path=temp_soundtrack_filepath), messages_for_polling)
+            log_for_polling("Will process {number_of_tracks} tracks...".format(number_of_tracks=number_of_tracks),
+                            messages_for_polling)
+
+        rendered_tracks = render_tracks(samples_data_config, source_formats, final_length_seconds,
+                                        PROCESSING_SAMPLE_RATE, PROCESSING_BIT_DEPTH,
+                                        block_size_ms if streaming_render else None, job_sample_cache,
+                                        messages_for_polling)
+    finally:
+        if sample_cache is None:
+            shutil.rmtree(job_sample_cache.directory, ignore_errors=True)
+
+    block_frames = int(PROCESSING_SAMPLE_RATE * block_size_ms / 1000)
+
+    # the tracks are summed on a float mix bus, which cannot clip, so no headroom has to be reserved upfront
+    log_for_polling("Mixing {number_of_tracks} tracks...".format(number_of_tracks=len(rendered_tracks)), messages_for_polling)
+    mixed_track = mixdown_rendered_tracks(
+        rendered_tracks,
+        "generated/temp-mix.pcm",
+        block_frames)
+
+    for rendered_track in rendered_tracks:
+        rendered_track.remove(messages_for_polling)
+
+    master_and_export_mix(mixed_track, jsonData, block_frames, messages_for_polling)
+    mixed_track.remove(messages_for_polling)
+    log_render_time(processing_policy, PROCESSING_SAMPLE_RATE, PROCESSING_BIT_DEPTH, render_started_at,
+                    messages_for_polling)
+
+
+def create_sample_cache(jsonData) -> DecodedSampleCache | None:
+    # sampleCacheSizeMb caps the on-disk cache of decoded sample variations, 0 turns the cache off
+    sample_cache_size_mb = jsonData.get("sampleCacheSizeMb", DEFAULT_SAMPLE_CACHE_SIZE_MB)
+    if sample_cache_size_mb <= 0:
+        return None
+    return DecodedSampleCache(max_size_bytes=int(sample_cache_size_mb * 1024 * 1024))
+
+
+def log_render_time(processing_policy: str, processing_sample_rate: int, processing_bit_depth: int,
+                    render_started_at: float, messages_for_polling):
+    log_for_polling("Rendered with processing format {policy} ({sample_rate} Hz, {bit_depth} bit) in {seconds:.2f}s".format(
+        policy=processing_policy, sample_rate=processing_sample_rate, bit_depth=processing_bit_depth,
+        seconds=time.perf_counter() - render_started_at), messages_for_polling)
+
+
+def mixdown_rendered_tracks(rendered_tracks: List[RenderedTrack], out_path: str,
+                            block_frames: int) -> RenderedTrack:
+    # Sums every rendered track into out_path in a single block-wise pass: each temp track is read once
+    # (memory-mapped) and the mix is written once. Mono tracks are spread to every channel of the mix.
+    # The mix is written as full scale float32 samples, so it never clips however loud the sum gets.
+    dtype = np.dtype(np.float32)
+    scales = [1 / full_scale_sample_value(np.dtype(rendered_track.dtype)) for rendered_track in rendered_tracks]
+    channels = max(rendered_track.channels for rendered_track in rendered_tracks)
+    length_frames = max(rendered_track.shape[0] for rendered_track in rendered_tracks)
+    peak = 0
+
+    track_blocks = [rendered_track.iter_blocks(block_frames) for rendered_track in rendered_tracks]
+    with open(out_path, "wb") as out_file:
+        for block_start in range(0, length_frames, block_frames):
+            mixed = np.zeros((min(block_frames, length_frames - block_start), channels), dtype=np.float64)
+            for blocks, scale in zip(track_blocks, scales):
+                block = next(blocks, None)
+                if block is not None:
+                    mixed[:len(block)] += block * scale
+
+            mixed_block = mixed.astype(dtype)
+            peak = max(peak, get_peak_sample_value(mixed_block))
+            mixed_block.tofile(out_file)
+
+    return RenderedTrack(
+        index=-1,  # the mix is not one of the tracks
+        path=out_path,
+        shape=(length_frames, channels),
+        dtype=dtype.str,
+        frame_rate=rendered_tracks[0].frame_rate,
+        peak=peak
+    )
+
+
+def iter_mastered_pcm_blocks(mixed_track: RenderedTrack, normalization_gain: float, final_sample_rate: int,
+                             final_sample_width: int, block_frames: int, dither: bool = False):
+    # The mastering pass: normalizes, resamples and converts the float mix to integer samples (optionally
+    # with TPDF dither) block by block, so the encoder gets the final PCM without any full length copy of
+    # the track in between. The resampler state is carried from one block to the next.
+    gain = np.float32(db_to_float(normalization_gain))
+    dither_rng = np.random.default_rng() if dither else None
+    blocks = (block * gain for block in mixed_track.iter_blocks(block_frames))
+    if mixed_track.frame_rate != final_sample_rate:
+        resampler = PolyphaseResampler(mixed_track.frame_rate, final_sample_rate, mixed_track.channels,
+                                       dtype=np.float32)
+        blocks = resampler.resample_blocks(blocks)
+    for block in blocks:
+        yield int_samples_to_bytes(float_to_int_samples(block, final_sample_width, dither_rng=dither_rng),
+                                   final_sample_width)
+
+
+def master_and_export_mix(mixed_track: RenderedTrack, jsonData, block_frames: int, messages_for_polling):
+    # Normalizes the mix to the target peak level and exports it in the sample rate, bit depth and format
+    # of the request, in a single streamed pass over the mix.
+    FINAL_TRACK_BIT_DEPTH = jsonData["bitDepth"]
+    FINAL_TRACK_SAMPLE_RATE = jsonData["sampleRate"]
+    audio_format = jsonData["format"]
+    dither = jsonData.get("dither", False)
 
     log_for_polling("Normalizing final track", messages_for_polling)
-    final_track = normalize_soundtrack(final_track, messages_for_polling)
+    # the peak of the mix is known from the mixdown, no need to scan it again
+    normalization_gain = calculate_normalization_gain(mixed_track.max_dBFS, messages_for_polling)
 
-    if PROCESSING_SAMPLE_RATE != FINAL_TRACK_SAMPLE_RATE:
-        log_for_polling("Adjusting final soundtrack sample rate to: " + str(FINAL_TRACK_SAMPLE_RATE) + "...", messages_for_polling)
-        final_track = final_track.set_frame_rate(FINAL_TRACK_SAMPLE_RATE)
+    if mixed_track.frame_rate != FINAL_TRACK_SAMPLE_RATE:
+        log_for_polling("Adjusting final soundtrack sample rate to: " + str(FINAL_TRACK_SAMPLE_RATE) + "...",
+                        messages_for_polling)
     else:
         log_for_polling("Final soundtrack sample rate is set to: " + str(FINAL_TRACK_SAMPLE_RATE), messages_for_polling)
-
-    if PROCESSING_BIT_DEPTH != FINAL_TRACK_BIT_DEPTH:
-        log_for_polling("Adjusting final soundtrack bit depth to: " + str(FINAL_TRACK_BIT_DEPTH) + "...", messages_for_polling)
-        final_track = final_track.set_sample_width(translate_bit_depth_for_pydub(FINAL_TRACK_BIT_DEPTH))
-    else:
-        log_for_polling("Final soundtrack bit depth is set to: " + str(FINAL_TRACK_BIT_DEPTH), messages_for_polling)
-
-    log_for_polling(
-        "Final track check: bit depth " + str(
-            get_bit_depth_from_audio_segment(final_track)) + ", sample rate: " + str(
-            get_sample_rate(final_track)), messages_for_polling)
+    log_for_polling("Converting final soundtrack to bit depth: " + str(FINAL_TRACK_BIT_DEPTH) +
+                    (" with TPDF dither" if dither else "") + "...", messages_for_polling)
 
     log_for_polling("Exporting...", messages_for_polling)
-    # Export the final track
-    final_track.export("generated/processedConcatenatedSample." + audio_format_to_file_extension(audio_format),
-                       format=audio_format)
+    final_sample_width = translate_bit_depth_for_pydub(FINAL_TRACK_BIT_DEPTH)
+    # the blocks are mastered while the encoder consumes them
+    AudioSegment.export_blocks(
+        iter_mastered_pcm_blocks(
+            mixed_track, normalization_gain,
+            FINAL_TRACK_SAMPLE_RATE, final_sample_width,
+            block_frames, dither),
+        final_sample_width,
+        FINAL_TRACK_SAMPLE_RATE,
+        mixed_track.channels,
+        "generated/processedConcatenatedSample." + audio_format_to_file_extension(audio_format),
+        format=audio_format).close()
     log_for_polling("Exporting finished.", messages_for_polling)
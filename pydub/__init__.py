@@ -1 +1,2 @@
-from .audio_segment import AudioSegment
\ No newline at end of file
+from .audio_segment import AudioSegment
+from .audio_buffer import AudioBuffer
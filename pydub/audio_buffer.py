@@ -0,0 +1,193 @@
+"""
+A mutable companion to AudioSegment for building up audio in place.
+
+AudioSegments are immutable, so every overlay, append or gain change copies
+the whole segment. An AudioBuffer preallocates its samples once and mixes,
+writes and scales ranges of them in place; freeze() then hands the samples
+to an AudioSegment without copying them.
+"""
+import numpy as np
+
+from .audio_segment import AudioSegment
+from .utils import (
+    VECTORIZED_BLOCK_FRAMES,
+    apply_gain_envelope,
+    db_to_float,
+    get_array_type,
+    get_float_array_type,
+)
+
+
+class AudioBuffer(object):
+    """
+    frame_count frames of silence in the given format, to be filled with
+    add_at(), write_at() and mul_range(). Positions are in milliseconds like
+    everywhere in AudioSegment, and anything past the end of the buffer is
+    cut off (the buffer never grows). Integer samples are rounded down and
+    saturated the same way overlay and apply_gain do.
+    """
+
+    def __init__(self, frame_count, frame_rate, channels=1, sample_width=2, sample_format="int"):
+        if sample_format == "float":
+            if sample_width != 4:
+                raise ValueError("float samples must have a sample_width of 4")
+            dtype = get_float_array_type(sample_width * 8)
+        else:
+            dtype = get_array_type(sample_width * 8)
+
+        self.frame_rate = frame_rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.sample_format = sample_format
+        self.frame_width = channels * sample_width
+        self._samples = np.zeros((int(frame_count), channels), dtype=dtype)
+        self._frozen = False
+
+    @classmethod
+    def silent(cls, duration, frame_rate, channels=1, sample_width=2, sample_format="int"):
+        """
+        A buffer of duration milliseconds, counted the same way as
+        AudioSegment.silent()
+        """
+        frames = max(0, int(frame_rate * (duration / 1000.0)))
+        return cls(frames, frame_rate, channels, sample_width, sample_format)
+
+    @classmethod
+    def from_segment(cls, seg):
+        """
+        A buffer holding a copy of the samples of seg, in its format
+        """
+        buf = cls(seg.frame_count(), seg.frame_rate, seg.channels, seg.sample_width, seg.sample_format)
+        if not seg.is_implicit_silence:
+            buf._samples[:] = seg.get_numpy_array()
+        return buf
+
+    def __len__(self):
+        """
+        returns the length of this buffer in milliseconds
+        """
+        return round(1000 * (self.frame_count() / self.frame_rate))
+
+    def frame_count(self, ms=None):
+        """
+        returns the number of frames for the given number of milliseconds, or
+            if not specified, the number of frames in the whole buffer
+        """
+        if ms is not None:
+            return ms * (self.frame_rate / 1000.0)
+        return float(len(self._samples))
+
+    def get_numpy_array(self):
+        """
+        returns the samples as a (frames, channels) numpy array, without
+        copying them. It is writable until the buffer is frozen. Views taken
+        from it (and memoryviews of it) before that stay writable, so they
+        must not be written to once the buffer is frozen, or the frozen
+        segment changes with them.
+        """
+        return self._samples
+
+    @property
+    def is_frozen(self):
+        return self._frozen
+
+    def _parse_position(self, val):
+        if val < 0:
+            val = len(self) - abs(val)
+        return max(0, min(int(self.frame_count(ms=val)), len(self._samples)))
+
+    def _writable_range(self, start, end):
+        if self._frozen:
+            raise ValueError("AudioBuffer is frozen, it can not be changed anymore")
+        return self._parse_position(start), self._parse_position(end)
+
+    def _matching_samples(self, seg):
+        # the samples of seg converted to the format of this buffer (without
+        # a copy when it already matches)
+        seg = seg.set_channels(self.channels).set_frame_rate(self.frame_rate) \
+            .set_sample_format(self.sample_format).set_sample_width(self.sample_width)
+        return seg.get_numpy_array()
+
+    def write_at(self, position, seg):
+        """
+        Overwrites the frames from position (in milliseconds) on with the
+        audio of seg.
+        """
+        start, _ = self._writable_range(position, position)
+        if seg.is_implicit_silence:
+            frames = min(int(seg.frame_count()), len(self._samples) - start)
+            self._samples[start:start + frames] = 0
+            return self
+
+        samples = self._matching_samples(seg)[:len(self._samples) - start]
+        self._samples[start:start + len(samples)] = samples
+        return self
+
+    def add_at(self, position, seg, gain=0):
+        """
+        Mixes the audio of seg, changed by gain (in dB), into the frames from
+        position (in milliseconds) on, like overlay does.
+        """
+        start, _ = self._writable_range(position, position)
+        if seg.is_implicit_silence:
+            return self
+
+        samples = self._matching_samples(seg)[:len(self._samples) - start]
+        ratio = db_to_float(gain)
+        is_float = self._samples.dtype.kind == 'f'
+        limits = None if is_float else np.iinfo(self._samples.dtype)
+
+        for block_start in range(0, len(samples), VECTORIZED_BLOCK_FRAMES):
+            source = samples[block_start:block_start + VECTORIZED_BLOCK_FRAMES].astype(np.float64)
+            target = self._samples[start + block_start:start + block_start + len(source)]
+            if ratio != 1:
+                source *= ratio
+                if not is_float:
+                    np.floor(source, out=source)
+            source += target
+            if not is_float:
+                np.clip(source, limits.min, limits.max, out=source)
+            target[:] = source
+        return self
+
+    def mul_range(self, start, end, ramp):
+        """
+        Scales the frames between start and end (in milliseconds) in place.
+
+        ramp (float, (float, float) or numpy array):
+            a gain in dB for the whole range, a (from_gain, to_gain) pair of
+            gains in dB that the range fades between like fade() does, or the
+            linear gain ratio of every frame in the range
+        """
+        start, end = self._writable_range(start, end)
+        if end <= start:
+            return self
+
+        samples = self._samples[start:end]
+        if isinstance(ramp, np.ndarray):
+            gains = ramp[:len(samples)]
+            apply_gain_envelope(samples, np.arange(len(gains)), gains, out=samples)
+        elif isinstance(ramp, (tuple, list)):
+            from_gain, to_gain = ramp
+            apply_gain_envelope(samples, [0, len(samples)], [db_to_float(from_gain), db_to_float(to_gain)],
+                                out=samples)
+        else:
+            apply_gain_envelope(samples, [0], [db_to_float(ramp)], out=samples)
+        return self
+
+    def freeze(self):
+        """
+        Returns an AudioSegment of the samples, which shares them with this
+        buffer rather than copying them. The buffer can not be changed after
+        that, so the segment stays immutable, as long as nothing writes
+        through a view of the samples taken before (see get_numpy_array()).
+        """
+        self._frozen = True
+        self._samples.setflags(write=False)
+        return AudioSegment(data=memoryview(self._samples.reshape(-1).view(np.uint8)), metadata={
+            'sample_width': self.sample_width,
+            'sample_format': self.sample_format,
+            'frame_rate': self.frame_rate,
+            'frame_width': self.frame_width,
+            'channels': self.channels,
+        })
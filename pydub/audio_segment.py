@@ -2,15 +2,16 @@ from __future__ import division
 
 import array
 import os
+import shutil
 import subprocess
-from tempfile import NamedTemporaryFile
-import wave
+from tempfile import NamedTemporaryFile, TemporaryFile
 import sys
 import struct
 from .logging_utils import log_conversion, log_subprocess_output
 from .utils import mediainfo_json, fsdecode
 import base64
-from collections import namedtuple
+
+import numpy as np
 
 try:
     from StringIO import StringIO
@@ -30,7 +31,31 @@ from .utils import (
     ratio_to_db,
     get_encoder_name,
     get_array_type,
+    get_float_array_type,
+    apply_gain_envelope,
+    int_to_float_samples,
+    float_to_int_samples,
+    int_samples_to_bytes,
+    crossfade_gain_tables,
     audioop,
+    VECTORIZED_BLOCK_FRAMES,
+)
+from .resampler import resample, resampled_frame_count
+from .lazy import (
+    SourceNode,
+    LazySegment,
+    frames_to_bytes,
+)
+from .wavfile import (
+    WAVE_FORMAT_PCM,
+    WAVE_FORMAT_IEEE_FLOAT,
+    WavSubChunk,
+    WavData,
+    WavWriter,
+    extract_wav_headers,
+    read_wav_audio,
+    read_wav_file,
+    fix_wav_headers,
 )
 from .exceptions import (
     TooManyMissingFrames,
@@ -42,6 +67,17 @@ from .exceptions import (
     MissingAudioParameter,
 )
 
+# the wav helpers used to be defined in this module and are still
+# importable from here for compatibility
+__all__ = [
+    'AudioSegment',
+    'WavSubChunk',
+    'WavData',
+    'extract_wav_headers',
+    'read_wav_audio',
+    'fix_wav_headers',
+]
+
 if sys.version_info >= (3, 0):
     basestring = str
     xrange = range
@@ -84,69 +120,22 @@ AUDIO_FILE_EXT_ALIASES = {
     "wave": "wav",
 }
 
-WavSubChunk = namedtuple('WavSubChunk', ['id', 'position', 'size'])
-WavData = namedtuple('WavData', ['audio_format', 'channels', 'sample_rate',
-                                 'bits_per_sample', 'raw_data'])
-
-
-def extract_wav_headers(data):
-    # def search_subchunk(data, subchunk_id):
-    pos = 12  # The size of the RIFF chunk descriptor
-    subchunks = []
-    while pos + 8 <= len(data) and len(subchunks) < 10:
-        subchunk_id = data[pos:pos + 4]
-        subchunk_size = struct.unpack_from('<I', data[pos + 4:pos + 8])[0]
-        subchunks.append(WavSubChunk(subchunk_id, pos, subchunk_size))
-        if subchunk_id == b'data':
-            # 'data' is the last subchunk
-            break
-        pos += subchunk_size + 8
-
-    return subchunks
-
-
-def read_wav_audio(data, headers=None):
-    if not headers:
-        headers = extract_wav_headers(data)
-
-    fmt = [x for x in headers if x.id == b'fmt ']
-    if not fmt or fmt[0].size < 16:
-        raise CouldntDecodeError("Couldn't find fmt header in wav data")
-    fmt = fmt[0]
-    pos = fmt.position + 8
-    audio_format = struct.unpack_from('<H', data[pos:pos + 2])[0]
-    if audio_format != 1 and audio_format != 0xFFFE:
-        raise CouldntDecodeError("Unknown audio format 0x%X in wav data" %
-                                 audio_format)
-
-    channels = struct.unpack_from('<H', data[pos + 2:pos + 4])[0]
-    sample_rate = struct.unpack_from('<I', data[pos + 4:pos + 8])[0]
-    bits_per_sample = struct.unpack_from('<H', data[pos + 14:pos + 16])[0]
-
-    data_hdr = headers[-1]
-    if data_hdr.id != b'data':
-        raise CouldntDecodeError("Couldn't find data header in wav data")
-
-    pos = data_hdr.position + 8
-    return WavData(audio_format, channels, sample_rate, bits_per_sample,
-                   data[pos:pos + data_hdr.size])
-
-
-def fix_wav_headers(data):
-    headers = extract_wav_headers(data)
-    if not headers or headers[-1].id != b'data':
-        return
-
-    # TODO: Handle huge files in some other way
-    if len(data) > 2**32:
-        raise CouldntDecodeError("Unable to process >4GB files")
-
-    # Set the file size in the RIFF chunk descriptor
-    data[4:8] = struct.pack('<I', len(data) - 8)
+# ffmpeg's raw PCM formats for each (sample_format, sample_width)
+FFMPEG_RAW_FORMATS = {
+    ("int", 1): "s8",
+    ("int", 2): "s16le",
+    ("int", 3): "s24le",
+    ("int", 4): "s32le",
+    ("float", 4): "f32le",
+}
 
-    # Set the data size in the data subchunk
-    pos = headers[-1].position
-    data[pos + 4:pos + 8] = struct.pack('<I', len(data) - pos - 8)
+# ffmpeg filters converting to 1 or 2 channels the way set_channels does:
+# mono is copied to both channels as is (ffmpeg's default upmix lowers it by
+# 3dB) and stereo is averaged down to mono
+FFMPEG_CHANNEL_MAPS = {
+    1: "pan=mono|c0=0.5*FL+0.5*FR+FC",
+    2: "pan=stereo|FL=FL+FC|FR=FR+FC",
+}
 
 
 class AudioSegment(object):
@@ -177,6 +166,10 @@ class AudioSegment(object):
     }
 
     def __init__(self, data=None, *args, **kwargs):
+        # number of frames of implicit silence, see _spawn_silence()
+        self._silent_frames = None
+        # "int" or "float", float samples are always 32 bit
+        self.sample_format = kwargs.pop("sample_format", "int")
         self.sample_width = kwargs.pop("sample_width", None)
         self.frame_rate = kwargs.pop("frame_rate", None)
         self.channels = kwargs.pop("channels", None)
@@ -198,6 +191,9 @@ class AudioSegment(object):
             if len(data) % (self.sample_width * self.channels) != 0:
                 raise ValueError("data length must be a multiple of '(sample_width * channels)'")
 
+            if self.sample_format == "float" and self.sample_width != 4:
+                raise ValueError("float samples must have a sample_width of 4")
+
             self.frame_width = self.channels * self.sample_width
             self._data = data
 
@@ -208,26 +204,27 @@ class AudioSegment(object):
             for attr, val in kwargs.pop('metadata').items():
                 setattr(self, attr, val)
         else:
-            # normal construction
-            try:
-                data = data if isinstance(data, (basestring, bytes)) else data.read()
-            except(OSError):
-                d = b''
-                reader = data.read(2 ** 31 - 1)
-                while reader:
-                    d += reader
-                    reader = data.read(2 ** 31 - 1)
-                data = d
-
-            wav_data = read_wav_audio(data)
+            # normal construction, from wav data, a wav file or what
+            # read_wav_file returned for one
+            if isinstance(data, WavData):
+                wav_data = data
+            elif isinstance(data, (basestring, bytes, bytearray, memoryview)):
+                wav_data = read_wav_audio(data)
+            else:
+                wav_data = read_wav_file(data)
             if not wav_data:
                 raise CouldntDecodeError("Couldn't read wav audio from data")
 
             self.channels = wav_data.channels
             self.sample_width = wav_data.bits_per_sample // 8
             self.frame_rate = wav_data.sample_rate
-            self.frame_width = self.channels * self.sample_width
             self._data = wav_data.raw_data
+            if wav_data.audio_format == WAVE_FORMAT_IEEE_FLOAT:
+                self.sample_format = "float"
+                if self.sample_width == 8:
+                    self._data = np.frombuffer(self._data, dtype='<f8').astype('<f4').tobytes()
+                    self.sample_width = 4
+            self.frame_width = self.channels * self.sample_width
             if self.sample_width == 1:
                 # convert from unsigned integers in wav
                 self._data = audioop.bias(self._data, 1, -128)
@@ -257,12 +254,70 @@ class AudioSegment(object):
 
         super(AudioSegment, self).__init__(*args, **kwargs)
 
+    @property
+    def _data(self):
+        # implicit silence only turns into actual bytes once somebody asks
+        # for the samples
+        if self._silent_frames is not None:
+            self._buffer = b"\0" * (self._silent_frames * self.frame_width)
+            self._silent_frames = None
+        return self._buffer
+
+    @_data.setter
+    def _data(self, data):
+        self._silent_frames = None
+        self._buffer = data
+
     @property
     def raw_data(self):
         """
-        public access to the raw audio data as a bytestring
+        public access to the raw audio data as a bytestring. Segments may keep
+        their samples internally as a view of another segment's data (slices
+        do) or of a memory-mapped file, which is copied into a bytestring
+        here.
+        """
+        return bytes(self._data)
+
+    def _data_view(self):
+        """
+        A read-only memoryview of the raw data. Slices of it share the
+        samples with this segment instead of copying them, so segments made
+        from them are cheap to create but keep all of this segment's data
+        alive.
+        """
+        return memoryview(self._data).toreadonly()
+
+    def __getstate__(self):
+        # memoryviews can not be pickled
+        state = self.__dict__.copy()
+        if isinstance(state.get('_buffer'), memoryview):
+            state['_buffer'] = state['_buffer'].tobytes()
+        return state
+
+    @property
+    def is_implicit_silence(self):
+        """
+        True while this segment is silence that has not been materialized
         """
-        return self._data
+        return self._silent_frames is not None
+
+    def lazy(self):
+        """
+        Returns this segment as a pydub.lazy.LazySegment, which only records
+        slicing, gain changes, fades, overlays and appends and computes the
+        whole chain block by block once it is evaluated or exported.
+        """
+        return LazySegment(SourceNode(self))
+
+    def _spawn_template(self):
+        # an empty segment of the same format
+        return self.__class__(data=b'', metadata={
+            'sample_width': self.sample_width,
+            'sample_format': self.sample_format,
+            'frame_rate': self.frame_rate,
+            'frame_width': self.frame_width,
+            'channels': self.channels
+        })
 
     def get_array_of_samples(self, array_type_override=None):
         """
@@ -272,8 +327,17 @@ class AudioSegment(object):
             array_type_override = self.array_type
         return array.array(array_type_override, self._data)
 
+    def get_numpy_array(self):
+        """
+        returns the raw_data as a read-only numpy array of shape
+        (frames, channels), without copying it
+        """
+        return np.frombuffer(self._data, dtype=self.array_type).reshape(-1, self.channels)
+
     @property
     def array_type(self):
+        if self.sample_format == "float":
+            return get_float_array_type(self.sample_width * 8)
         return get_array_type(self.sample_width * 8)
 
     def __len__(self):
@@ -289,7 +353,8 @@ class AudioSegment(object):
             return False
 
     def __hash__(self):
-        return hash(AudioSegment) ^ hash((self.channels, self.frame_rate, self.sample_width, self._data))
+        return hash(AudioSegment) ^ hash((self.channels, self.frame_rate, self.sample_width,
+                                        self.sample_format, bytes(self._data)))
 
     def __ne__(self, other):
         return not (self == other)
@@ -317,20 +382,29 @@ class AudioSegment(object):
 
         start = self._parse_position(start) * self.frame_width
         end = self._parse_position(end) * self.frame_width
-        data = self._data[start:end]
+        if self.is_implicit_silence:
+            data = None
+            data_length = max(0, min(end, self._silent_frames * self.frame_width) - start)
+        else:
+            data = self._data_view()[start:end]
+            data_length = len(data)
 
         # ensure the output is as long as the requester is expecting
         expected_length = end - start
-        missing_frames = (expected_length - len(data)) // self.frame_width
+        missing_frames = (expected_length - data_length) // self.frame_width
+        if missing_frames > self.frame_count(ms=2):
+            raise TooManyMissingFrames(
+                "You should never be filling in "
+                "   more than 2 ms with silence here, "
+                "missing frames: %s" % missing_frames)
+
+        if data is None:
+            return self._spawn_silence(expected_length // self.frame_width)
+
         if missing_frames:
-            if missing_frames > self.frame_count(ms=2):
-                raise TooManyMissingFrames(
-                    "You should never be filling in "
-                    "   more than 2 ms with silence here, "
-                    "missing frames: %s" % missing_frames)
             silence = audioop.mul(data[:self.frame_width],
                                   self.sample_width, 0)
-            data += (silence * missing_frames)
+            data = b''.join([data, silence * missing_frames])
 
         return self._spawn(data)
 
@@ -356,7 +430,10 @@ class AudioSegment(object):
         start_i = bounded(start_sample, 0) * self.frame_width
         end_i = bounded(end_sample, max_val) * self.frame_width
 
-        data = self._data[start_i:end_i]
+        if self.is_implicit_silence:
+            return self._spawn_silence(max(0, end_i - start_i) // self.frame_width)
+
+        data = self._data_view()[start_i:end_i]
         return self._spawn(data)
 
     def __add__(self, arg):
@@ -396,8 +473,10 @@ class AudioSegment(object):
         """
         if isinstance(arg, AudioSegment):
             return self.overlay(arg, position=0, loop=True)
+        elif self.is_implicit_silence:
+            return self._spawn_silence(self._silent_frames * max(0, arg))
         else:
-            return self._spawn(data=self._data * arg)
+            return self._spawn(data=b''.join([self._data] * arg))
 
     def _spawn(self, data, overrides={}):
         """
@@ -416,6 +495,9 @@ class AudioSegment(object):
             except:
                 data = data.tostring()
 
+        if isinstance(data, np.ndarray):
+            data = data.tobytes()
+
         # accept file-like objects
         if hasattr(data, 'read'):
             if hasattr(data, 'seek'):
@@ -424,6 +506,7 @@ class AudioSegment(object):
 
         metadata = {
             'sample_width': self.sample_width,
+            'sample_format': self.sample_format,
             'frame_rate': self.frame_rate,
             'frame_width': self.frame_width,
             'channels': self.channels
@@ -431,14 +514,38 @@ class AudioSegment(object):
         metadata.update(overrides)
         return self.__class__(data=data, metadata=metadata)
 
+    def _spawn_silence(self, frame_count, overrides={}):
+        """
+        Like _spawn() but the new segment is frame_count frames of implicit
+        silence: no sample data is allocated until it is actually needed, so
+        creating, slicing and converting silence is free.
+        """
+        seg = self._spawn(b'', overrides=overrides)
+        seg._silent_frames = int(frame_count)
+        return seg
+
+    def _mul_data(self, data, factor):
+        if self.sample_format == "float":
+            return (np.frombuffer(data, dtype=self.array_type) * np.float32(factor)).tobytes()
+        return audioop.mul(data, self.sample_width, factor)
+
+    def _add_data(self, data1, data2):
+        if self.sample_format == "float":
+            return (np.frombuffer(data1, dtype=self.array_type) +
+                    np.frombuffer(data2, dtype=self.array_type)).tobytes()
+        return audioop.add(data1, data2, self.sample_width)
+
     @classmethod
     def _sync(cls, *segs):
         channels = max(seg.channels for seg in segs)
         frame_rate = max(seg.frame_rate for seg in segs)
         sample_width = max(seg.sample_width for seg in segs)
+        # mixing anything with float samples happens in float
+        sample_format = "float" if any(seg.sample_format == "float" for seg in segs) else "int"
 
         return tuple(
-            seg.set_channels(channels).set_frame_rate(frame_rate).set_sample_width(sample_width)
+            seg.set_channels(channels).set_frame_rate(frame_rate)
+               .set_sample_format(sample_format).set_sample_width(sample_width)
             for seg in segs
         )
 
@@ -464,12 +571,13 @@ class AudioSegment(object):
         Generate a silent audio segment.
         duration specified in milliseconds (default duration: 1000ms, default frame_rate: 11025).
         """
-        frames = int(frame_rate * (duration / 1000.0))
-        data = b"\0\0" * frames
-        return cls(data, metadata={"channels": 1,
-                                   "sample_width": 2,
-                                   "frame_rate": frame_rate,
-                                   "frame_width": 2})
+        frames = max(0, int(frame_rate * (duration / 1000.0)))
+        seg = cls(b'', metadata={"channels": 1,
+                                 "sample_width": 2,
+                                 "frame_rate": frame_rate,
+                                 "frame_width": 2})
+        seg._silent_frames = frames
+        return seg
 
     @classmethod
     def from_mono_audiosegments(cls, *mono_segments):
@@ -484,6 +592,7 @@ class AudioSegment(object):
 
         channels = len(segs)
         sample_width = segs[0].sample_width
+        sample_format = segs[0].sample_format
         frame_rate = segs[0].frame_rate
 
         frame_count = max(int(seg.frame_count()) for seg in segs)
@@ -499,6 +608,7 @@ class AudioSegment(object):
             data,
             channels=channels,
             sample_width=sample_width,
+            sample_format=sample_format,
             frame_rate=frame_rate,
         )
 
@@ -665,15 +775,18 @@ class AudioSegment(object):
             return False
 
         if is_format("wav"):
+            # memory_map=True maps the file instead of reading it in, see
+            # wavfile.read_wav_file for when that is safe
+            memory_map = kwargs.get('memory_map', False)
             try:
                 if start_second is None and duration is None:
-                    return cls._from_safe_wav(file)
+                    return cls._from_safe_wav(file, memory_map)
                 elif start_second is not None and duration is None:
-                    return cls._from_safe_wav(file)[start_second*1000:]
+                    return cls._from_safe_wav(file, memory_map)[start_second*1000:]
                 elif start_second is None and duration is not None:
-                    return cls._from_safe_wav(file)[:duration*1000]
+                    return cls._from_safe_wav(file, memory_map)[:duration*1000]
                 else:
-                    return cls._from_safe_wav(file)[start_second*1000:(start_second+duration)*1000]
+                    return cls._from_safe_wav(file, memory_map)[start_second*1000:(start_second+duration)*1000]
             except:
                 file.seek(0)
         elif is_format("raw") or is_format("pcm"):
@@ -776,8 +889,8 @@ class AudioSegment(object):
 
         p_out = bytearray(p_out)
         fix_wav_headers(p_out)
-        p_out = bytes(p_out)
-        obj = cls(p_out)
+        # a view keeps the samples from being copied out of the output again
+        obj = cls(memoryview(p_out).toreadonly())
 
         if close_file:
             file.close()
@@ -791,6 +904,120 @@ class AudioSegment(object):
         else:
             return obj[0:duration * 1000]
 
+    @classmethod
+    def from_file_as(cls, file, frame_rate, sample_width, channels,
+                     sample_format="int", format=None, codec=None,
+                     parameters=None, start_second=None, duration=None,
+                     **kwargs):
+        """
+        Decodes a file straight into the given frame_rate, sample_width,
+        number of channels and sample_format ("int" or "float").
+
+        Unlike from_file, no ffprobe call is needed and there is no wav
+        round-trip: a single ffmpeg call decodes, resamples (with ffmpeg's
+        own resampler) and converts the audio, writing it to stdout as raw
+        PCM in exactly the requested format. wav files that already are in
+        that format are read directly, without ffmpeg (and memory-mapped
+        when memory_map=True is given, see wavfile.read_wav_file).
+        """
+        # AudioSegment has no 24 bit samples, those can only be exported
+        if (sample_format, sample_width) not in FFMPEG_RAW_FORMATS or sample_width == 3:
+            raise ValueError("Cannot decode to {0} samples of width {1}".format(
+                sample_format, sample_width))
+        raw_format = FFMPEG_RAW_FORMATS[(sample_format, sample_width)]
+
+        try:
+            filename = fsdecode(file)
+        except TypeError:
+            filename = None
+        file, close_file = _fd_or_path_or_tempfile(file, 'rb', tempfile=False)
+
+        if format:
+            format = format.lower()
+            format = AUDIO_FILE_EXT_ALIASES.get(format, format)
+
+        is_wav = format == "wav" or (filename and filename.lower().endswith(".wav"))
+        if is_wav and start_second is None and duration is None and codec is None and parameters is None:
+            try:
+                file.seek(0)
+                obj = cls(data=read_wav_file(file, kwargs.get('memory_map', False)))
+            except (CouldntDecodeError, struct.error):
+                obj = None
+            if obj is not None and (obj.frame_rate, obj.sample_width, obj.channels, obj.sample_format) == \
+                    (frame_rate, sample_width, channels, sample_format):
+                if close_file:
+                    file.close()
+                return obj
+            file.seek(0)
+
+        conversion_command = [cls.converter,
+                              '-y',  # always overwrite existing files
+                              ]
+
+        if format:
+            conversion_command += ["-f", format]
+
+        if codec:
+            # force audio decoder
+            conversion_command += ["-acodec", codec]
+
+        if filename:
+            conversion_command += ["-i", filename]
+            stdin_parameter = None
+            stdin_data = None
+        else:
+            if cls.converter == 'ffmpeg':
+                conversion_command += ["-read_ahead_limit", str(kwargs.get('read_ahead_limit', -1)),
+                                       "-i", "cache:pipe:0"]
+            else:
+                conversion_command += ["-i", "-"]
+            stdin_parameter = subprocess.PIPE
+            stdin_data = file.read()
+
+        conversion_command += [
+            "-vn",  # Drop any video streams if there are any
+            "-f", raw_format,
+            "-ar", str(frame_rate),
+        ]
+        if channels in FFMPEG_CHANNEL_MAPS:
+            conversion_command += ["-af", FFMPEG_CHANNEL_MAPS[channels]]
+        else:
+            conversion_command += ["-ac", str(channels)]
+
+        if start_second is not None:
+            conversion_command += ["-ss", str(start_second)]
+
+        if duration is not None:
+            conversion_command += ["-t", str(duration)]
+
+        conversion_command += ["-"]
+
+        if parameters is not None:
+            # extend arguments with arbitrary set
+            conversion_command.extend(parameters)
+
+        log_conversion(conversion_command)
+
+        p = subprocess.Popen(conversion_command, stdin=stdin_parameter,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        p_out, p_err = p.communicate(input=stdin_data)
+
+        if close_file:
+            file.close()
+
+        if p.returncode != 0:
+            raise CouldntDecodeError(
+                "Decoding failed. ffmpeg returned error code: {0}\n\nOutput from ffmpeg/avlib:\n\n{1}".format(
+                    p.returncode, p_err.decode(errors='ignore')))
+
+        return cls(data=p_out, metadata={
+            'sample_width': sample_width,
+            'sample_format': sample_format,
+            'frame_rate': frame_rate,
+            'channels': channels,
+            'frame_width': channels * sample_width
+        })
+
     @classmethod
     def from_mp3(cls, file, parameters=None):
         return cls.from_file(file, 'mp3', parameters=parameters)
@@ -804,8 +1031,8 @@ class AudioSegment(object):
         return cls.from_file(file, 'ogg', parameters=parameters)
 
     @classmethod
-    def from_wav(cls, file, parameters=None):
-        return cls.from_file(file, 'wav', parameters=parameters)
+    def from_wav(cls, file, parameters=None, memory_map=False):
+        return cls.from_file(file, 'wav', parameters=parameters, memory_map=memory_map)
 
     @classmethod
     def from_raw(cls, file, **kwargs):
@@ -813,10 +1040,10 @@ class AudioSegment(object):
                              channels=kwargs['channels'])
 
     @classmethod
-    def _from_safe_wav(cls, file):
+    def _from_safe_wav(cls, file, memory_map=False):
         file, close_file = _fd_or_path_or_tempfile(file, 'rb', tempfile=False)
         file.seek(0)
-        obj = cls(data=file)
+        obj = cls(data=read_wav_file(file, memory_map))
         if close_file:
             file.close()
         return obj
@@ -856,6 +1083,26 @@ class AudioSegment(object):
         cover (file)
             Set cover for audio file from image file. (png or jpg)
         """
+        return self.export_blocks([self._data], self.sample_width, self.frame_rate, self.channels,
+                                  out_f=out_f, format=format, sample_format=self.sample_format, codec=codec,
+                                  bitrate=bitrate, parameters=parameters, tags=tags,
+                                  id3v2_version=id3v2_version, cover=cover)
+
+    @classmethod
+    def export_blocks(cls, blocks, sample_width, frame_rate, channels, out_f=None, format='mp3',
+                      sample_format="int", codec=None, bitrate=None, parameters=None, tags=None,
+                      id3v2_version='4', cover=None):
+        """
+        Export audio given as an iterable of raw PCM blocks (bytes-like
+        objects holding whole frames of the given sample_width, frame_rate,
+        channels and sample_format) without ever holding all of it. Blocks
+        are encoded as they come, so a generator that is still rendering
+        overlaps with the encoder.
+
+        The blocks are piped into ffmpeg's stdin as raw PCM. When out_f is
+        a path, ffmpeg writes the file itself, a file object gets a copy of
+        ffmpeg's output. Takes the same options as export().
+        """
         id3v2_allowed_versions = ['3', '4']
 
         if format == "raw" and (codec is not None or parameters is not None):
@@ -864,53 +1111,51 @@ class AudioSegment(object):
                     'specify an ffmpeg raw format like format="s16le" instead '
                     'or call export(format="raw") with no codec or parameters')
 
-        out_f, _ = _fd_or_path_or_tempfile(out_f, 'wb+')
-        out_f.seek(0)
-
-        if format == "raw":
-            out_f.write(self._data)
-            out_f.seek(0)
-            return out_f
-
         # wav with no ffmpeg parameters can just be written directly to out_f
         easy_wav = format == "wav" and codec is None and parameters is None
 
-        if easy_wav:
-            data = out_f
-        else:
-            data = NamedTemporaryFile(mode="wb", delete=False)
-
-        pcm_for_wav = self._data
-        if self.sample_width == 1:
-            # convert to unsigned integers for wav
-            pcm_for_wav = audioop.bias(self._data, 1, 128)
-
-        wave_data = wave.open(data, 'wb')
-        wave_data.setnchannels(self.channels)
-        wave_data.setsampwidth(self.sample_width)
-        wave_data.setframerate(self.frame_rate)
-        # For some reason packing the wave header struct with
-        # a float in python 2 doesn't throw an exception
-        wave_data.setnframes(int(self.frame_count()))
-        wave_data.writeframesraw(pcm_for_wav)
-        wave_data.close()
-
-        # for easy wav files, we're done (wav data is written directly to out_f)
-        if easy_wav:
+        if format == "raw" or easy_wav:
+            out_f, _ = _fd_or_path_or_tempfile(out_f, 'wb+')
+            out_f.seek(0)
+            if format == "raw":
+                for block in blocks:
+                    out_f.write(block)
+            else:
+                audio_format = WAVE_FORMAT_IEEE_FLOAT if sample_format == "float" else WAVE_FORMAT_PCM
+                with WavWriter(out_f, audio_format, channels, sample_width, frame_rate) as writer:
+                    for block in blocks:
+                        writer.write(block)
             out_f.seek(0)
             return out_f
 
-        output = NamedTemporaryFile(mode="w+b", delete=False)
+        try:
+            raw_format = FFMPEG_RAW_FORMATS[(sample_format, sample_width)]
+        except KeyError:
+            raise ValueError("Cannot encode {0} samples of width {1}".format(
+                sample_format, sample_width))
+
+        try:
+            out_path = fsdecode(out_f)
+        except TypeError:
+            out_path = None
+
+        if out_path is None:
+            # formats like mp4 need to seek in their output, so ffmpeg writes
+            # to a temp file, which is copied into out_f afterwards
+            out_f, _ = _fd_or_path_or_tempfile(out_f, 'wb+')
+            output = NamedTemporaryFile(mode="w+b", delete=False)
+            output.close()
 
         # build converter command to export
         conversion_command = [
-            self.converter,
+            cls.converter,
             '-y',  # always overwrite existing files
-            "-f", "wav", "-i", data.name,  # input options (filename last)
+            "-f", raw_format, "-ar", str(frame_rate), "-ac", str(channels),
+            "-i", "pipe:0",  # input options (filename last)
         ]
 
         if codec is None:
-            codec = self.DEFAULT_CODECS.get(format, None)
+            codec = cls.DEFAULT_CODECS.get(format, None)
 
         if cover is not None:
             if cover.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')) and format == "mp3":
@@ -953,17 +1198,38 @@ class AudioSegment(object):
             conversion_command.extend(["-write_xing", "0"])
 
         conversion_command.extend([
-            "-f", format, output.name,  # output options (filename last)
+            "-f", format, out_path or output.name,  # output options (filename last)
         ])
 
         log_conversion(conversion_command)
 
-        # read stdin / write stdout
-        with open(os.devnull, 'rb') as devnull:
-            p = subprocess.Popen(conversion_command, stdin=devnull, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        p_out, p_err = p.communicate()
+        # ffmpeg's output goes to a file rather than a pipe, so that nothing
+        # has to be read while the blocks are written to its stdin
+        with TemporaryFile() as stderr_file:
+            p = subprocess.Popen(conversion_command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                 stderr=stderr_file)
+            try:
+                for block in blocks:
+                    p.stdin.write(block)
+            except BrokenPipeError:
+                # ffmpeg gave up early, its output says why
+                pass
+            except BaseException:
+                # the blocks failed, so there is nothing complete to encode
+                p.kill()
+                if out_path is None:
+                    os.unlink(output.name)
+                raise
+            finally:
+                # ffmpeg only finishes once its input is closed
+                try:
+                    p.stdin.close()
+                except BrokenPipeError:
+                    pass
+                p.wait()
+            stderr_file.seek(0)
+            p_err = stderr_file.read()
 
-        log_subprocess_output(p_out)
         log_subprocess_output(p_err)
 
         try:
@@ -972,14 +1238,16 @@ class AudioSegment(object):
                     "Encoding failed. ffmpeg/avlib returned error code: {0}\n\nCommand:{1}\n\nOutput from ffmpeg/avlib:\n\n{2}".format(
                         p.returncode, conversion_command, p_err.decode(errors='ignore') ))
 
-            output.seek(0)
-            out_f.write(output.read())
+            if out_path is not None:
+                return open(out_path, 'rb+')
+
+            out_f.seek(0)
+            with open(output.name, 'rb') as output_file:
+                shutil.copyfileobj(output_file, out_f)
 
         finally:
-            data.close()
-            output.close()
-            os.unlink(data.name)
-            os.unlink(output.name)
+            if out_path is None:
+                os.unlink(output.name)
 
         out_f.seek(0)
         return out_f
@@ -996,28 +1264,74 @@ class AudioSegment(object):
         """
         if ms is not None:
             return ms * (self.frame_rate / 1000.0)
+        elif self.is_implicit_silence:
+            return float(self._silent_frames)
         else:
             return float(len(self._data) // self.frame_width)
 
     def set_sample_width(self, sample_width):
+        """
+        Changes the sample width (in bytes). Float segments are converted to
+        integer samples of that width, unless it is the float width already.
+        """
         if sample_width == self.sample_width:
             return self
 
         frame_width = self.channels * sample_width
+        overrides = {'sample_width': sample_width, 'frame_width': frame_width,
+                     'sample_format': 'int'}
+
+        if self.is_implicit_silence:
+            return self._spawn_silence(self._silent_frames, overrides=overrides)
+
+        if self.sample_format == "float":
+            return self._spawn(
+                int_samples_to_bytes(float_to_int_samples(self.get_numpy_array(), sample_width), sample_width),
+                overrides=overrides
+            )
 
         return self._spawn(
             audioop.lin2lin(self._data, self.sample_width, sample_width),
             overrides={'sample_width': sample_width, 'frame_width': frame_width}
         )
 
+    def set_sample_format(self, sample_format):
+        """
+        Converts between integer ("int") and 32 bit floating point ("float")
+        samples. Float samples use the full scale range [-1.0, 1.0] and are
+        never clipped by gain changes or overlays, only when converted back
+        to integers (as 32 bit samples, see set_sample_width for others).
+        """
+        if sample_format == self.sample_format:
+            return self
+        if sample_format not in ("int", "float"):
+            raise ValueError("Unknown sample format: %s" % sample_format)
+
+        overrides = {'sample_width': 4, 'frame_width': self.channels * 4,
+                     'sample_format': sample_format}
+
+        if self.is_implicit_silence:
+            return self._spawn_silence(self._silent_frames, overrides=overrides)
+
+        if sample_format == "float":
+            converted = int_to_float_samples(self.get_numpy_array())
+        else:
+            converted = float_to_int_samples(self.get_numpy_array(), 4)
+        return self._spawn(converted, overrides=overrides)
+
     def set_frame_rate(self, frame_rate):
         if frame_rate == self.frame_rate:
             return self
 
+        if self.is_implicit_silence:
+            return self._spawn_silence(
+                resampled_frame_count(self._silent_frames, self.frame_rate, frame_rate),
+                overrides={'frame_rate': frame_rate})
+
         if self._data:
-            converted, _ = audioop.ratecv(self._data, self.sample_width,
-                                          self.channels, self.frame_rate,
-                                          frame_rate, None)
+            # band limited (windowed sinc) resampling, which unlike
+            # audioop.ratecv does not alias when lowering the frame rate
+            converted = resample(self.get_numpy_array(), self.frame_rate, frame_rate)
         else:
             converted = self._data
 
@@ -1028,6 +1342,24 @@ class AudioSegment(object):
         if channels == self.channels:
             return self
 
+        if self.is_implicit_silence and 1 in (channels, self.channels):
+            return self._spawn_silence(
+                self._silent_frames,
+                overrides={'channels': channels,
+                           'frame_width': self.sample_width * channels}
+            )
+
+        if self.sample_format == "float" and 1 in (channels, self.channels):
+            samples = self.get_numpy_array()
+            if channels == 1:
+                converted = samples.mean(axis=1, dtype=samples.dtype)
+            else:
+                converted = np.repeat(samples, channels, axis=1)
+            return self._spawn(data=converted,
+                               overrides={
+                                   'channels': channels,
+                                   'frame_width': self.sample_width * channels})
+
         if channels == 2 and self.channels == 1:
             fn = audioop.tostereo
             frame_width = self.frame_width * 2
@@ -1084,6 +1416,11 @@ class AudioSegment(object):
 
     @property
     def rms(self):
+        if self.is_implicit_silence:
+            return 0
+        if self.sample_format == "float":
+            samples = self.get_numpy_array()
+            return float(np.sqrt(np.mean(np.square(samples, dtype=np.float64)))) if samples.size else 0.0
         return audioop.rms(self._data, self.sample_width)
 
     @property
@@ -1095,10 +1432,18 @@ class AudioSegment(object):
 
     @property
     def max(self):
+        if self.is_implicit_silence:
+            return 0
+        if self.sample_format == "float":
+            samples = self.get_numpy_array()
+            return float(np.abs(samples).max()) if samples.size else 0.0
         return audioop.max(self._data, self.sample_width)
 
     @property
     def max_possible_amplitude(self):
+        if self.sample_format == "float":
+            return 1.0
+
         bits = self.sample_width * 8
         max_possible_val = (2 ** bits)
 
@@ -1121,6 +1466,11 @@ class AudioSegment(object):
         if not 1 <= channel <= 2:
             raise ValueError("channel value must be 1 (left) or 2 (right)")
 
+        if self.sample_format == "float":
+            samples = self.get_numpy_array()
+            samples = samples[:, 0] if self.channels == 1 else samples[:, channel - 1]
+            return float(np.mean(samples, dtype=np.float64)) if samples.size else 0.0
+
         if self.channels == 1:
             data = self._data
         elif channel == 1:
@@ -1142,6 +1492,17 @@ class AudioSegment(object):
         if offset and not -1.0 <= offset <= 1.0:
             raise ValueError("offset value must be in range -1.0 to 1.0")
 
+        if self.sample_format == "float":
+            samples = self.get_numpy_array()
+            columns = range(self.channels) if self.channels == 1 or not channel else [channel - 1]
+            removed = samples.copy()
+            for column in columns:
+                off = offset
+                if not off:
+                    off = np.mean(samples[:, column], dtype=np.float64) if len(samples) else 0.0
+                removed[:, column] -= np.float32(off)
+            return self._spawn(data=removed)
+
         if offset:
             offset = int(round(offset * self.max_possible_amplitude))
 
@@ -1169,8 +1530,10 @@ class AudioSegment(object):
                                             self.sample_width))
 
     def apply_gain(self, volume_change):
-        return self._spawn(data=audioop.mul(self._data, self.sample_width,
-                                            db_to_float(float(volume_change))))
+        if self.is_implicit_silence:
+            return self
+        return self._spawn(data=self._mul_data(self._data,
+                                               db_to_float(float(volume_change))))
 
     def overlay(self, seg, position=0, loop=False, times=None, gain_during_overlay=None):
         """
@@ -1208,11 +1571,27 @@ class AudioSegment(object):
             # it's a no-op, make a copy since we never mutate
             return self._spawn(self._data)
 
+        seg1, seg2 = AudioSegment._sync(self, seg)
+
+        if seg2.is_implicit_silence and not gain_during_overlay:
+            # adding silence changes nothing
+            return seg1
+
+        if seg1.is_implicit_silence and times == 1 and not gain_during_overlay:
+            # nothing to mix with: the result is seg pasted into the silence
+            head_frames = int(seg1[:position].frame_count())
+            tail_length = int(seg1[position:].frame_count()) * seg1.frame_width
+            overlaid = seg2._data[:tail_length]
+            return seg1._spawn(data=[
+                b"\0" * (head_frames * seg1.frame_width),
+                overlaid,
+                b"\0" * (tail_length - len(overlaid)),
+            ])
+
         output = StringIO()
 
-        seg1, seg2 = AudioSegment._sync(self, seg)
-        sample_width = seg1.sample_width
         spawn = seg1._spawn
+        mul, add = seg1._mul_data, seg1._add_data
 
         output.write(seg1[:position]._data)
 
@@ -1233,12 +1612,11 @@ class AudioSegment(object):
 
             if gain_during_overlay:
                 seg1_overlaid = seg1[pos:pos + seg2_len]
-                seg1_adjusted_gain = audioop.mul(seg1_overlaid, self.sample_width,
-                                                 db_to_float(float(gain_during_overlay)))
-                output.write(audioop.add(seg1_adjusted_gain, seg2, sample_width))
+                seg1_adjusted_gain = mul(seg1_overlaid,
+                                         db_to_float(float(gain_during_overlay)))
+                output.write(add(seg1_adjusted_gain, seg2))
             else:
-                output.write(audioop.add(seg1[pos:pos + seg2_len], seg2,
-                                         sample_width))
+                output.write(add(seg1[pos:pos + seg2_len], seg2))
             pos += seg2_len
 
             # dec times to break our while loop (eventually)
@@ -1248,11 +1626,106 @@ class AudioSegment(object):
 
         return spawn(data=output)
 
-    def append(self, seg, crossfade=100):
+    @classmethod
+    def mix_many(cls, segments, length=None):
+        """
+        Mixes any number of segments into one new segment in a single pass,
+        instead of one overlay (and one copy of the whole result) per segment.
+
+        segments (list):
+            (seg, position, gain) tuples: seg is mixed in from position (in
+            milliseconds, negative positions cut off the start of seg) with
+            its volume changed by gain (in dB). gain may be left out.
+
+        length (optional int):
+            The length of the result in milliseconds, anything past it is
+            cut off. Defaults to the end of the segment that ends last.
+
+        The segments are converted to a common format the way overlay does.
+        The mix is summed in floating point, so only the final sum of integer
+        samples is rounded down and saturated (overlay does so after every
+        segment); float samples are never clipped.
+        """
+        if not len(segments):
+            raise ValueError("At least one AudioSegment instance is required")
+
+        for entry in segments:
+            if not (isinstance(entry, (tuple, list)) and 2 <= len(entry) <= 3 and
+                    isinstance(entry[0], AudioSegment)):
+                raise TypeError("mix_many takes (seg, position) or (seg, position, gain) "
+                                "tuples, not {0}".format(type(entry).__name__))
+        segments = [tuple(entry) + (0,) * (3 - len(entry)) for entry in segments]
+        synced = cls._sync(*[seg for seg, _, _ in segments])
+        template = synced[0]._spawn_template()
+
+        starts = np.array([int(template.frame_count(ms=position)) for _, position, _ in segments], dtype=np.int64)
+        ends = starts + np.array([int(seg.frame_count()) for seg in synced], dtype=np.int64)
+        if length is None:
+            frame_count = max(0, int(ends.max()))
+        else:
+            frame_count = max(0, int(template.frame_count(ms=length)))
+
+        # silence adds nothing, and neither does anything outside of the mix
+        mixed = [i for i, seg in enumerate(synced)
+                 if not seg.is_implicit_silence and ends[i] > 0 and starts[i] < frame_count]
+        sources = {i: synced[i].get_numpy_array() for i in mixed}
+        ratios = {i: db_to_float(float(segments[i][2])) for i in mixed}
+
+        dtype = np.dtype(template.array_type)
+        is_float = dtype.kind == 'f'
+        limits = None if is_float else np.iinfo(dtype)
+        out = np.empty((frame_count, template.channels), dtype=dtype)
+
+        # segments by start position, so every block only visits the ones
+        # playing in it (summed in their original order)
+        by_start = sorted(mixed, key=lambda i: starts[i])
+        next_start = 0
+        playing = []
+        for block_start in range(0, frame_count, VECTORIZED_BLOCK_FRAMES):
+            block_end = min(block_start + VECTORIZED_BLOCK_FRAMES, frame_count)
+            if next_start < len(by_start) and starts[by_start[next_start]] < block_end:
+                while next_start < len(by_start) and starts[by_start[next_start]] < block_end:
+                    playing.append(by_start[next_start])
+                    next_start += 1
+                playing.sort()
+            playing = [i for i in playing if ends[i] > block_start]
+
+            block = np.zeros((block_end - block_start, template.channels), dtype=np.float64)
+            for i in playing:
+                mix_from = max(block_start, starts[i])
+                mix_to = min(block_end, ends[i])
+                target = block[mix_from - block_start:mix_to - block_start]
+                source = sources[i][mix_from - starts[i]:mix_to - starts[i]]
+                if ratios[i] == 1:
+                    target += source
+                else:
+                    target += source * ratios[i]
+
+            if not is_float:
+                np.floor(block, out=block)
+                np.clip(block, limits.min, limits.max, out=block)
+            out[block_start:block_end] = block
+
+        out.setflags(write=False)
+        return template._spawn(frames_to_bytes(out))
+
+    def append(self, seg, crossfade=100, crossfade_curve="linear"):
+        """
+        Returns this segment followed by seg, with the last crossfade
+        milliseconds of this segment faded out over the first crossfade
+        milliseconds of seg as it fades in.
+
+        crossfade_curve (optional str):
+            The shape of the fades, one of "linear" (the amplitudes ramp
+            between 0dB and -120dB, like fade() does), "equal_power" (keeps
+            the loudness of unrelated audio constant) or "s_curve"
+        """
         seg1, seg2 = AudioSegment._sync(self, seg)
 
         if not crossfade:
-            return seg1._spawn(seg1._data + seg2._data)
+            if seg1.is_implicit_silence and seg2.is_implicit_silence:
+                return seg1._spawn_silence(seg1._silent_frames + seg2._silent_frames)
+            return seg1._spawn([seg1._data, seg2._data])
         elif crossfade > len(self):
             raise ValueError("Crossfade is longer than the original AudioSegment ({}ms > {}ms)".format(
                 crossfade, len(self)
@@ -1262,19 +1735,51 @@ class AudioSegment(object):
                 crossfade, len(seg)
             ))
 
-        xf = seg1[-crossfade:].fade(to_gain=-120, start=0, end=float('inf'))
-        xf *= seg2[:crossfade].fade(from_gain=-120, start=0, end=float('inf'))
-
-        output = BytesIO()
-
-        output.write(seg1[:-crossfade]._data)
-        output.write(xf._data)
-        output.write(seg2[crossfade:]._data)
+        if seg1.is_implicit_silence and seg2.is_implicit_silence:
+            # crossfading two silences is still silence
+            return seg1._spawn_silence(
+                seg1[:-crossfade].frame_count() +
+                seg1[-crossfade:].frame_count() +
+                seg2[crossfade:].frame_count()
+            )
 
-        output.seek(0)
-        obj = seg1._spawn(data=output)
-        output.close()
-        return obj
+        # the fades run over the whole crossfade, like fade(start=0, end=float('inf'))
+        before, tail, head, after = seg1[:-crossfade], seg1[-crossfade:], seg2[:crossfade], seg2[crossfade:]
+        xf_frames = int(tail.frame_count())
+        fade_out, fade_in = crossfade_gain_tables(xf_frames, int(tail.frame_count(ms=len(tail))), crossfade_curve)
+
+        # the result is written into place part by part, the crossfade being
+        # one multiply-add of the two fading parts
+        before, tail, head, after = [part.get_numpy_array() for part in (before, tail, head, after)]
+        head = head[:xf_frames]
+        out = np.empty((len(before) + xf_frames + len(after), seg1.channels), dtype=tail.dtype)
+        out[:len(before)] = before
+        out[len(before) + xf_frames:] = after
+
+        xf = out[len(before):len(before) + xf_frames]
+        is_float = tail.dtype.kind == 'f'
+        limits = None if is_float else np.iinfo(tail.dtype)
+        for block_start in range(0, xf_frames, VECTORIZED_BLOCK_FRAMES):
+            block_end = min(block_start + VECTORIZED_BLOCK_FRAMES, xf_frames)
+            fading_out = tail[block_start:block_end] * fade_out[block_start:block_end, np.newaxis]
+            fading_in = np.zeros_like(fading_out)
+            head_block = head[block_start:block_end]
+            fading_in[:len(head_block)] = head_block * fade_in[block_start:block_start + len(head_block), np.newaxis]
+            if is_float:
+                # both fades are float32 before they are added, as with overlay
+                xf[block_start:block_end] = fading_out.astype(tail.dtype) + fading_in.astype(tail.dtype)
+            else:
+                # each fade is rounded down and saturated like apply_gain_envelope,
+                # and so is their sum like audioop.add
+                for fading in (fading_out, fading_in):
+                    np.floor(fading, out=fading)
+                    np.clip(fading, limits.min, limits.max, out=fading)
+                fading_out += fading_in
+                np.clip(fading_out, limits.min, limits.max, out=fading_out)
+                xf[block_start:block_end] = fading_out
+
+        out.setflags(write=False)
+        return seg1._spawn(frames_to_bytes(out))
 
     def fade(self, to_gain=0, from_gain=0, start=None, end=None,
              duration=None):
@@ -1304,6 +1809,21 @@ class AudioSegment(object):
         if to_gain == 0 and from_gain == 0:
             return self
 
+        start_frame, end_frame = self._fade_frames(start, end, duration)
+
+        if self.is_implicit_silence:
+            return self
+
+        # the gain ramp is built at sample resolution and applied in a
+        # single multiply: from_gain is held before the fade, to_gain after it
+        data = apply_gain_envelope(self.get_numpy_array(),
+                                   [start_frame, end_frame],
+                                   [db_to_float(from_gain), db_to_float(to_gain)])
+
+        return self._spawn(data=data)
+
+    def _fade_frames(self, start, end, duration):
+        # the first and last frame of a fade given as to fade()
         start = min(len(self), start) if start is not None else None
         end = min(len(self), end) if end is not None else None
 
@@ -1323,56 +1843,7 @@ class AudioSegment(object):
         else:
             duration = end - start
 
-        from_power = db_to_float(from_gain)
-
-        output = []
-
-        # original data - up until the crossfade portion, as is
-        before_fade = self[:start]._data
-        if from_gain != 0:
-            before_fade = audioop.mul(before_fade,
-                                      self.sample_width,
-                                      from_power)
-        output.append(before_fade)
-
-        gain_delta = db_to_float(to_gain) - from_power
-
-        # fades longer than 100ms can use coarse fading (one gain step per ms),
-        # shorter fades will have audible clicks so they use precise fading
-        # (one gain step per sample)
-        if duration > 100:
-            scale_step = gain_delta / duration
-
-            for i in range(duration):
-                volume_change = from_power + (scale_step * i)
-                chunk = self[start + i]
-                chunk = audioop.mul(chunk._data,
-                                    self.sample_width,
-                                    volume_change)
-
-                output.append(chunk)
-        else:
-            start_frame = self.frame_count(ms=start)
-            end_frame = self.frame_count(ms=end)
-            fade_frames = end_frame - start_frame
-            scale_step = gain_delta / fade_frames
-
-            for i in range(int(fade_frames)):
-                volume_change = from_power + (scale_step * i)
-                sample = self.get_frame(int(start_frame + i))
-                sample = audioop.mul(sample, self.sample_width, volume_change)
-
-                output.append(sample)
-
-        # original data after the crossfade portion, at the new volume
-        after_fade = self[end:]._data
-        if to_gain != 0:
-            after_fade = audioop.mul(after_fade,
-                                     self.sample_width,
-                                     db_to_float(to_gain))
-        output.append(after_fade)
-
-        return self._spawn(data=output)
+        return int(self.frame_count(ms=start)), int(self.frame_count(ms=end))
 
     def fade_out(self, duration):
         return self.fade(to_gain=-120, duration=duration, end=float('inf'))
@@ -1381,6 +1852,8 @@ class AudioSegment(object):
         return self.fade(from_gain=-120, duration=duration, start=0)
 
     def reverse(self):
+        if self.is_implicit_silence:
+            return self
         return self._spawn(
             data=audioop.reverse(self._data, self.sample_width)
         )
@@ -1,6 +1,9 @@
 import sys
 import math
 import array
+
+import numpy as np
+
 from .utils import (
     db_to_float,
     ratio_to_db,
@@ -178,9 +181,7 @@ def compress_dynamic_range(seg, threshold=-20.0, ratio=4.0, attack=5.0, release=
         
         frame = seg.get_frame(i)
         if attenuation != 0.0:
-            frame = audioop.mul(frame,
-                                seg.sample_width,
-                                db_to_float(-attenuation))
+            frame = seg._mul_data(frame, db_to_float(-attenuation))
         
         output.append(frame)
     
@@ -197,7 +198,7 @@ def invert_phase(seg, channels=(1, 1)):
     Note that mono AudioSegments will become stereo.
     """
     if channels == (1, 1):
-        inverted = audioop.mul(seg._data, seg.sample_width, -1.0)  
+        inverted = seg._mul_data(seg._data, -1.0)
         return seg._spawn(data=inverted)
     
     else:
@@ -320,14 +321,23 @@ def apply_gain_stereo(seg, left_gain=0.0, right_gain=0.0):
     
     note: mono audio segments will be converted to stereo
     """
+    l_mult_factor = db_to_float(left_gain)
+    r_mult_factor = db_to_float(right_gain)
+
+    if seg.sample_format == "float":
+        samples = seg.get_numpy_array()
+        if seg.channels == 1:
+            samples = np.repeat(samples, 2, axis=1)
+        output = samples * np.array([l_mult_factor, r_mult_factor], dtype=np.float32)
+        return seg._spawn(data=output,
+                    overrides={'channels': 2,
+                               'frame_width': 2 * seg.sample_width})
+
     if seg.channels == 1:
         left = right = seg
     elif seg.channels == 2:
         left, right = seg.split_to_mono()
     
-    l_mult_factor = db_to_float(left_gain)
-    r_mult_factor = db_to_float(right_gain)
-    
     left_data = audioop.mul(left._data, left.sample_width, l_mult_factor)
     left_data = audioop.tostereo(left_data, left.sample_width, 1, 0)
     
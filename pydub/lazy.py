@@ -0,0 +1,427 @@
+"""
+Lazy evaluation of AudioSegment operations, see AudioSegment.lazy().
+
+A LazySegment holds a LazyNode instead of samples. Every node knows the
+format and length of its output and can render any range of its frames on
+its own, so a whole chain of operations is evaluated block by block in a
+single pass, with no intermediate segment ever allocated in full.
+
+Nodes reuse the eager AudioSegment operations on each block (the samples of
+a block are wrapped in a segment of the node's format, the template), so a
+lazy chain produces exactly the samples the eager one does.
+"""
+import abc
+
+import numpy as np
+
+from .exceptions import TooManyMissingFrames
+from .utils import VECTORIZED_BLOCK_FRAMES, apply_gain_envelope, crossfade_gain_tables, db_to_float
+
+
+def frames_to_bytes(frames):
+    # a (frames, channels) array as a flat byte view, which (unlike
+    # memoryview.cast) also works for zero frames
+    return memoryview(np.ascontiguousarray(frames).reshape(-1).view(np.uint8))
+
+
+class LazyNode(abc.ABC):
+    """
+    frame_count frames of audio in the format of template (an empty eager
+    AudioSegment). render(start, end) returns frames start to end as a new
+    (frames, channels) numpy array that the caller may change.
+    """
+
+    def __init__(self, template, frame_count):
+        self.template = template
+        self.frame_count = int(frame_count)
+
+    @property
+    def dtype(self):
+        return np.dtype(self.template.array_type)
+
+    @abc.abstractmethod
+    def render(self, start, end):
+        pass
+
+    def iter_blocks(self, block_frames=VECTORIZED_BLOCK_FRAMES):
+        for block_start in range(0, self.frame_count, block_frames):
+            yield self.render(block_start, min(block_start + block_frames, self.frame_count))
+
+    def evaluate(self, block_frames=VECTORIZED_BLOCK_FRAMES):
+        # renders every frame into one read-only buffer
+        out = np.empty((self.frame_count, self.template.channels), dtype=self.dtype)
+        for block_start in range(0, self.frame_count, block_frames):
+            block_end = min(block_start + block_frames, self.frame_count)
+            out[block_start:block_end] = self.render(block_start, block_end)
+        out.setflags(write=False)
+        return frames_to_bytes(out)
+
+    def _segment(self, frames):
+        # an eager segment of this node's format holding frames
+        return self.template._spawn(frames_to_bytes(frames))
+
+
+class SourceNode(LazyNode):
+    """
+    The samples of an eager segment, or silence for implicit silence (which
+    stays unallocated)
+    """
+
+    def __init__(self, seg):
+        super(SourceNode, self).__init__(seg._spawn_template(), seg.frame_count())
+        self.seg = seg
+
+    def render(self, start, end):
+        if self.seg.is_implicit_silence:
+            return np.zeros((end - start, self.template.channels), dtype=self.dtype)
+        return self.seg.get_numpy_array()[start:end].copy()
+
+
+class SliceNode(LazyNode):
+    """
+    Frames start to end of child, padded with silence past its end
+    """
+
+    def __init__(self, child, start, end):
+        super(SliceNode, self).__init__(child.template, max(0, end - start))
+        self.child = child
+        self.start = start
+
+    def render(self, start, end):
+        available = max(0, min(end + self.start, self.child.frame_count) - (start + self.start))
+        if available == end - start:
+            return self.child.render(start + self.start, end + self.start)
+
+        out = np.zeros((end - start, self.template.channels), dtype=self.dtype)
+        if available:
+            out[:available] = self.child.render(start + self.start, start + self.start + available)
+        return out
+
+
+class ConcatNode(LazyNode):
+    """
+    The children (all in the same format) one after the other
+    """
+
+    def __init__(self, children):
+        super(ConcatNode, self).__init__(children[0].template, sum(child.frame_count for child in children))
+        self.children = children
+        self.offsets = np.cumsum([0] + [child.frame_count for child in children])
+
+    def render(self, start, end):
+        out = np.empty((end - start, self.template.channels), dtype=self.dtype)
+        for child, offset in zip(self.children, self.offsets):
+            child_start = max(start, offset)
+            child_end = min(end, offset + child.frame_count)
+            if child_end > child_start:
+                out[child_start - start:child_end - start] = child.render(child_start - offset, child_end - offset)
+        return out
+
+
+class MapNode(LazyNode):
+    """
+    An operation that changes every frame on its own (like a gain change or
+    a sample format conversion), given as a function from an eager segment
+    to an eager segment and applied to each block
+    """
+
+    def __init__(self, child, fn):
+        super(MapNode, self).__init__(fn(child.template), child.frame_count)
+        self.child = child
+        self.fn = fn
+
+    def render(self, start, end):
+        mapped = self.fn(self.child._segment(self.child.render(start, end)))
+        return mapped.get_numpy_array().copy()
+
+
+class EnvelopeNode(LazyNode):
+    """
+    child multiplied by a piecewise linear gain envelope, see
+    utils.apply_gain_envelope
+    """
+
+    def __init__(self, child, breakpoint_frames, breakpoint_gains):
+        super(EnvelopeNode, self).__init__(child.template, child.frame_count)
+        self.child = child
+        self.breakpoint_frames = np.asarray(breakpoint_frames, dtype=np.float64)
+        self.breakpoint_gains = breakpoint_gains
+
+    def render(self, start, end):
+        block = self.child.render(start, end)
+        return apply_gain_envelope(block, self.breakpoint_frames - start, self.breakpoint_gains, out=block)
+
+
+class ReverseNode(LazyNode):
+    """
+    child backwards, sample by sample like audioop.reverse
+    """
+
+    def __init__(self, child):
+        super(ReverseNode, self).__init__(child.template, child.frame_count)
+        self.child = child
+
+    def render(self, start, end):
+        return self.child.render(self.frame_count - end, self.frame_count - start)[::-1, ::-1].copy()
+
+
+class OverlayNode(LazyNode):
+    """
+    top mixed into base, times times from its start on (-1 to repeat it
+    until the end of base), with base changed by gain_during_overlay (in dB)
+    wherever top plays
+    """
+
+    def __init__(self, base, top, times, gain_during_overlay=None):
+        super(OverlayNode, self).__init__(base.template, base.frame_count)
+        self.base = base
+        self.top = top
+        self.gain_ratio = None
+        if gain_during_overlay:
+            self.gain_ratio = db_to_float(float(gain_during_overlay))
+
+        if top.frame_count == 0:
+            times = 0
+        repeats = -(-base.frame_count // top.frame_count) if top.frame_count else 0
+        self.times = repeats if times < 0 else min(times, repeats)
+
+    def render(self, start, end):
+        out = self.base.render(start, end)
+        if not self.times:
+            return out
+
+        segment = self.template
+        first = start // self.top.frame_count
+        last = min(self.times, -(-end // self.top.frame_count))
+        for repeat in range(first, last):
+            offset = repeat * self.top.frame_count
+            mix_from = max(start, offset)
+            mix_to = min(end, offset + self.top.frame_count)
+            if mix_to <= mix_from:
+                continue
+
+            target = out[mix_from - start:mix_to - start]
+            base_data = frames_to_bytes(target)
+            if self.gain_ratio is not None:
+                base_data = segment._mul_data(base_data, self.gain_ratio)
+            top_data = frames_to_bytes(self.top.render(mix_from - offset, mix_to - offset))
+            mixed = segment._add_data(base_data, top_data)
+            target[:] = np.frombuffer(mixed, dtype=self.dtype).reshape(target.shape)
+        return out
+
+
+class LazySegment(object):
+    """
+    An audio segment whose samples are only computed when it is evaluated
+    or exported. Slicing, apply_gain, fade, reverse, overlay, append and
+    the sample width, format and channel conversions only record what is
+    to be done and return a new LazySegment. AudioSegments mixed into a
+    lazy segment are used as they are, so a chain costs no memory until
+    evaluate() or export() renders it block by block.
+
+    The samples are exactly the ones the same chain of AudioSegment
+    operations gives.
+    """
+
+    def __init__(self, node):
+        self._node = node
+        # implicit silence of the same format and length, which knows the
+        # millisecond arithmetic of AudioSegment without holding any samples
+        self._shape = node.template._spawn_silence(node.frame_count)
+
+    @property
+    def frame_rate(self):
+        return self._node.template.frame_rate
+
+    @property
+    def channels(self):
+        return self._node.template.channels
+
+    @property
+    def sample_width(self):
+        return self._node.template.sample_width
+
+    @property
+    def sample_format(self):
+        return self._node.template.sample_format
+
+    @property
+    def frame_width(self):
+        return self._node.template.frame_width
+
+    def frame_count(self, ms=None):
+        return self._shape.frame_count(ms=ms)
+
+    def __len__(self):
+        return len(self._shape)
+
+    def __getitem__(self, millisecond):
+        if isinstance(millisecond, slice):
+            if millisecond.step:
+                return (
+                    self[i:i + millisecond.step]
+                    for i in range(*millisecond.indices(len(self)))
+                )
+
+            start = millisecond.start if millisecond.start is not None else 0
+            end = millisecond.stop if millisecond.stop is not None \
+                else len(self)
+
+            start = min(start, len(self))
+            end = min(end, len(self))
+        else:
+            start = millisecond
+            end = millisecond + 1
+
+        # the frames that slicing the data of an AudioSegment would give
+        start_frame = self._shape._parse_position(start)
+        end_frame = self._shape._parse_position(end)
+        first_frame, last_frame, _ = slice(start_frame, end_frame).indices(self._node.frame_count)
+        available_frames = max(0, last_frame - first_frame)
+
+        # ensure the output is as long as the requester is expecting
+        missing_frames = end_frame - start_frame - available_frames
+        if missing_frames > self.frame_count(ms=2):
+            raise TooManyMissingFrames(
+                "You should never be filling in "
+                "   more than 2 ms with silence here, "
+                "missing frames: %s" % missing_frames)
+
+        # the missing frames are only filled in after some actual data
+        if available_frames:
+            end_frame = first_frame + end_frame - start_frame
+        else:
+            end_frame = first_frame
+        return LazySegment(SliceNode(self._node, first_frame, end_frame))
+
+    def get_sample_slice(self, start_sample=None, end_sample=None):
+        max_val = self._node.frame_count
+
+        def bounded(val, default):
+            if val is None:
+                return default
+            return min(max(val, 0), max_val)
+
+        return LazySegment(SliceNode(self._node, bounded(start_sample, 0), bounded(end_sample, max_val)))
+
+    def __add__(self, arg):
+        if isinstance(arg, (int, float)):
+            return self.apply_gain(arg)
+        return self.append(arg, crossfade=0)
+
+    def __sub__(self, arg):
+        return self.apply_gain(-arg)
+
+    def _map(self, fn):
+        return LazySegment(MapNode(self._node, fn))
+
+    def apply_gain(self, volume_change):
+        return self._map(lambda seg: seg.apply_gain(volume_change))
+
+    def set_sample_width(self, sample_width):
+        return self._map(lambda seg: seg.set_sample_width(sample_width))
+
+    def set_sample_format(self, sample_format):
+        return self._map(lambda seg: seg.set_sample_format(sample_format))
+
+    def set_channels(self, channels):
+        return self._map(lambda seg: seg.set_channels(channels))
+
+    def fade(self, to_gain=0, from_gain=0, start=None, end=None, duration=None):
+        if None not in [duration, end, start]:
+            raise TypeError('Only two of the three arguments, "start", '
+                            '"end", and "duration" may be specified')
+        if to_gain == 0 and from_gain == 0:
+            return self
+
+        start_frame, end_frame = self._shape._fade_frames(start, end, duration)
+        return LazySegment(EnvelopeNode(self._node, [start_frame, end_frame],
+                                        [db_to_float(from_gain), db_to_float(to_gain)]))
+
+    def fade_out(self, duration):
+        return self.fade(to_gain=-120, duration=duration, end=float('inf'))
+
+    def fade_in(self, duration):
+        return self.fade(from_gain=-120, duration=duration, start=0)
+
+    def reverse(self):
+        return LazySegment(ReverseNode(self._node))
+
+    @staticmethod
+    def _sync(*segs):
+        # like AudioSegment._sync, with AudioSegments taken as they are;
+        # resampling needs the whole signal, so it is the one conversion
+        # that evaluates the segment
+        segs = [seg if isinstance(seg, LazySegment) else seg.lazy() for seg in segs]
+        channels = max(seg.channels for seg in segs)
+        frame_rate = max(seg.frame_rate for seg in segs)
+        sample_width = max(seg.sample_width for seg in segs)
+        sample_format = "float" if any(seg.sample_format == "float" for seg in segs) else "int"
+
+        synced = []
+        for seg in segs:
+            if seg.frame_rate != frame_rate:
+                seg = seg.evaluate().set_frame_rate(frame_rate).lazy()
+            if seg.channels != channels:
+                seg = seg.set_channels(channels)
+            if seg.sample_format != sample_format:
+                seg = seg.set_sample_format(sample_format)
+            if seg.sample_width != sample_width:
+                seg = seg.set_sample_width(sample_width)
+            synced.append(seg)
+        return synced
+
+    def overlay(self, seg, position=0, loop=False, times=None, gain_during_overlay=None):
+        if loop:
+            times = -1
+        elif times is None:
+            times = 1
+        elif times == 0:
+            return self
+
+        seg1, seg2 = self._sync(self, seg)
+        # the part before position is left as it is
+        overlaid = OverlayNode(seg1[position:]._node, seg2._node, times, gain_during_overlay)
+        return LazySegment(ConcatNode([seg1[:position]._node, overlaid]))
+
+    def append(self, seg, crossfade=100, crossfade_curve="linear"):
+        seg1, seg2 = self._sync(self, seg)
+
+        if not crossfade:
+            return LazySegment(ConcatNode([seg1._node, seg2._node]))
+        elif crossfade > len(self):
+            raise ValueError("Crossfade is longer than the original AudioSegment ({}ms > {}ms)".format(
+                crossfade, len(self)
+            ))
+        elif crossfade > len(seg):
+            raise ValueError("Crossfade is longer than the appended AudioSegment ({}ms > {}ms)".format(
+                crossfade, len(seg)
+            ))
+
+        # the fades run over the whole crossfade, like AudioSegment.append
+        before, tail, head, after = seg1[:-crossfade], seg1[-crossfade:], seg2[:crossfade], seg2[crossfade:]
+        xf_frames = int(tail.frame_count())
+        fade_out, fade_in = crossfade_gain_tables(xf_frames, int(tail.frame_count(ms=len(tail))), crossfade_curve)
+        xf_positions = np.arange(xf_frames)
+        return LazySegment(ConcatNode([
+            before._node,
+            OverlayNode(EnvelopeNode(tail._node, xf_positions, fade_out),
+                        EnvelopeNode(SliceNode(head._node, 0, xf_frames), xf_positions, fade_in), 1),
+            after._node,
+        ]))
+
+    def evaluate(self):
+        """
+        Renders the chain into an AudioSegment
+        """
+        return self._node.template._spawn(self._node.evaluate())
+
+    def export(self, out_f=None, format='mp3', **kwargs):
+        """
+        Like AudioSegment.export, with the chain rendered block by block as
+        the blocks are written
+        """
+        template = self._node.template
+        blocks = (frames_to_bytes(block) for block in self._node.iter_blocks())
+        return template.export_blocks(blocks, template.sample_width, template.frame_rate, template.channels,
+                                      out_f=out_f, format=format, sample_format=template.sample_format, **kwargs)
@@ -1,16 +1,28 @@
-try:
-    from __builtin__ import max as builtin_max
-    from __builtin__ import min as builtin_min
-except ImportError:
-    from builtins import max as builtin_max
-    from builtins import min as builtin_min
+"""
+NumPy implementation of the audioop module, used when neither the standard
+library audioop (removed in Python 3.13) nor the audioop-lts backport can be
+imported.
+
+Results match the C module: samples are native byte order signed integers
+of 1, 2, 3 or 4 bytes, scaled results are rounded down and saturated, bias()
+wraps around on overflow and ratecv() returns the same frames and state.
+"""
+import builtins
 import math
-import struct
-try:
-    from fractions import gcd
-except ImportError:  # Python 3.9+
-    from math import gcd
-from ctypes import create_string_buffer
+
+import numpy as np
+
+# samples processed per vectorized step, which bounds the size of the
+# float64 temporaries
+BLOCK_SAMPLES = 1 << 18
+
+_SAMPLE_DTYPES = {
+    1: np.dtype(np.int8),
+    2: np.dtype(np.int16),
+    4: np.dtype(np.int32),
+}
+_MAXVALS = {1: 0x7f, 2: 0x7fff, 3: 0x7fffff, 4: 0x7fffffff}
+_MINVALS = {1: -0x80, 2: -0x8000, 3: -0x800000, 4: -0x80000000}
 
 
 class error(Exception):
@@ -18,8 +30,8 @@ class error(Exception):
 
 
 def _check_size(size):
-    if size != 1 and size != 2 and size != 4:
-        raise error("Size should be 1, 2 or 4")
+    if size not in (1, 2, 3, 4):
+        raise error("Size should be 1, 2, 3 or 4")
 
 
 def _check_params(length, size):
@@ -28,399 +40,236 @@ def _check_params(length, size):
         raise error("not a whole number of frames")
 
 
-def _sample_count(cp, size):
-    return len(cp) / size
-
-
-def _get_samples(cp, size, signed=True):
-    for i in range(_sample_count(cp, size)):
-        yield _get_sample(cp, size, i, signed)
-
-
-def _struct_format(size, signed):
-    if size == 1:
-        return "b" if signed else "B"
-    elif size == 2:
-        return "h" if signed else "H"
-    elif size == 4:
-        return "i" if signed else "I"
+def _get_samples(cp, size):
+    # the samples of cp as a numpy array (a read-only view, except for 24 bit
+    # samples, which are widened to int32)
+    if size == 3:
+        raw = np.frombuffer(cp, dtype=np.uint8).reshape(-1, 3)
+        widened = np.zeros((len(raw), 4), dtype=np.uint8)
+        widened[:, 1:] = raw
+        return widened.view("<i4").ravel() >> 8
+    return np.frombuffer(cp, dtype=_SAMPLE_DTYPES[size])
 
 
-def _get_sample(cp, size, i, signed=True):
-    fmt = _struct_format(size, signed)
-    start = i * size
-    end = start + size
-    return struct.unpack_from(fmt, buffer(cp)[start:end])[0]
+def _to_bytes(samples, size):
+    # samples must already be in range for the sample width
+    if size == 3:
+        return samples.astype("<i4").view(np.uint8).reshape(-1, 4)[:, :3].tobytes()
+    return samples.astype(_SAMPLE_DTYPES[size], copy=False).tobytes()
 
 
-def _put_sample(cp, size, i, val, signed=True):
-    fmt = _struct_format(size, signed)
-    struct.pack_into(fmt, cp, i * size, val)
+def _saturate(values, size):
+    # rounds float64 results down and clips them to the sample width, like
+    # the C module does for scaled samples
+    return np.floor(np.clip(values, _MINVALS[size], _MAXVALS[size]))
 
 
-def _get_maxval(size, signed=True):
-    if signed and size == 1:
-        return 0x7f
-    elif size == 1:
-        return 0xff
-    elif signed and size == 2:
-        return 0x7fff
-    elif size == 2:
-        return 0xffff
-    elif signed and size == 4:
-        return 0x7fffffff
-    elif size == 4:
-        return 0xffffffff
-
-
-def _get_minval(size, signed=True):
-    if not signed:
-        return 0
-    elif size == 1:
-        return -0x80
-    elif size == 2:
-        return -0x8000
-    elif size == 4:
-        return -0x80000000
-
-
-def _get_clipfn(size, signed=True):
-    maxval = _get_maxval(size, signed)
-    minval = _get_minval(size, signed)
-    return lambda val: builtin_max(min(val, maxval), minval)
-
-
-def _overflow(val, size, signed=True):
-    minval = _get_minval(size, signed)
-    maxval = _get_maxval(size, signed)
-    if minval <= val <= maxval:
-        return val
-
-    bits = size * 8
-    if signed:
-        offset = 2**(bits-1)
-        return ((val + offset) % (2**bits)) - offset
-    else:
-        return val % (2**bits)
+def _map_blocks(samples, size, fn, shape=None):
+    # applies fn to blocks of samples and collects the results in an int32
+    # array of the given shape (the shape of samples by default)
+    out = np.empty(samples.shape if shape is None else shape, dtype=np.int32)
+    for start in range(0, len(samples), BLOCK_SAMPLES):
+        out[start:start + BLOCK_SAMPLES] = fn(samples[start:start + BLOCK_SAMPLES])
+    return out
 
 
 def getsample(cp, size, i):
     _check_params(len(cp), size)
-    if not (0 <= i < len(cp) / size):
+    if not 0 <= i < len(cp) // size:
         raise error("Index out of range")
-    return _get_sample(cp, size, i)
+    return int(_get_samples(cp, size)[i])
 
 
 def max(cp, size):
     _check_params(len(cp), size)
-
     if len(cp) == 0:
         return 0
-
-    return builtin_max(abs(sample) for sample in _get_samples(cp, size))
+    samples = _get_samples(cp, size)
+    return builtins.max(-int(samples.min()), int(samples.max()))
 
 
 def minmax(cp, size):
     _check_params(len(cp), size)
-
-    max_sample, min_sample = 0, 0
-    for sample in _get_samples(cp, size):
-        max_sample = builtin_max(sample, max_sample)
-        min_sample = builtin_min(sample, min_sample)
-
-    return min_sample, max_sample
+    if len(cp) == 0:
+        return 0x7fffffff, -0x80000000
+    samples = _get_samples(cp, size)
+    return int(samples.min()), int(samples.max())
 
 
 def avg(cp, size):
     _check_params(len(cp), size)
-    sample_count = _sample_count(cp, size)
+    sample_count = len(cp) // size
     if sample_count == 0:
         return 0
-    return sum(_get_samples(cp, size)) / sample_count
+    total = int(_get_samples(cp, size).sum(dtype=np.int64))
+    return math.floor(float(total) / sample_count)
 
 
 def rms(cp, size):
     _check_params(len(cp), size)
-
-    sample_count = _sample_count(cp, size)
+    sample_count = len(cp) // size
     if sample_count == 0:
         return 0
 
-    sum_squares = sum(sample**2 for sample in _get_samples(cp, size))
+    samples = _get_samples(cp, size)
+    sum_squares = 0.0
+    for start in range(0, sample_count, BLOCK_SAMPLES):
+        block = samples[start:start + BLOCK_SAMPLES].astype(np.float64)
+        sum_squares += float(np.dot(block, block))
     return int(math.sqrt(sum_squares / sample_count))
 
 
-def _sum2(cp1, cp2, length):
-    size = 2
-    total = 0
-    for i in range(length):
-        total += getsample(cp1, size, i) * getsample(cp2, size, i)
-    return total
-
-
-def findfit(cp1, cp2):
-    size = 2
-
-    if len(cp1) % 2 != 0 or len(cp2) % 2 != 0:
+def _get_int16_samples(cp):
+    if len(cp) % 2 != 0:
         raise error("Strings should be even-sized")
+    return np.frombuffer(cp, dtype=np.int16).astype(np.float64)
 
-    if len(cp1) < len(cp2):
-        raise error("First sample should be longer")
-
-    len1 = _sample_count(cp1, size)
-    len2 = _sample_count(cp2, size)
-
-    sum_ri_2 = _sum2(cp2, cp2, len2)
-    sum_aij_2 = _sum2(cp1, cp1, len2)
-    sum_aij_ri = _sum2(cp1, cp2, len2)
-
-    result = (sum_ri_2 * sum_aij_2 - sum_aij_ri * sum_aij_ri) / sum_aij_2
-
-    best_result = result
-    best_i = 0
 
-    for i in range(1, len1 - len2 + 1):
-        aj_m1 = _get_sample(cp1, size, i - 1)
-        aj_lm1 = _get_sample(cp1, size, i + len2 - 1)
+def _window_sums(squares, length):
+    # sums of every run of length consecutive values
+    cumulative = np.concatenate(([0.0], np.cumsum(squares)))
+    return cumulative[length:] - cumulative[:-length]
 
-        sum_aij_2 += aj_lm1**2 - aj_m1**2
-        sum_aij_ri = _sum2(buffer(cp1)[i*size:], cp2, len2)
 
-        result = (sum_ri_2 * sum_aij_2 - sum_aij_ri * sum_aij_ri) / sum_aij_2
+def findfit(cp1, cp2):
+    samples1 = _get_int16_samples(cp1)
+    samples2 = _get_int16_samples(cp2)
+    if len(samples1) < len(samples2):
+        raise error("First sample should be longer")
 
-        if result < best_result:
-            best_result = result
-            best_i = i
+    sum_ri_2 = np.dot(samples2, samples2)
+    sum_aij_2 = _window_sums(samples1 * samples1, len(samples2)) if len(samples2) else \
+        np.zeros(len(samples1) + 1)
+    sum_aij_ri = np.correlate(samples1, samples2, mode="valid") if len(samples2) else \
+        np.zeros(len(samples1) + 1)
 
-    factor = _sum2(buffer(cp1)[best_i*size:], cp2, len2) / sum_ri_2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        results = (sum_ri_2 * sum_aij_2 - sum_aij_ri * sum_aij_ri) / sum_aij_2
+        # the C module only moves on from the first offset to a strictly
+        # better one, which a NaN never is
+        best_i = 0 if np.isnan(results[0]) else int(np.argmin(np.where(np.isnan(results), np.inf, results)))
+        factor = float(np.float64(sum_aij_ri[best_i]) / sum_ri_2)
 
     return best_i, factor
 
 
 def findfactor(cp1, cp2):
-    size = 2
-
-    if len(cp1) % 2 != 0:
-        raise error("Strings should be even-sized")
-
+    samples1 = _get_int16_samples(cp1)
     if len(cp1) != len(cp2):
         raise error("Samples should be same size")
+    samples2 = _get_int16_samples(cp2)
 
-    sample_count = _sample_count(cp1, size)
-
-    sum_ri_2 = _sum2(cp2, cp2, sample_count)
-    sum_aij_ri = _sum2(cp1, cp2, sample_count)
-
-    return sum_aij_ri / sum_ri_2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return float(np.float64(np.dot(samples1, samples2)) / np.dot(samples2, samples2))
 
 
 def findmax(cp, len2):
-    size = 2
-    sample_count = _sample_count(cp, size)
-
-    if len(cp) % 2 != 0:
-        raise error("Strings should be even-sized")
-
-    if len2 < 0 or sample_count < len2:
+    samples = _get_int16_samples(cp)
+    if len2 < 0 or len(samples) < len2:
         raise error("Input sample should be longer")
-
-    if sample_count == 0:
+    if len2 == 0:
         return 0
 
-    result = _sum2(cp, cp, len2)
-    best_result = result
-    best_i = 0
+    return int(np.argmax(_window_sums(samples * samples, len2)))
 
-    for i in range(1, sample_count - len2 + 1):
-        sample_leaving_window = getsample(cp, size, i - 1)
-        sample_entering_window = getsample(cp, size, i + len2 - 1)
 
-        result -= sample_leaving_window**2
-        result += sample_entering_window**2
+def _extreme_differences(cp, size):
+    # differences between consecutive extremes (the samples at which the
+    # signal changes direction), as counted by avgpp and maxpp
+    samples = _get_samples(cp, size).astype(np.int64)
+    if len(samples) < 3:
+        return samples[:0]
+    changes = np.concatenate(([True], samples[1:] != samples[:-1]))
+    samples = samples[changes]
 
-        if result > best_result:
-            best_result = result
-            best_i = i
-
-    return best_i
+    descending = samples[1:] < samples[:-1]
+    extremes = samples[1:-1][descending[1:] != descending[:-1]]
+    return np.abs(np.diff(extremes))
 
 
 def avgpp(cp, size):
     _check_params(len(cp), size)
-    sample_count = _sample_count(cp, size)
-
-    prevextremevalid = False
-    prevextreme = None
-    avg = 0
-    nextreme = 0
-
-    prevval = getsample(cp, size, 0)
-    val = getsample(cp, size, 1)
-
-    prevdiff = val - prevval
-
-    for i in range(1, sample_count):
-        val = getsample(cp, size, i)
-        diff = val - prevval
-
-        if diff * prevdiff < 0:
-            if prevextremevalid:
-                avg += abs(prevval - prevextreme)
-                nextreme += 1
-
-            prevextremevalid = True
-            prevextreme = prevval
-
-        prevval = val
-        if diff != 0:
-            prevdiff = diff
-
-    if nextreme == 0:
+    differences = _extreme_differences(cp, size)
+    if len(differences) == 0:
         return 0
-
-    return avg / nextreme
+    return int(float(differences.sum()) / len(differences))
 
 
 def maxpp(cp, size):
     _check_params(len(cp), size)
-    sample_count = _sample_count(cp, size)
-
-    prevextremevalid = False
-    prevextreme = None
-    max = 0
-
-    prevval = getsample(cp, size, 0)
-    val = getsample(cp, size, 1)
-
-    prevdiff = val - prevval
-
-    for i in range(1, sample_count):
-        val = getsample(cp, size, i)
-        diff = val - prevval
-
-        if diff * prevdiff < 0:
-            if prevextremevalid:
-                extremediff = abs(prevval - prevextreme)
-                if extremediff > max:
-                    max = extremediff
-            prevextremevalid = True
-            prevextreme = prevval
-
-        prevval = val
-        if diff != 0:
-            prevdiff = diff
-
-    return max
+    differences = _extreme_differences(cp, size)
+    if len(differences) == 0:
+        return 0
+    return int(differences.max())
 
 
 def cross(cp, size):
     _check_params(len(cp), size)
+    if len(cp) == 0:
+        return -1
 
-    crossings = 0
-    last_sample = 0
-    for sample in _get_samples(cp, size):
-        if sample <= 0 < last_sample or sample >= 0 > last_sample:
-            crossings += 1
-        last_sample = sample
-
-    return crossings
+    negative = _get_samples(cp, size) < 0
+    return int(np.count_nonzero(negative[1:] != negative[:-1]))
 
 
 def mul(cp, size, factor):
     _check_params(len(cp), size)
-    clip = _get_clipfn(size)
-
-    result = create_string_buffer(len(cp))
-
-    for i, sample in enumerate(_get_samples(cp, size)):
-        sample = clip(int(sample * factor))
-        _put_sample(result, size, i, sample)
+    factor = float(factor)
 
-    return result.raw
+    samples = _get_samples(cp, size)
+    return _to_bytes(_map_blocks(samples, size, lambda block: _saturate(block * factor, size)), size)
 
 
 def tomono(cp, size, fac1, fac2):
     _check_params(len(cp), size)
-    clip = _get_clipfn(size)
-
-    sample_count = _sample_count(cp, size)
-
-    result = create_string_buffer(len(cp) / 2)
-
-    for i in range(0, sample_count, 2):
-        l_sample = getsample(cp, size, i)
-        r_sample = getsample(cp, size, i + 1)
+    fac1, fac2 = float(fac1), float(fac2)
 
-        sample = (l_sample * fac1) + (r_sample * fac2)
-        sample = clip(sample)
-
-        _put_sample(result, size, i / 2, sample)
+    samples = _get_samples(cp, size)
+    if len(samples) % 2 != 0:
+        raise error("not a whole number of frames")
+    frames = samples.reshape(-1, 2)
 
-    return result.raw
+    return _to_bytes(_map_blocks(
+        frames, size, lambda block: _saturate(block[:, 0] * fac1 + block[:, 1] * fac2, size),
+        shape=len(frames)), size)
 
 
 def tostereo(cp, size, fac1, fac2):
     _check_params(len(cp), size)
+    fac1, fac2 = float(fac1), float(fac2)
 
-    sample_count = _sample_count(cp, size)
-
-    result = create_string_buffer(len(cp) * 2)
-    clip = _get_clipfn(size)
-
-    for i in range(sample_count):
-        sample = _get_sample(cp, size, i)
-
-        l_sample = clip(sample * fac1)
-        r_sample = clip(sample * fac2)
-
-        _put_sample(result, size, i * 2, l_sample)
-        _put_sample(result, size, i * 2 + 1, r_sample)
-
-    return result.raw
+    samples = _get_samples(cp, size)
+    out = np.empty((len(samples), 2), dtype=np.int32)
+    for start in range(0, len(samples), BLOCK_SAMPLES):
+        block = samples[start:start + BLOCK_SAMPLES]
+        out[start:start + len(block), 0] = left = _saturate(block * fac1, size)
+        out[start:start + len(block), 1] = left if fac2 == fac1 else _saturate(block * fac2, size)
+    return _to_bytes(out, size)
 
 
 def add(cp1, cp2, size):
     _check_params(len(cp1), size)
-
     if len(cp1) != len(cp2):
         raise error("Lengths should be the same")
 
-    clip = _get_clipfn(size)
-    sample_count = _sample_count(cp1, size)
-    result = create_string_buffer(len(cp1))
-
-    for i in range(sample_count):
-        sample1 = getsample(cp1, size, i)
-        sample2 = getsample(cp2, size, i)
-
-        sample = clip(sample1 + sample2)
-
-        _put_sample(result, size, i, sample)
-
-    return result.raw
+    samples1 = _get_samples(cp1, size)
+    samples2 = _get_samples(cp2, size)
+    sums = samples1.astype(np.int64 if size == 4 else np.int32) + samples2
+    np.clip(sums, _MINVALS[size], _MAXVALS[size], out=sums)
+    return _to_bytes(sums, size)
 
 
 def bias(cp, size, bias):
     _check_params(len(cp), size)
 
-    result = create_string_buffer(len(cp))
-
-    for i, sample in enumerate(_get_samples(cp, size)):
-        sample = _overflow(sample + bias, size)
-        _put_sample(result, size, i, sample)
-
-    return result.raw
+    # narrowing the int64 sums back to the sample width wraps them around on
+    # overflow, the same as the C module
+    return _to_bytes(_get_samples(cp, size).astype(np.int64) + bias % (1 << 32), size)
 
 
 def reverse(cp, size):
     _check_params(len(cp), size)
-    sample_count = _sample_count(cp, size)
-
-    result = create_string_buffer(len(cp))
-    for i, sample in enumerate(_get_samples(cp, size)):
-        _put_sample(result, size, sample_count - i - 1, sample)
-
-    return result.raw
+    return _to_bytes(_get_samples(cp, size)[::-1], size)
 
 
 def lin2lin(cp, size, size2):
@@ -428,24 +277,28 @@ def lin2lin(cp, size, size2):
     _check_size(size2)
 
     if size == size2:
-        return cp
-
-    new_len = (len(cp) / size) * size2
+        return bytes(cp)
 
-    result = create_string_buffer(new_len)
-
-    for i in range(_sample_count(cp, size)):
-        sample = _get_sample(cp, size, i)
-        if size < size2:
-            sample = sample << (4 * size2 / size)
-        elif size > size2:
-            sample = sample >> (4 * size / size2)
-
-        sample = _overflow(sample, size2)
+    samples = _get_samples(cp, size).astype(np.int32)
+    if size < size2:
+        samples <<= 8 * (size2 - size)
+    else:
+        # an arithmetic shift, which rounds down
+        samples >>= 8 * (size - size2)
+    return _to_bytes(samples, size2)
 
-        _put_sample(result, size2, i, sample)
 
-    return result.raw
+def _parse_ratecv_state(state, nchannels):
+    if not isinstance(state, tuple):
+        raise TypeError("state must be a tuple or None")
+    try:
+        d, samps = state
+        channels = [(int(prev), int(cur)) for prev, cur in samps]
+    except (TypeError, ValueError):
+        raise TypeError("ratecv(): illegal state argument")
+    if len(channels) != nchannels:
+        raise error("illegal state argument")
+    return int(d), np.array(channels, dtype=np.int32).reshape(nchannels, 2)
 
 
 def ratecv(cp, size, nchannels, inrate, outrate, state, weightA=1, weightB=0):
@@ -454,79 +307,59 @@ def ratecv(cp, size, nchannels, inrate, outrate, state, weightA=1, weightB=0):
         raise error("# of channels should be >= 1")
 
     bytes_per_frame = size * nchannels
-    frame_count = len(cp) / bytes_per_frame
-
-    if bytes_per_frame / nchannels != size:
-        raise OverflowError("width * nchannels too big for a C int")
-
     if weightA < 1 or weightB < 0:
         raise error("weightA should be >= 1, weightB should be >= 0")
-
     if len(cp) % bytes_per_frame != 0:
         raise error("not a whole number of frames")
-
     if inrate <= 0 or outrate <= 0:
         raise error("sampling rate not > 0")
 
-    d = gcd(inrate, outrate)
-    inrate /= d
-    outrate /= d
-
-    prev_i = [0] * nchannels
-    cur_i = [0] * nchannels
+    d = math.gcd(inrate, outrate)
+    inrate //= d
+    outrate //= d
+    d = math.gcd(weightA, weightB)
+    weightA //= d
+    weightB //= d
 
     if state is None:
         d = -outrate
+        state_samples = np.zeros((nchannels, 2), dtype=np.int32)
     else:
-        d, samps = state
-
-        if len(samps) != nchannels:
-            raise error("illegal state argument")
-
-        prev_i, cur_i = zip(*samps)
-        prev_i, cur_i = list(prev_i), list(cur_i)
-
-    q = frame_count / inrate
-    ceiling = (q + 1) * outrate
-    nbytes = ceiling * bytes_per_frame
-
-    result = create_string_buffer(nbytes)
-
-    samples = _get_samples(cp, size)
-    out_i = 0
-    while True:
-        while d < 0:
-            if frame_count == 0:
-                samps = zip(prev_i, cur_i)
-                retval = result.raw
-
-                # slice off extra bytes
-                trim_index = (out_i * bytes_per_frame) - len(retval)
-                retval = buffer(retval)[:trim_index]
-
-                return (retval, (d, tuple(samps)))
-
-            for chan in range(nchannels):
-                prev_i[chan] = cur_i[chan]
-                cur_i[chan] = samples.next()
-
-                cur_i[chan] = (
-                    (weightA * cur_i[chan] + weightB * prev_i[chan])
-                    / (weightA + weightB)
-                )
-
-            frame_count -= 1
-            d += outrate
-
-        while d >= 0:
-            for chan in range(nchannels):
-                cur_o = (
-                    (prev_i[chan] * d + cur_i[chan] * (outrate - d))
-                    / outrate
-                )
-                _put_sample(result, size, out_i, _overflow(cur_o, size))
-                out_i += 1
-            d -= inrate
+        d, state_samples = _parse_ratecv_state(state, nchannels)
+
+    # Like the C module, work on samples scaled up to 32 bits. history[k] and
+    # history[k + 1] are the previous and current frame once k input frames
+    # have been consumed.
+    frames = _get_samples(cp, size).astype(np.int32).reshape(-1, nchannels) << (32 - 8 * size)
+    frame_count = len(frames)
+    history = np.concatenate((state_samples.T, frames))
+
+    if weightB:
+        # a one pole low pass filter over the input, which is recursive and
+        # so has to run frame by frame
+        total_weight = float(weightA + weightB)
+        for k in range(2, len(history)):
+            history[k] = np.trunc((weightA * history[k].astype(np.float64) +
+                                   weightB * history[k - 1].astype(np.float64)) / total_weight)
+
+    # Output frame j is interpolated once k_j input frames have been consumed,
+    # where k_j is the smallest k >= 0 with d + k * outrate - j * inrate >= 0,
+    # and the C module stops emitting once the input is used up.
+    end = frame_count * outrate + d
+    out_frame_count = end // inrate + 1 if end >= 0 else 0
+
+    out = np.empty((out_frame_count, nchannels), dtype=np.int32)
+    for start in range(0, out_frame_count, BLOCK_SAMPLES):
+        j = np.arange(start, builtins.min(start + BLOCK_SAMPLES, out_frame_count), dtype=np.int64)
+        k = np.maximum(0, -((d - j * inrate) // outrate))
+        weights = (d + k * outrate - j * inrate).astype(np.float64)[:, np.newaxis]
+        interpolated = (history[k].astype(np.float64) * weights +
+                        history[k + 1].astype(np.float64) * (outrate - weights)) / outrate
+        out[start:start + len(j)] = np.trunc(interpolated).astype(np.int32) >> (32 - 8 * size)
+
+    d += frame_count * outrate - out_frame_count * inrate
+    samps = tuple((int(prev), int(cur)) for prev, cur in zip(history[frame_count], history[frame_count + 1]))
+    return _to_bytes(out, size), (d, samps)
 
 
 def lin2ulaw(cp, size):
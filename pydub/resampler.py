@@ -0,0 +1,210 @@
+"""
+Polyphase windowed-sinc resampling for (frames, channels) numpy arrays.
+
+The rates are reduced to up / down by their greatest common divisor, and
+every run of up output frames (one period) is computed from the same
+relative window of down + 2 * half_taps - 1 input frames. A whole block of
+periods is then a single matrix product with a precomputed
+(up, window) matrix. The matrices, and the Kaiser windowed sinc filters they
+are built from, are cached per (in_rate, out_rate, quality).
+
+Output frame j lands at input position j * in_rate / out_rate, so a signal
+of n frames resamples to as many frames as audioop.ratecv produces.
+"""
+import functools
+import math
+
+import numpy as np
+
+from .utils import VECTORIZED_BLOCK_FRAMES
+
+# zero crossings of the sinc on each side, Kaiser window beta and the cutoff
+# as a fraction of the lower of the two Nyquist frequencies
+RESAMPLER_QUALITIES = {
+    "low": (8, 6.0, 0.85),
+    "medium": (16, 9.0, 0.9),
+    "high": (32, 12.0, 0.94),
+}
+DEFAULT_RESAMPLER_QUALITY = "high"
+
+# How the filter bank is applied depends on the ratio: a matrix product per
+# period of up output frames when the period windows do not overlap much
+# (every window is copied out for it), a correlation of the whole input with
+# each phase when there are only a few phases, and gathering the taps for
+# every output frame otherwise (rates without a large common divisor, like
+# 44100 and 44101).
+MAX_PERIOD_MATRIX_SIZE = 1 << 21
+MAX_WINDOW_OVERLAP = 4
+MAX_CORRELATED_PHASES = 64
+
+# output frames computed at once by the gathering fallback
+GATHER_BLOCK_FRAMES = 4096
+
+
+def resampled_frame_count(frame_count, in_rate, out_rate):
+    # the number of output frames for frame_count input frames, the same as audioop.ratecv
+    if frame_count == 0:
+        return 0
+    divisor = math.gcd(in_rate, out_rate)
+    return (frame_count - 1) * (out_rate // divisor) // (in_rate // divisor) + 1
+
+
+class PolyphaseFilter:
+    """
+    The filter bank for one conversion: taps[r] are the 2 * half_taps
+    weights of input frames base[r] - half_taps + 1 ... base[r] + half_taps
+    for output frame r of every period. period_matrix holds the same taps
+    laid out over the whole period window, or is None when that would be
+    too large.
+    """
+
+    def __init__(self, in_rate, out_rate, quality):
+        if quality not in RESAMPLER_QUALITIES:
+            raise ValueError("Unknown resampler quality {quality!r}, expected one of {qualities}".format(
+                quality=quality, qualities=", ".join(RESAMPLER_QUALITIES)))
+        zero_crossings, beta, rolloff = RESAMPLER_QUALITIES[quality]
+
+        divisor = math.gcd(in_rate, out_rate)
+        self.up = out_rate // divisor
+        self.down = in_rate // divisor
+
+        # the cutoff relative to the input Nyquist frequency
+        cutoff = rolloff * min(1.0, self.up / self.down)
+        self.half_taps = math.ceil(zero_crossings / cutoff)
+        self.window_frames = self.down + 2 * self.half_taps - 1
+
+        positions = np.arange(self.up) * self.down
+        self.base = positions // self.up
+        fractions = (positions % self.up) / self.up
+        # distance of every tap from the output position, in input frames
+        offsets = np.arange(-self.half_taps + 1, self.half_taps + 1)[np.newaxis, :] - fractions[:, np.newaxis]
+        window = np.i0(beta * np.sqrt(np.clip(1 - (offsets / self.half_taps) ** 2, 0, None))) / np.i0(beta)
+        taps = cutoff * np.sinc(cutoff * offsets) * window
+        # unity gain at DC for every phase
+        taps /= taps.sum(axis=1, keepdims=True)
+        self.taps = taps
+
+        self.period_matrix = None
+        if self.up * self.window_frames <= MAX_PERIOD_MATRIX_SIZE and \
+                self.window_frames <= MAX_WINDOW_OVERLAP * self.down:
+            self.period_matrix = np.zeros((self.up, self.window_frames))
+            columns = self.base[:, np.newaxis] + np.arange(2 * self.half_taps)
+            self.period_matrix[np.arange(self.up)[:, np.newaxis], columns] = taps
+            self.period_matrix.setflags(write=False)
+        self.taps.setflags(write=False)
+
+    def apply(self, frames, periods, dtype):
+        # resamples the given number of periods of frames, where frames starts
+        # half_taps - 1 frames before the first period
+        if self.period_matrix is not None:
+            windows = np.lib.stride_tricks.sliding_window_view(frames, self.window_frames, axis=0)
+            # a contiguous copy of the windows makes for a much faster matrix product
+            windows = np.ascontiguousarray(windows[:(periods - 1) * self.down + 1:self.down])
+            out = windows.reshape(-1, self.window_frames) @ self.period_matrix.T.astype(dtype, copy=False)
+            return out.reshape(periods, -1, self.up).transpose(0, 2, 1).reshape(periods * self.up, frames.shape[1])
+
+        if self.up <= MAX_CORRELATED_PHASES:
+            # every down-th value of the correlation of the input with each phase
+            out = np.empty((periods, self.up, frames.shape[1]), dtype=dtype)
+            span = (periods - 1) * self.down + 2 * self.half_taps
+            for row, (first_frame, taps) in enumerate(zip(self.base, self.taps.astype(dtype))):
+                for channel in range(frames.shape[1]):
+                    correlated = np.correlate(frames[first_frame:first_frame + span, channel], taps, mode="valid")
+                    out[:, row, channel] = correlated[::self.down]
+            return out.reshape(periods * self.up, frames.shape[1])
+
+        out = np.empty((periods * self.up, frames.shape[1]), dtype=dtype)
+        tap_offsets = np.arange(2 * self.half_taps)
+        for start in range(0, len(out), GATHER_BLOCK_FRAMES):
+            indices = np.arange(start, min(start + GATHER_BLOCK_FRAMES, len(out)))
+            periods_in, rows = np.divmod(indices, self.up)
+            first_frames = periods_in * self.down + self.base[rows]
+            out[indices] = np.einsum('ntc,nt->nc', frames[first_frames[:, np.newaxis] + tap_offsets],
+                                     self.taps[rows].astype(dtype, copy=False))
+        return out
+
+
+@functools.lru_cache(maxsize=32)
+def get_polyphase_filter(in_rate, out_rate, quality=DEFAULT_RESAMPLER_QUALITY):
+    return PolyphaseFilter(in_rate, out_rate, quality)
+
+
+class PolyphaseResampler:
+    """
+    Resamples a stream of (frames, channels) blocks. process() returns the
+    output frames that can already be computed from the input so far, and
+    finish() the rest, so that the concatenated output equals resampling the
+    whole signal at once. Works in float32 for float32 input and in float64
+    otherwise.
+    """
+
+    def __init__(self, in_rate, out_rate, channels, quality=DEFAULT_RESAMPLER_QUALITY, dtype=np.float64):
+        self.filter = get_polyphase_filter(in_rate, out_rate, quality)
+        self.in_rate = in_rate
+        self.out_rate = out_rate
+        self.dtype = np.dtype(dtype)
+        self.input_frame_count = 0
+        self.output_frame_count = 0
+        # the signal is zero before its first frame
+        self._pending = np.zeros((self.filter.half_taps - 1, channels), dtype=self.dtype)
+
+    def _resample_pending(self, periods):
+        out = self.filter.apply(self._pending, periods, self.dtype)
+        self._pending = self._pending[periods * self.filter.down:]
+        self.output_frame_count += len(out)
+        return out
+
+    def process(self, block):
+        self.input_frame_count += len(block)
+        self._pending = np.concatenate((self._pending, block.astype(self.dtype, copy=False)))
+        if len(self._pending) < self.filter.window_frames:
+            return self._pending[:0].copy()
+
+        periods = (len(self._pending) - self.filter.window_frames) // self.filter.down + 1
+        return self._resample_pending(periods)
+
+    def finish(self):
+        remaining = resampled_frame_count(
+            self.input_frame_count, self.in_rate, self.out_rate) - self.output_frame_count
+        if remaining <= 0:
+            return self._pending[:0].copy()
+
+        # pad with silence for the last filter windows
+        periods = -(-remaining // self.filter.up)
+        padding = (periods - 1) * self.filter.down + self.filter.window_frames - len(self._pending)
+        self._pending = np.concatenate(
+            (self._pending, np.zeros((max(padding, 0), self._pending.shape[1]), dtype=self.dtype)))
+        out = self._resample_pending(periods)[:remaining]
+        self.output_frame_count -= periods * self.filter.up - remaining
+        return out
+
+    def resample_blocks(self, blocks):
+        # resamples an iterable of blocks, including the final frames from finish()
+        for block in blocks:
+            yield self.process(block)
+        yield self.finish()
+
+
+def resample(samples, in_rate, out_rate, quality=DEFAULT_RESAMPLER_QUALITY, block_frames=VECTORIZED_BLOCK_FRAMES):
+    """
+    Resamples a (frames, channels) numpy array and returns a new array of
+    the same dtype. Integer results are rounded to the nearest integer and
+    saturated.
+    """
+    out = np.empty((resampled_frame_count(len(samples), in_rate, out_rate), samples.shape[1]),
+                   dtype=samples.dtype)
+    is_float = samples.dtype.kind == 'f'
+    limits = None if is_float else np.iinfo(samples.dtype)
+    resampler = PolyphaseResampler(in_rate, out_rate, samples.shape[1], quality,
+                                   dtype=np.float32 if samples.dtype == np.float32 else np.float64)
+
+    position = 0
+    blocks = (samples[block_start:block_start + block_frames] for block_start in range(0, len(samples), block_frames))
+    for block in resampler.resample_blocks(blocks):
+        if not is_float:
+            np.rint(block, out=block)
+            np.clip(block, limits.min, limits.max, out=block)
+        out[position:position + len(block)] = block
+        position += len(block)
+
+    return out
@@ -9,12 +9,17 @@ from subprocess import Popen, PIPE
 from math import log, ceil
 from tempfile import TemporaryFile
 from warnings import warn
-from functools import wraps
+from functools import lru_cache, wraps
+
+import numpy as np
 
 try:
+    # the C module (audioop-lts on Python 3.13+) is still the faster backend
+    # for the per sample operations pydub leans on, like mul, add and ratecv
+    # (see "python benchmarks.py audioop")
     import audioop
 except ImportError:
-    import pyaudioop as audioop
+    from . import pyaudioop as audioop
 
 if sys.version_info >= (3, 0):
     basestring = str
@@ -29,6 +34,10 @@ ARRAY_TYPES = {
     16: "h",
     32: "i",
 }
+# floating point samples only come in one width, in the full scale range [-1.0, 1.0]
+FLOAT_ARRAY_TYPES = {
+    32: "f",
+}
 ARRAY_RANGES = {
     8: (-0x80, 0x7f),
     16: (-0x8000, 0x7fff),
@@ -47,10 +56,145 @@ def get_array_type(bit_depth, signed=True):
     return t
 
 
+def get_float_array_type(bit_depth):
+    return FLOAT_ARRAY_TYPES[bit_depth]
+
+
 def get_min_max_value(bit_depth):
     return ARRAY_RANGES[bit_depth]
 
 
+# number of frames processed at once by the vectorized helpers, this keeps
+# the float intermediates small even for hours long segments
+VECTORIZED_BLOCK_FRAMES = 2 ** 18
+
+
+def apply_gain_envelope(samples, breakpoint_frames, breakpoint_gains,
+                        out=None, block_frames=VECTORIZED_BLOCK_FRAMES):
+    """
+    Multiplies a (frames, channels) numpy array of samples by a gain
+    envelope and returns the result as a new array of the same dtype, or
+    writes it into out (which may be samples itself, to work in place).
+
+    The envelope is given as breakpoints (frame positions in increasing
+    order and the linear gain ratio at each of them). Gains are linearly
+    interpolated between breakpoints and held constant before the first
+    and after the last one. Integer results are rounded down and saturated
+    the same way audioop.mul does, floating point results are left as they
+    are.
+    """
+    if out is None:
+        out = np.empty_like(samples)
+    is_float = samples.dtype.kind == 'f'
+    limits = None if is_float else np.iinfo(samples.dtype)
+
+    for block_start in range(0, len(samples), block_frames):
+        block_end = min(block_start + block_frames, len(samples))
+        gains = np.interp(np.arange(block_start, block_end), breakpoint_frames, breakpoint_gains)
+
+        block = samples[block_start:block_end] * gains[:, np.newaxis]
+        if not is_float:
+            np.floor(block, out=block)
+            np.clip(block, limits.min, limits.max, out=block)
+        out[block_start:block_end] = block
+
+    return out
+
+
+def int_to_float_samples(samples, out=None):
+    """
+    Converts a numpy array of integer samples to float32 samples in the
+    full scale range, where the most negative integer maps to -1.0.
+    """
+    scale = np.float32(1.0 / (np.iinfo(samples.dtype).max + 1))
+    return np.multiply(samples, scale, out=out, dtype=np.float32)
+
+
+def float_to_int_samples(samples, sample_width, out=None,
+                         block_frames=VECTORIZED_BLOCK_FRAMES, dither_rng=None):
+    """
+    Converts a numpy array of full scale float samples to integers of the
+    given sample width (in bytes). Samples are rounded to the nearest
+    integer and anything outside of the full scale range is saturated.
+    24 bit samples are returned in an int32 array.
+
+    When dither_rng (a numpy random Generator) is given, triangular (TPDF)
+    dither of up to one least significant bit is added before rounding, so
+    the rounding error does not follow the signal.
+    """
+    if sample_width == 3:
+        dtype = np.dtype(np.int32)
+        min_value, max_value = -0x800000, 0x7fffff
+    else:
+        dtype = np.dtype(get_array_type(sample_width * 8))
+        min_value, max_value = np.iinfo(dtype).min, np.iinfo(dtype).max
+    if out is None:
+        out = np.empty(samples.shape, dtype=dtype)
+    scale = float(max_value + 1)
+
+    for block_start in range(0, len(samples), block_frames):
+        # float64, since float32 cannot hold the 32 bit limits exactly
+        block = samples[block_start:block_start + block_frames].astype(np.float64) * scale
+        if dither_rng is not None:
+            block += dither_rng.random(block.shape)
+            block -= dither_rng.random(block.shape)
+        np.rint(block, out=block)
+        np.clip(block, min_value, max_value, out=block)
+        out[block_start:block_start + block_frames] = block
+
+    return out
+
+
+def int_samples_to_bytes(samples, sample_width):
+    """
+    Packs integer samples (as returned by float_to_int_samples) into raw
+    little endian bytes of the given sample width. 24 bit samples keep the
+    low three bytes of every int32.
+    """
+    if sample_width == 3:
+        samples = samples.astype("<i4", copy=False).view(np.uint8).reshape(-1, 4)[:, :3]
+    return samples.tobytes()
+
+
+# the gain curves append can crossfade with
+CROSSFADE_CURVES = ("linear", "equal_power", "s_curve")
+
+
+@lru_cache(maxsize=64)
+def crossfade_gain_tables(frame_count, ramp_frames, curve="linear"):
+    """
+    Returns the gain ratios of the outgoing and of the incoming audio for
+    each of frame_count crossfade frames, as two read-only numpy arrays. The
+    fade runs from frame 0 to frame ramp_frames.
+
+    "linear" ramps the amplitude between 0dB and -120dB the same way fade()
+    does, "equal_power" uses quarter cosine and sine waves, whose powers add
+    up to 1 (the loudness of uncorrelated audio stays the same), and
+    "s_curve" uses smoothstep, which eases in and out of the fade.
+    """
+    if curve not in CROSSFADE_CURVES:
+        raise ValueError("Unknown crossfade curve {curve!r}, expected one of {curves}".format(
+            curve=curve, curves=", ".join(CROSSFADE_CURVES)))
+
+    frames = np.arange(frame_count)
+    if curve == "linear":
+        silence_ratio = db_to_float(-120)
+        fade_out = np.interp(frames, [0, ramp_frames], [1.0, silence_ratio])
+        fade_in = np.interp(frames, [0, ramp_frames], [silence_ratio, 1.0])
+    else:
+        position = np.interp(frames, [0, ramp_frames], [0.0, 1.0])
+        if curve == "equal_power":
+            fade_out = np.cos(position * (np.pi / 2))
+            fade_in = np.sin(position * (np.pi / 2))
+        else:
+            fade_in = position * position * (3 - 2 * position)
+            fade_out = 1 - fade_in
+
+    fade_out.setflags(write=False)
+    fade_in.setflags(write=False)
+    return fade_out, fade_in
+
+
 def _fd_or_path_or_tempfile(fd, mode='w+b', tempfile=True):
     close_fd = False
     if fd is None and tempfile:
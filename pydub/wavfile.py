@@ -0,0 +1,282 @@
+"""
+Reading and writing wav files of any size.
+
+Besides plain RIFF files (limited to 4GB by their 32 bit sizes) this reads
+RF64, the EBU extension that keeps 64 bit sizes in a ds64 chunk, and Sony
+Wave64, which uses GUID chunk ids and 64 bit sizes throughout. Files can be
+read through mmap, so the samples are never copied into memory, and are
+written block by block with the sizes patched in after the last block. A
+writer that ends up past 4GB turns its file into RF64.
+"""
+import mmap
+import struct
+from collections import namedtuple
+
+from .exceptions import CouldntDecodeError
+from .utils import audioop
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# header_size is the size of the chunk id and size fields before the chunk data
+WavSubChunk = namedtuple('WavSubChunk', ['id', 'position', 'size', 'header_size'], defaults=(8,))
+WavData = namedtuple('WavData', ['audio_format', 'channels', 'sample_rate',
+                                 'bits_per_sample', 'raw_data'])
+
+# a 32 bit size of 0xFFFFFFFF stands for a size that is kept in the ds64
+# chunk (RF64) or was unknown when the header was written (streamed wav)
+UNKNOWN_SIZE = 0xFFFFFFFF
+
+# size of a ds64 chunk without a table: the 64 bit RIFF size, data size and
+# sample count and the table length
+DS64_CHUNK_SIZE = 28
+
+# Wave64 chunk ids are GUIDs made of the RIFF chunk id and this suffix, except
+# for the riff GUID at the start of the file
+W64_RIFF_GUID = bytes.fromhex('726966662e91cf11a5d628db04c10000')
+W64_GUID_SUFFIX = bytes.fromhex('f3acd3118cd100c04f8edb8a')
+W64_CHUNK_HEADER_SIZE = 24
+
+
+def extract_wav_headers(data):
+    if bytes(data[:16]) == W64_RIFF_GUID:
+        return _extract_w64_headers(data)
+
+    pos = 12  # The size of the RIFF chunk descriptor
+    subchunks = []
+    ds64_data_size = None
+    while pos + 8 <= len(data) and len(subchunks) < 10:
+        subchunk_id = bytes(data[pos:pos + 4])
+        subchunk_size = struct.unpack_from('<I', data, pos + 4)[0]
+        if subchunk_id == b'ds64' and subchunk_size >= DS64_CHUNK_SIZE:
+            ds64_data_size = struct.unpack_from('<Q', data, pos + 16)[0]
+        elif subchunk_id == b'data' and subchunk_size == UNKNOWN_SIZE:
+            # RF64 keeps the size in the ds64 chunk, a streamed wav goes on
+            # until the end of the file
+            subchunk_size = ds64_data_size if ds64_data_size is not None else len(data) - pos - 8
+
+        subchunks.append(WavSubChunk(subchunk_id, pos, subchunk_size))
+        if subchunk_id == b'data':
+            # 'data' is the last subchunk
+            break
+        # chunks are word aligned
+        pos += subchunk_size + 8 + subchunk_size % 2
+
+    return subchunks
+
+
+def _extract_w64_headers(data):
+    pos = 40  # The riff GUID, the 64 bit file size and the wave GUID
+    subchunks = []
+    while pos + W64_CHUNK_HEADER_SIZE <= len(data) and len(subchunks) < 10:
+        guid = bytes(data[pos:pos + 16])
+        subchunk_id = guid[:4] if guid[4:] == W64_GUID_SUFFIX else guid
+        # Wave64 sizes include the chunk header
+        subchunk_size = struct.unpack_from('<Q', data, pos + 16)[0] - W64_CHUNK_HEADER_SIZE
+
+        subchunks.append(WavSubChunk(subchunk_id, pos, subchunk_size, W64_CHUNK_HEADER_SIZE))
+        if subchunk_id == b'data':
+            break
+        # chunks are aligned to 8 bytes
+        pos += -(-(subchunk_size + W64_CHUNK_HEADER_SIZE) // 8) * 8
+
+    return subchunks
+
+
+def read_wav_audio(data, headers=None):
+    if not headers:
+        headers = extract_wav_headers(data)
+
+    fmt = [x for x in headers if x.id == b'fmt ']
+    if not fmt or fmt[0].size < 16:
+        raise CouldntDecodeError("Couldn't find fmt header in wav data")
+    fmt = fmt[0]
+    pos = fmt.position + fmt.header_size
+    audio_format = struct.unpack_from('<H', data, pos)[0]
+    if audio_format == WAVE_FORMAT_EXTENSIBLE and fmt.size >= 26:
+        # the actual format is in the first two bytes of the SubFormat GUID
+        audio_format = struct.unpack_from('<H', data, pos + 24)[0]
+    if audio_format not in (WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT,
+                            WAVE_FORMAT_EXTENSIBLE):
+        raise CouldntDecodeError("Unknown audio format 0x%X in wav data" %
+                                 audio_format)
+
+    channels = struct.unpack_from('<H', data, pos + 2)[0]
+    sample_rate = struct.unpack_from('<I', data, pos + 4)[0]
+    bits_per_sample = struct.unpack_from('<H', data, pos + 14)[0]
+
+    data_hdr = headers[-1]
+    if data_hdr.id != b'data':
+        raise CouldntDecodeError("Couldn't find data header in wav data")
+
+    pos = data_hdr.position + data_hdr.header_size
+    return WavData(audio_format, channels, sample_rate, bits_per_sample,
+                   data[pos:pos + data_hdr.size])
+
+
+def read_wav_file(file, memory_map=False):
+    """
+    Reads a wav file, given as a path or as a file object, into memory.
+
+    With memory_map=True, files on disk are memory-mapped instead, so their
+    samples are never copied: raw_data of the returned WavData is then a
+    read-only memoryview of the data chunk inside the map. The map stays
+    open for as long as that view (or anything sliced from it) is
+    referenced. Writing to the file in the meantime (exporting back to it,
+    for one) fails, and truncating it crashes the interpreter on the next
+    read, so only map files nobody else changes, like temporary or cache
+    files. File objects that cannot be mapped (pipes, BytesIO) or are not at
+    their start are read in either way.
+    """
+    if not hasattr(file, 'read'):
+        with open(file, 'rb') as wav_file:
+            return read_wav_file(wav_file, memory_map)
+
+    mapped = None
+    if memory_map:
+        try:
+            mapped = _map_file(file) if file.tell() == 0 else None
+        except OSError:
+            # io.UnsupportedOperation and the errors of unseekable files
+            mapped = None
+    if mapped is None:
+        # a view keeps the samples from being copied out of the file data
+        # again
+        return read_wav_audio(memoryview(_read_all(file)))
+
+    if mapped[:4] not in (b'RIFF', b'RF64') and mapped[:16] != W64_RIFF_GUID:
+        raise CouldntDecodeError("Couldn't find a wav header")
+    return read_wav_audio(memoryview(mapped))
+
+
+def _map_file(file):
+    fileno = file.fileno()
+    try:
+        return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        # mmap refuses empty files
+        raise CouldntDecodeError("Couldn't read wav audio from an empty file")
+
+
+def _read_all(file):
+    try:
+        return file.read()
+    except OSError:
+        # some platforms refuse to read 2GB or more at once
+        return b''.join(iter(lambda: file.read(2 ** 31 - 1), b''))
+
+
+def fix_wav_headers(data):
+    # Sets the sizes in the header of a wav that was streamed (by ffmpeg to a
+    # pipe) to the actual sizes, now that the whole file is in data
+    headers = extract_wav_headers(data)
+    if not headers or headers[-1].id != b'data' or bytes(data[:4]) != b'RIFF':
+        return
+
+    pos = headers[-1].position
+    if len(data) - 8 >= UNKNOWN_SIZE:
+        # too large for the 32 bit sizes, mark the data as running until
+        # the end of the file
+        data[4:8] = struct.pack('<I', UNKNOWN_SIZE)
+        data[pos + 4:pos + 8] = struct.pack('<I', UNKNOWN_SIZE)
+        return
+
+    # Set the file size in the RIFF chunk descriptor
+    data[4:8] = struct.pack('<I', len(data) - 8)
+
+    # Set the data size in the data subchunk
+    data[pos + 4:pos + 8] = struct.pack('<I', len(data) - pos - 8)
+
+
+def _fmt_chunks(audio_format, channels, sample_width, frame_rate, frame_count):
+    # the fmt chunk, plus the fact chunk that formats other than PCM need
+    frame_width = channels * sample_width
+    fmt = struct.pack('<HHIIHH', audio_format, channels, frame_rate,
+                      frame_rate * frame_width, frame_width, sample_width * 8)
+    chunks = b''
+    if audio_format != WAVE_FORMAT_PCM:
+        fmt += struct.pack('<H', 0)
+        chunks += b'fact' + struct.pack('<II', 4, min(frame_count, UNKNOWN_SIZE))
+    return b'fmt ' + struct.pack('<I', len(fmt)) + fmt + chunks
+
+
+def build_wav_header(audio_format, channels, sample_width, frame_rate,
+                     data_size):
+    """
+    Builds the header of a wav file with data_size bytes of samples. The
+    wave module only writes integer PCM, this also covers IEEE float data
+    (which requires an extended fmt chunk and a fact chunk).
+    """
+    chunks = _fmt_chunks(audio_format, channels, sample_width, frame_rate,
+                         data_size // (channels * sample_width))
+
+    return (b'RIFF' + struct.pack('<I', 4 + len(chunks) + 8 + data_size) +
+            b'WAVE' + chunks + b'data' + struct.pack('<I', data_size))
+
+
+class WavWriter(object):
+    """
+    Writes a wav file block by block to a binary file object. The header
+    reserves room for a ds64 chunk (as a JUNK chunk, which readers skip),
+    and close() patches the final sizes in, turning the file into RF64 when
+    they do not fit in 32 bits. On a file object that cannot seek, the sizes
+    are left marked as unknown. 8 bit samples are given signed, like
+    AudioSegment keeps them, and stored unsigned, as wav requires.
+    """
+
+    def __init__(self, out_f, audio_format, channels, sample_width, frame_rate):
+        self.out_f = out_f
+        self.audio_format = audio_format
+        self.channels = channels
+        self.sample_width = sample_width
+        self.frame_rate = frame_rate
+        self.data_size = 0
+
+        self._start = out_f.tell() if out_f.seekable() else None
+        out_f.write(self._header(None))
+
+    def _header(self, data_size):
+        # data_size None writes the sizes as unknown
+        frame_count = 0 if data_size is None else data_size // (self.channels * self.sample_width)
+        chunks = _fmt_chunks(self.audio_format, self.channels, self.sample_width,
+                             self.frame_rate, frame_count)
+
+        if data_size is None:
+            riff_size = None
+        else:
+            riff_size = 4 + 8 + DS64_CHUNK_SIZE + len(chunks) + 8 + data_size + data_size % 2
+
+        if riff_size is not None and riff_size >= UNKNOWN_SIZE:
+            return (b'RF64' + struct.pack('<I', UNKNOWN_SIZE) + b'WAVE' +
+                    b'ds64' + struct.pack('<IQQQI', DS64_CHUNK_SIZE, riff_size, data_size, frame_count, 0) +
+                    chunks + b'data' + struct.pack('<I', UNKNOWN_SIZE))
+
+        return (b'RIFF' + struct.pack('<I', UNKNOWN_SIZE if riff_size is None else riff_size) + b'WAVE' +
+                b'JUNK' + struct.pack('<I', DS64_CHUNK_SIZE) + bytes(DS64_CHUNK_SIZE) +
+                chunks + b'data' + struct.pack('<I', UNKNOWN_SIZE if data_size is None else data_size))
+
+    def write(self, block):
+        if self.sample_width == 1:
+            # convert to unsigned integers for wav
+            block = audioop.bias(block, 1, 128)
+        self.out_f.write(block)
+        self.data_size += memoryview(block).nbytes
+
+    def close(self):
+        if self.data_size % 2:
+            # chunks are word aligned
+            self.out_f.write(b'\x00')
+        if self._start is None:
+            return
+
+        end = self.out_f.tell()
+        self.out_f.seek(self._start)
+        self.out_f.write(self._header(self.data_size))
+        self.out_f.seek(end)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
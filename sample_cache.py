@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import tempfile
+from typing import Tuple
+
+import numpy as np
+
+DEFAULT_SAMPLE_CACHE_DIRECTORY = "generated/sample-cache"
+DEFAULT_SAMPLE_CACHE_SIZE_MB = 4096
+
+SAMPLE_CACHE_FILE_EXTENSION = ".npy"
+SOURCE_FORMAT_FILE_EXTENSION = ".format.json"
+
+
+class DecodedSampleCache:
+    """
+    On-disk cache of decoded sample variations, already converted to the format they are processed in.
+    Entries are keyed by the content hash of the source file and the target sample rate, sample width and
+    channel count, and stored as .npy files which are memory-mapped back when read, so a cache hit costs
+    neither a decode nor a copy. evict() brings the cache back under max_size_bytes by dropping the least
+    recently used entries. Next to the entries, the cache keeps the sample rate and channel count of every
+    source file it has seen, so a source only has to be probed the first time it shows up.
+
+    Several pool workers can share one cache: entries are written to a temp file first and renamed into
+    place, and an entry evicted while another process still has it mapped stays readable for that process.
+    """
+
+    def __init__(self, directory: str = DEFAULT_SAMPLE_CACHE_DIRECTORY,
+                 max_size_bytes: int = DEFAULT_SAMPLE_CACHE_SIZE_MB * 1024 * 1024):
+        self.directory = directory
+        self.max_size_bytes = max_size_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._content_hashes = {}
+
+    def content_hash(self, filename: str) -> str:
+        # sha256 of the file content, hashed once per cache instance unless the file changes in between
+        stat = os.stat(filename)
+        memo_key = (filename, stat.st_mtime_ns, stat.st_size)
+        content_hash = self._content_hashes.get(memo_key)
+        if content_hash is None:
+            with open(filename, "rb") as source_file:
+                content_hash = hashlib.file_digest(source_file, "sha256").hexdigest()
+            self._content_hashes[memo_key] = content_hash
+        return content_hash
+
+    def key(self, filename: str, sample_rate: int, sample_width: int, channels: int | None = None) -> str:
+        # channels=None stands for the channel layout of the source file
+        return "{content_hash}-{sample_rate}hz-{sample_width}b-{channels}".format(
+            content_hash=self.content_hash(filename), sample_rate=sample_rate, sample_width=sample_width,
+            channels="source-channels" if channels is None else "{channels}ch".format(channels=channels))
+
+    def get_source_format(self, filename: str) -> Tuple[int, int] | None:
+        # sample rate and channel count of a source file probed before, or None if it was never probed
+        path = os.path.join(self.directory, self.content_hash(filename) + SOURCE_FORMAT_FILE_EXTENSION)
+        try:
+            with open(path) as format_file:
+                source_format = json.load(format_file)
+        except (FileNotFoundError, ValueError):
+            return None
+        return source_format["sampleRate"], source_format["channels"]
+
+    def put_source_format(self, filename: str, sample_rate: int, channels: int):
+        # These files are a few bytes each and are never evicted: the format of a source does not depend on
+        # what it is decoded to, and keeping it saves the probe when the source is decoded again.
+        path = os.path.join(self.directory, self.content_hash(filename) + SOURCE_FORMAT_FILE_EXTENSION)
+        with tempfile.NamedTemporaryFile("w", dir=self.directory, suffix=".tmp", delete=False) as temp_file:
+            json.dump({"sampleRate": sample_rate, "channels": channels}, temp_file)
+        os.replace(temp_file.name, path)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + SAMPLE_CACHE_FILE_EXTENSION)
+
+    def get(self, key: str) -> np.ndarray | None:
+        # read-only (frames, channels) memory map of the cached samples, or None on a cache miss
+        path = self.path(key)
+        try:
+            frames = np.load(path, mmap_mode="r")
+        except (FileNotFoundError, ValueError, EOFError):
+            # missing, or cut short by a crash while it was written
+            return None
+
+        # the modification time doubles as the last access time for the LRU eviction
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return frames
+
+    def put(self, key: str, frames: np.ndarray) -> str:
+        # stores frames under key and returns the path of the entry
+        path = self.path(key)
+        with tempfile.NamedTemporaryFile(dir=self.directory, suffix=".tmp", delete=False) as temp_file:
+            np.save(temp_file, frames)
+        os.replace(temp_file.name, path)
+        return path
+
+    def evict(self, keep=()):
+        # Drop the least recently used entries until the cache fits in max_size_bytes again. The entries
+        # listed in keep (the ones a running job is about to map) are never dropped, even if that leaves
+        # the cache over its size cap until the next eviction.
+        keep_paths = {self.path(key) for key in keep}
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(SAMPLE_CACHE_FILE_EXTENSION) and entry.path not in keep_paths:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        cache_size = sum(size for _, size, _ in entries) + sum(
+            os.path.getsize(path) for path in keep_paths if os.path.exists(path))
+        for _, size, path in sorted(entries):
+            if cache_size <= self.max_size_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            cache_size -= size